@@ -12,6 +12,7 @@ from lollms.types import MSG_OPERATION_TYPE, SENDER_TYPES
 from lollms.utilities import PromptReshaper
 from lollms.client_session import Client, Session
 from lollms.databases.skills_database import SkillsLibrary
+from lollms.databases.maintenance import DatabaseMaintenanceScheduler
 from lollms.tasks import TasksLibrary
 
 from lollmsvectordb.database_elements.chunk import Chunk
@@ -179,6 +180,17 @@ class LollmsApplication(LoLLMsCom):
         self.session                    = Session(lollms_paths)
         self.skills_library             = SkillsLibrary(self.lollms_paths.personal_skills_path/(self.config.skills_lib_database_name+".sqlite"))
         self.tasks_library              = TasksLibrary(self)
+        self.db_maintenance             = DatabaseMaintenanceScheduler(self.is_idle, interval=max(1, self.config.db_maintenance_interval_minutes)*60)
+        self.db_maintenance.register("discussions", lambda: self.db.discussion_db_file_path if getattr(self, "db", None) is not None else None)
+        self.db_maintenance.register("skills", lambda: self.skills_library.db_path)
+        if self.config.db_maintenance_interval_minutes>0:
+            self.db_maintenance.start()
+
+    def is_idle(self)->bool:
+        """True when no generation is running, used to schedule background maintenance"""
+        if getattr(self, "busy", False):
+            return False
+        return not any(client.processing for client in list(self.session.clients.values()))
 
     @staticmethod
     def check_internet_connection():
@@ -710,7 +722,7 @@ class LollmsApplication(LoLLMsCom):
             personality = PersonalityBuilder(self.lollms_paths, self.config, self.model, self, callback=callback).build_personality(id)
             if personality.model is not None:
                 try:
-                    self.cond_tk = personality.model.tokenize(personality.personality_conditioning)
+                    self.cond_tk = personality.model.tokenize_cached(personality.personality_conditioning)
                     self.n_cond_tk = len(self.cond_tk)
                     ASCIIColors.success(f"Personality  {personality.name} mounted successfully")
                 except:
@@ -887,7 +899,7 @@ class LollmsApplication(LoLLMsCom):
         return True
 
     def recover_discussion(self,client_id, message_index=-1):
-        messages = self.session.get_client(client_id).discussion.get_messages()
+        messages = self.session.get_client(client_id).discussion.sync_messages()
         discussion=""
         for msg in messages:
             if message_index!=-1 and msg>message_index:
@@ -909,7 +921,6 @@ class LollmsApplication(LoLLMsCom):
             Tuple[str, str, List[str]]: The prepared query, original message content, and tokenized query.
         """
         skills_detials=[]
-        skills = []
         documentation_entries = []
         start_ai_header_id_template     = self.config.start_ai_header_id_template
         end_ai_header_id_template       = self.config.end_ai_header_id_template
@@ -918,20 +929,17 @@ class LollmsApplication(LoLLMsCom):
 
         if self.personality.callback is None:
             self.personality.callback = partial(self.process_data, client_id=client_id)
-        # Get the list of messages
+        # Get the branch of messages ending with the requested message (the last one by default).
+        # The messages stay loaded between turns, only the new ones are read, and the branch is
+        # materialized by the discussion so it is not walked again at each turn.
         client = self.session.get_client(client_id)
         discussion = client.discussion
-        messages = discussion.get_messages()
-
-        # Find the index of the message with the specified message_id
-        message_index = -1
-        for i, message in enumerate(messages):
-            if message.id == message_id:
-                message_index = i
-                break
-        
+        all_messages = discussion.sync_messages()
         # Define current message
-        current_message = messages[message_index]
+        current_message = all_messages[discussion.get_message_index(message_id)]
+        discussion.current_message = all_messages[-1]
+        messages = discussion.get_branch(current_message.id)
+        message_index = len(messages)-1
 
         # Build the conditionning text block
         default_language = self.personality.language.lower().strip().split()[0]
@@ -968,21 +976,21 @@ class LollmsApplication(LoLLMsCom):
         # boosting information
         if self.config.positive_boost:
             positive_boost=f"{self.system_custom_header('important information')}"+self.config.positive_boost+"\n"
-            n_positive_boost = len(self.model.tokenize(positive_boost))
+            n_positive_boost = self.model.count_tokens(positive_boost)
         else:
             positive_boost=""
             n_positive_boost = 0
 
         if self.config.negative_boost:
             negative_boost=f"{self.system_custom_header('important information')}"+self.config.negative_boost+"\n"
-            n_negative_boost = len(self.model.tokenize(negative_boost))
+            n_negative_boost = self.model.count_tokens(negative_boost)
         else:
             negative_boost=""
             n_negative_boost = 0
 
         if self.config.fun_mode:
             fun_mode=f"{self.system_custom_header('important information')} Fun mode activated. In this mode you must answer in a funny playful way. Do not be serious in your answers. Each answer needs to make the user laugh.\n"
-            n_fun_mode = len(self.model.tokenize(positive_boost))
+            n_fun_mode = self.model.count_tokens(fun_mode)
         else:
             fun_mode=""
             n_fun_mode = 0
@@ -1272,10 +1280,10 @@ The reformulation must be placed inside a json markdown tag like this:
                         self.personality.step_start("Adding skills")
                         if self.config.debug:
                             ASCIIColors.info(f"Query : {query}")
-                        skill_titles, skills, similarities = self.skills_library.query_vector_db(query, top_k=3, min_similarity=self.config.rag_min_correspondance)#query_entry_fts(query)
-                        skills_detials=[{"title": title, "content":content, "similarity":similarity} for title, content, similarity in zip(skill_titles, skills, similarities)]
+                        # similarity is the cosine similarity (None for skills only found by keywords), score depends on score_type
+                        skills_detials=self.skills_library.query_details(query, top_k=3, min_similarity=self.config.rag_min_correspondance, method=self.config.skills_lib_retrieval, time_budget_ms=self.config.skills_lib_retrieval_budget_ms)
 
-                        if len(skills)>0:
+                        if len(skills_detials)>0:
                             if knowledge=="":
                                 knowledge=f"{self.system_custom_header(knowledge)}\n"
                             for i,skill in enumerate(skills_detials):
@@ -1293,13 +1301,13 @@ The reformulation must be placed inside a json markdown tag like this:
 
 
         # Tokenize the conditionning text and calculate its number of tokens
-        tokens_conditionning = self.model.tokenize(conditionning)
+        tokens_conditionning = self.model.tokenize_cached(conditionning)
         n_cond_tk = len(tokens_conditionning)
 
 
         # Tokenize the internet search results text and calculate its number of tokens
         if len(internet_search_results)>0:
-            tokens_internet_search_results = self.model.tokenize(internet_search_results)
+            tokens_internet_search_results = self.model.tokenize_cached(internet_search_results)
             n_isearch_tk = len(tokens_internet_search_results)
         else:
             tokens_internet_search_results = []
@@ -1308,7 +1316,7 @@ The reformulation must be placed inside a json markdown tag like this:
 
         # Tokenize the documentation text and calculate its number of tokens
         if len(documentation)>0:
-            tokens_documentation = self.model.tokenize(documentation)
+            tokens_documentation = self.model.tokenize_cached(documentation)
             n_doc_tk = len(tokens_documentation)
             self.info(f"The documentation consumes {n_doc_tk} tokens")
             if n_doc_tk>3*self.config.ctx_size/4:
@@ -1326,7 +1334,7 @@ The reformulation must be placed inside a json markdown tag like this:
 
         # Tokenize the knowledge text and calculate its number of tokens
         if len(knowledge)>0:
-            tokens_history = self.model.tokenize(knowledge)
+            tokens_history = self.model.tokenize_cached(knowledge)
             n_history_tk = len(tokens_history)
         else:
             tokens_history = []
@@ -1335,7 +1343,7 @@ The reformulation must be placed inside a json markdown tag like this:
 
         # Tokenize user description
         if len(user_description)>0:
-            tokens_user_description = self.model.tokenize(user_description)
+            tokens_user_description = self.model.tokenize_cached(user_description)
             n_user_description_tk = len(tokens_user_description)
         else:
             tokens_user_description = []
@@ -1372,7 +1380,7 @@ The reformulation must be placed inside a json markdown tag like this:
         full_message_list = []
         # If this is not a continue request, we add the AI prompt
         if not is_continue:
-            message_tokenized = self.model.tokenize(
+            message_tokenized = self.model.tokenize_cached(
                 self.personality.ai_message_prefix.strip()
             )
             full_message_list.append(message_tokenized)
@@ -1381,6 +1389,16 @@ The reformulation must be placed inside a json markdown tag like this:
 
 
         if generation_type != "simple_question":
+            # Message sizes come from the token counts stored in the database for the current model,
+            # only messages that were never counted are tokenized. Fully included messages are kept
+            # as text and only the message that overflows the context is tokenized and cropped.
+            # Header and content are counted apart and the texts are joined afterwards, which can
+            # tokenize differently at the junctions: each message keeps one token of margin for it
+            # and the assembled history is checked again below.
+            tokenizer_id = self.model.get_model_identity()
+            client.discussion.load_tokens_counts(tokenizer_id)
+            header_tokens_counts = {}
+            counted_messages = []
             # Accumulate messages starting from message_index
             for i in range(message_index, -1, -1):
                 message = messages[i]
@@ -1389,31 +1407,38 @@ The reformulation must be placed inside a json markdown tag like this:
                 if message.content != '' and (
                         message.message_type <= MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_USER.value and message.message_type != MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_SET_CONTENT_INVISIBLE_TO_AI.value):
 
-                    # Tokenize the message content
-                    if self.config.use_model_name_in_discussions:
-                        if message.model:
-                            msg =  f"{self.separator_template}" + f"{start_ai_header_id_template if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.start_user_header_id_template}{message.sender}({message.model}){end_ai_header_id_template  if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.end_user_header_id_template}" + message.content.strip()
-                        else:
-                            msg = f"{self.separator_template}" + f"{start_ai_header_id_template if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.start_user_header_id_template}{message.sender}{end_ai_header_id_template  if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.end_user_header_id_template}" + message.content.strip()
-                        message_tokenized = self.model.tokenize(msg)
+                    if self.config.use_model_name_in_discussions and message.model:
+                        header = f"{self.separator_template}" + f"{start_ai_header_id_template if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.start_user_header_id_template}{message.sender}({message.model}){end_ai_header_id_template  if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.end_user_header_id_template}"
                     else:
-                        msg_value= f"{self.separator_template}" + f"{start_ai_header_id_template if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.start_user_header_id_template}{message.sender}{end_ai_header_id_template  if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.end_user_header_id_template}" + message.content.strip()
-                        message_tokenized = self.model.tokenize(
-                            msg_value
-                        )
+                        header = f"{self.separator_template}" + f"{start_ai_header_id_template if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.start_user_header_id_template}{message.sender}{end_ai_header_id_template  if message.sender_type == SENDER_TYPES.SENDER_TYPES_AI else self.end_user_header_id_template}"
+                    if header not in header_tokens_counts:
+                        header_tokens_counts[header] = self.model.count_tokens(header)
+                    content_tokens = message.tokens_counts.get(tokenizer_id)
+                    if content_tokens is None:
+                        # Stored in the database, no need to keep it in the tokens cache
+                        content_tokens = self.model.count_tokens(message.content.strip(), use_cache=False)
+                        message.tokens_counts[tokenizer_id] = content_tokens
+                        counted_messages.append(message)
+                    message_tokens_count = header_tokens_counts[header] + content_tokens + 1
                     # Check if adding the message will exceed the available space
-                    if tokens_accumulated + len(message_tokenized) > available_space:
-                        # Update the cumulative number of tokens
-                        msg = message_tokenized[-(available_space-tokens_accumulated):]
-                        tokens_accumulated += available_space-tokens_accumulated
-                        full_message_list.insert(0, msg)
+                    if tokens_accumulated + message_tokens_count > available_space:
+                        if available_space>tokens_accumulated:
+                            message_tokenized = self.model.tokenize(header + message.content.strip())
+                            # Update the cumulative number of tokens
+                            msg = message_tokenized[-(available_space-tokens_accumulated):]
+                            tokens_accumulated += available_space-tokens_accumulated
+                            full_message_list.insert(0, msg)
                         break
 
-                    # Add the tokenized message to the full_message_list
-                    full_message_list.insert(0, message_tokenized)
+                    # Add the message text to the full_message_list
+                    full_message_list.insert(0, header + message.content.strip())
 
                     # Update the cumulative number of tokens
-                    tokens_accumulated += len(message_tokenized)
+                    tokens_accumulated += message_tokens_count
+            try:
+                client.discussion.store_tokens_counts(tokenizer_id, counted_messages)
+            except Exception as ex:
+                trace_exception(ex)
         else:
             message = messages[message_index]
 
@@ -1442,8 +1467,14 @@ The reformulation must be placed inside a json markdown tag like this:
         discussion_messages = ""
         for i in range(len(full_message_list)-1 if not is_continue else len(full_message_list)):
             message_tokens = full_message_list[i]
-            discussion_messages += self.model.detokenize(message_tokens)
-        
+            discussion_messages += message_tokens if isinstance(message_tokens, str) else self.model.detokenize(message_tokens)
+
+        # The history was sized from separate counts: make sure the joined text really fits, and
+        # drop its oldest tokens if it doesn't (the AI prefix is the last entry when not continuing)
+        history_space = available_space - (len(full_message_list[-1]) if not is_continue and len(full_message_list)>0 else 0)
+        if len(discussion_messages)>0 and self.model.count_tokens(discussion_messages, use_cache=False)>history_space:
+            discussion_messages = self.model.detokenize(self.model.tokenize(discussion_messages)[-history_space:]) if history_space>0 else ""
+
         if len(full_message_list)>0:
             ai_prefix = self.personality.ai_message_prefix
         else:
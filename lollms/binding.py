@@ -7,7 +7,7 @@
 # This is an interface class for lollms bindings.
 ######
 from fastapi import Request
-from typing import Dict, Any
+from typing import Dict, Any, List
 from pathlib import Path
 from typing import Callable, Any
 from lollms.paths import LollmsPaths
@@ -35,6 +35,9 @@ from lollms.utilities import trace_exception
 
 from tqdm import tqdm
 from lollms.databases.models_database import ModelsDB
+from lollms.models_inventory import ModelsInventory
+from lollms.utilities import path_signature
+from lollms.tokens_cache import TokensCache
 import sys
 
 __author__ = "parisneo"
@@ -97,12 +100,66 @@ class LLMBinding:
         for models_folder in self.models_folders:
             models_folder.mkdir(parents=True, exist_ok=True)
 
+        # Zoo databases kept open (models_dir_name -> (file signature, ModelsDB))
+        self._models_dbs = {}
+        # Installed and available models, shared by the endpoints
+        self.models_inventory = ModelsInventory(self, watch=config.models_inventory_watch)
+        # Recent tokenizations (see count_tokens and tokenize_cached)
+        self.tokens_cache = TokensCache()
+
 
     def get_nb_tokens(self, prompt):
         """
         Counts the number of tokens in a prtompt
         """
-        return len(self.tokenize(prompt))
+        return self.count_tokens(prompt)
+
+    def count_tokens(self, text:str, use_cache:bool=True)->int:
+        """
+        Counts the number of tokens of a text.
+        Texts that are counted again and again (conditioning, descriptions, headers, prompts) are only tokenized once.
+
+        Args:
+            text (str): The text to count.
+            use_cache (bool): Set to False for texts that won't be seen again (generated outputs, streams),
+                they are tokenized without taking the place of other texts in the cache.
+
+        Returns:
+            int: The number of tokens.
+        """
+        if not use_cache:
+            return len(self.tokenize(text))
+        return len(self._cached_tokens(text))
+
+    def _cached_tokens(self, text:str)->tuple:
+        identity = self.get_model_identity()
+        tokens = self.tokens_cache.get(identity, text)
+        if tokens is None:
+            tokens = self.tokens_cache.put(identity, text, self.tokenize(text))
+        return tokens
+
+    def tokenize_cached(self, text:str)->list:
+        """
+        Same as tokenize, but the tokens of recently tokenized texts are taken from the tokens cache.
+
+        Args:
+            text (str): The text to tokenize.
+
+        Returns:
+            list: The tokens (a new list, it can be modified).
+        """
+        return list(self._cached_tokens(text))
+
+    def clear_tokens_cache(self):
+        """Forgets the cached tokenizations, to be called when the tokenizer changes (model switch)"""
+        self.tokens_cache.clear()
+
+    def get_model_identity(self)->str:
+        """
+        Returns a string identifying the binding and model, and thus the tokenizer in use.
+        Token counts computed with one identity are not valid for another one.
+        """
+        return f"{self.binding_folder_name}:{self.config.model_name}"
 
     def searchModelFolder(self, model_name:str):
         for mn in self.models_folders:
@@ -189,6 +246,7 @@ class LLMBinding:
             with open(model_full_path,"w") as f:
                 f.write(str(path))
             self.InfoMessage("Reference created, please make sure you don't delete or move the referenced file.\nThis can cause the link to be broken.\nNow I'm reloading the zoo.")
+            self.models_inventory.invalidate()
             return True
 
 
@@ -373,7 +431,9 @@ class LLMBinding:
                     trace_exception(ex)
                     ASCIIColors.error(f"Couldn't delete file. Please try to remove it manually.\n{installation_path}")
                 return
-   
+
+            # The new variant is inside an existing folder, this is not seen by the folders signature
+            self.models_inventory.invalidate()
             self.lollmsCom.notify_model_install(
                         installation_path,
                         model_name,
@@ -780,11 +840,30 @@ class LLMBinding:
         return models
     
 
+    def get_models_db(self, models_dir_name:str)->ModelsDB:
+        """
+        Returns the zoo database of a models folder.
+        The zoo file is only read, it is served from an indexed copy in the personal data folder that is
+        refreshed only if the file was replaced or modified (zoo update).
+        """
+        db_path = self.lollms_paths.models_zoo_path/f"{models_dir_name}.db"
+        signature = path_signature(db_path)
+        entry = self._models_dbs.get(models_dir_name)
+        if entry is not None and entry[0]==signature:
+            return entry[1]
+        if entry is not None:
+            models_db = entry[1]
+            models_db.sync()
+        else:
+            models_db = ModelsDB(self.lollms_paths.personal_data_path/"models_zoo_cache"/f"{models_dir_name}.db", source=db_path)
+        self._models_dbs[models_dir_name] = (signature, models_db)
+        return models_db
+
     def get_available_models(self, app:LoLLMsCom=None):
         # Create the file path relative to the child class's directory
         full_data = []
         for models_dir_name in self.models_dir_names:
-            self.models_db = ModelsDB(self.lollms_paths.models_zoo_path/f"{models_dir_name}.db")
+            self.models_db = self.get_models_db(models_dir_name)
             full_data+=self.models_db.query()
         
         return full_data
@@ -793,11 +872,29 @@ class LLMBinding:
         # Create the file path relative to the child class's directory
         full_data = []
         for models_dir_name in self.models_dir_names:
-            self.models_db = ModelsDB(self.lollms_paths.models_zoo_path/f"{models_dir_name}.db")
+            self.models_db = self.get_models_db(models_dir_name)
             full_data+=self.models_db.query()
         
         return full_data           
 
+    def search_models_page(self, app:LoLLMsCom=None, text:str=None, model_types:List[str]=None, limit:int=50, offset:int=0, sort_by:str="last_commit_time"):
+        """Searches the models zoos of the binding (full text over names, descriptions and creators), one page at a time
+
+        Returns:
+            dict: {"models": [...], "total": number of matching models}
+        """
+        # The page spans the zoos in order
+        models = []
+        total = 0
+        for models_dir_name in self.models_dir_names:
+            self.models_db = self.get_models_db(models_dir_name)
+            page_offset = max(0, offset-total)
+            page_limit = max(0, limit-len(models))
+            result = self.models_db.search(text, model_types, limit=page_limit, offset=page_offset, sort_by=sort_by)
+            models += result["models"]
+            total += result["total"]
+        return {"models": models, "total": total}
+
     @staticmethod
     def vram_usage():
         try:
@@ -0,0 +1,177 @@
+"""
+project: lollms
+file: discussions_archive.py
+author: ParisNeo
+description:
+    Cold storage for discussions that have not been used for a long time.
+    The messages of an archived discussion are moved out of the main database into a separate
+    sqlite file (archive.db) as a single compressed blob, and the discussion folder is packed into
+    a compressed tar bundle. The discussion row itself stays in the main database so listings keep
+    working, and the archive keeps queryable metadata (message count, last activity, sizes).
+"""
+import json
+import tarfile
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Set
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+def folder_size(folder:Path)->int:
+    """Returns the total size in bytes of the files of a folder"""
+    if not folder.exists():
+        return 0
+    return sum(f.stat().st_size for f in folder.rglob("*") if f.is_file())
+
+
+class DiscussionsArchive:
+    """
+    Cold storage of a discussions database.
+    The archive file and the bundles folder are only created when the first discussion is archived.
+    """
+    def __init__(self, discussion_db_path:Path, compression_level:int=6):
+        self.archive_file_path = discussion_db_path/"archive.db"
+        self.bundles_path = discussion_db_path/"archive"
+        self.compression_level = compression_level
+        self._pool:SQLiteConnectionPool = None
+        self._archived_ids:Set[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self)->SQLiteConnectionPool:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    pool = SQLiteConnectionPool(self.archive_file_path)
+                    with pool.connection() as conn:
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS archived_discussion (
+                                id INTEGER PRIMARY KEY,
+                                title TEXT,
+                                created_at TIMESTAMP,
+                                last_activity_at TIMESTAMP,
+                                archived_at TIMESTAMP,
+                                message_count INT NOT NULL DEFAULT 0,
+                                messages BLOB,
+                                bundle TEXT,
+                                original_size INT NOT NULL DEFAULT 0,
+                                archived_size INT NOT NULL DEFAULT 0
+                            )
+                        """)
+                    self._pool = pool
+        return self._pool
+
+    def exists(self)->bool:
+        return self._pool is not None or self.archive_file_path.exists()
+
+    @property
+    def archived_ids(self)->Set[int]:
+        """Ids of the archived discussions, loaded once and kept up to date by archive/restore"""
+        if self._archived_ids is None:
+            if not self.exists():
+                self._archived_ids = set()
+            else:
+                with self.pool.connection() as conn:
+                    self._archived_ids = {row[0] for row in conn.execute("SELECT id FROM archived_discussion")}
+        return self._archived_ids
+
+    def is_archived(self, discussion_id:int)->bool:
+        return discussion_id in self.archived_ids
+
+    def bundle_path(self, discussion_id:int)->Path:
+        return self.bundles_path/f"{discussion_id}.tar.xz"
+
+    def store(self, discussion:Dict[str, Any], messages:List[Dict[str, Any]], tokens_counts:List[tuple], folder:Path)->Dict[str, int]:
+        """
+        Writes a discussion to the cold storage.
+
+        Args:
+            discussion (dict): id, title, created_at and last_activity_at of the discussion.
+            messages (list): The message rows as dictionaries (column -> value).
+            tokens_counts (list): The (message_id, tokenizer, nb_tokens) rows of the messages.
+            folder (Path): The discussion folder, bundled if it exists.
+
+        Returns:
+            dict: original_size and archived_size in bytes
+        """
+        payload = json.dumps({"messages": messages, "tokens_counts": tokens_counts}).encode("utf-8")
+        blob = zlib.compress(payload, self.compression_level)
+        original_size = len(payload)
+        archived_size = len(blob)
+        bundle = None
+        if folder.exists() and any(folder.iterdir()):
+            self.bundles_path.mkdir(exist_ok=True, parents=True)
+            bundle_path = self.bundle_path(discussion["id"])
+            with tarfile.open(bundle_path, "w:xz") as tar:
+                tar.add(folder, arcname=".")
+            bundle = bundle_path.name
+            original_size += folder_size(folder)
+            archived_size += bundle_path.stat().st_size
+
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO archived_discussion (id, title, created_at, last_activity_at, archived_at, message_count, messages, bundle, original_size, archived_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    discussion["id"], discussion["title"], discussion["created_at"], discussion["last_activity_at"],
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'), len(messages), blob, bundle, original_size, archived_size
+                )
+            )
+        self.archived_ids.add(discussion["id"])
+        return {"original_size": original_size, "archived_size": archived_size}
+
+    def load(self, discussion_id:int):
+        """
+        Returns the archived (messages, tokens_counts) of a discussion, or None if it is not archived
+        """
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT messages FROM archived_discussion WHERE id=?", (discussion_id,)).fetchone()
+        if row is None:
+            return None
+        payload = json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        return payload["messages"], [tuple(t) for t in payload["tokens_counts"]]
+
+    def unpack_bundle(self, discussion_id:int, folder:Path):
+        """Extracts the bundle of a discussion (if any) into its folder"""
+        bundle_path = self.bundle_path(discussion_id)
+        if not bundle_path.exists():
+            return
+        folder.mkdir(exist_ok=True, parents=True)
+        with tarfile.open(bundle_path, "r:xz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(folder, filter="data")
+            else:
+                tar.extractall(folder)
+
+    def remove(self, discussion_id:int):
+        """Forgets an archived discussion (after it was restored or deleted)"""
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM archived_discussion WHERE id=?", (discussion_id,))
+        bundle_path = self.bundle_path(discussion_id)
+        if bundle_path.exists():
+            bundle_path.unlink()
+        self.archived_ids.discard(discussion_id)
+
+    def list_archived(self)->List[Dict[str, Any]]:
+        """Returns the metadata of the archived discussions without decompressing anything"""
+        if not self.exists():
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id, title, created_at, last_activity_at, archived_at, message_count, original_size, archived_size FROM archived_discussion ORDER BY id DESC").fetchall()
+        return [
+            {
+                "id": row[0], "title": row[1], "created_at": row[2], "last_activity_at": row[3], "archived_at": row[4],
+                "message_count": row[5], "original_size": row[6], "archived_size": row[7]
+            }
+            for row in rows
+        ]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close_all()
@@ -1,33 +1,48 @@
 
 import sqlite3
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from ascii_colors import ASCIIColors, trace_exception
 from lollms.types import MSG_OPERATION_TYPE
 from lollms.types import BindingType
 from lollms.utilities import PackageManager, discussion_path_to_url
 from lollms.paths import LollmsPaths
 from lollms.com import LoLLMsCom
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+from lollms.databases.write_behind import WriteBehindBuffer
+from lollms.databases.discussions_archive import DiscussionsArchive
+from lollms.databases.media_store import MediaStore, open_unshared
+from lollms.databases.folder_remover import FolderRemover
 
 from lollmsvectordb.vector_database import VectorDatabase
 from lollmsvectordb.text_document_loader import TextDocumentsLoader
 import gc
 import json
 import shutil
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from lollms.tasks import TasksLibrary
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
 __author__ = "parisneo"
 __github__ = "https://github.com/ParisNeo/lollms-webui"
 __copyright__ = "Copyright 2023, "
 __license__ = "Apache 2.0"
 
+# UPDATE ... RETURNING appeared in sqlite 3.35
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info>=(3, 35, 0)
+
 
 # =================================== Database ==================================================================
 class DiscussionsDB:
-    
-    def __init__(self, lollms:LoLLMsCom, lollms_paths:LollmsPaths, discussion_db_name="default"):
+    # Database files whose schema has been checked by this process
+    _verified_schemas = set()
+    _schema_lock = threading.Lock()
+
+    def __init__(self, lollms:LoLLMsCom, lollms_paths:LollmsPaths, discussion_db_name="default", flush_interval_ms:int=250):
         self.lollms = lollms
         self.lollms_paths = lollms_paths
         
@@ -36,10 +51,46 @@ class DiscussionsDB:
 
         self.discussion_db_path.mkdir(exist_ok=True, parents= True)
         self.discussion_db_file_path = self.discussion_db_path/"database.db"
+        self.pool = SQLiteConnectionPool(self.discussion_db_file_path)
+        # Streamed message updates are coalesced and written at most every flush_interval_ms
+        self.write_buffer = WriteBehindBuffer(self.pool, "message", flush_interval_ms)
+        # Cold storage of the idle discussions (opened only when used)
+        self.archive = DiscussionsArchive(self.discussion_db_path)
+        # Archiving and restoring a discussion never run at the same time
+        self._archive_lock = threading.Lock()
+        # Discussion objects alive on this database, they are never archived
+        self._live_discussions = weakref.WeakSet()
+        # Files added to the discussions are stored once by content and linked from the discussion folders
+        self.media_store = MediaStore(self.discussion_db_path/"media")
+        # Folders of deleted discussions are removed in the background, then the unused media are collected
+        self.folder_remover = FolderRemover(on_done=self.media_store.collect_garbage)
+
+    def ensure_schema(self)->bool:
+        """
+        Creates or upgrades the schema, once per database file and per process.
+        Returns True if the schema was checked now, False if it was already done.
+        """
+        key = str(self.discussion_db_file_path.resolve())
+        with DiscussionsDB._schema_lock:
+            if key in DiscussionsDB._verified_schemas and self.discussion_db_file_path.exists():
+                return False
+            self.create_tables()
+            self.add_missing_columns()
+            DiscussionsDB._verified_schemas.add(key)
+            return True
+
+    def close_if_idle(self, idle_seconds:float)->bool:
+        """Closes the connections of this database if it has not been used for idle_seconds (they reopen on next use)"""
+        if self.write_buffer.has_pending():
+            return False
+        closed = self.pool.close_if_idle(idle_seconds)
+        if self.archive._pool is not None:
+            self.archive._pool.close_if_idle(idle_seconds)
+        return closed
 
     def create_tables(self):
-        db_version = 14
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        db_version = 19
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("""
@@ -54,7 +105,11 @@ class DiscussionsDB:
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     title TEXT,
                     metadata TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    parent_discussion_id INT,
+                    fork_message_id INT,
+                    message_count INT DEFAULT 0,
+                    last_message_at TIMESTAMP
                 )
             """)
 
@@ -94,7 +149,7 @@ class DiscussionsDB:
             conn.commit()
 
     def add_missing_columns(self):
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             table_columns = {
@@ -102,7 +157,11 @@ class DiscussionsDB:
                     'id',
                     'title',
                     'metadata',
-                    'created_at'
+                    'created_at',
+                    'parent_discussion_id',
+                    'fork_message_id',
+                    'message_count',
+                    'last_message_at'
                 ],
                 'message': [
                     'id',
@@ -146,10 +205,203 @@ class DiscussionsDB:
                             cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT DEFAULT 0")
                         elif column=='parent_message_id':
                             cursor.execute(f"ALTER TABLE {table} RENAME COLUMN parent TO {column}")
+                        elif column in ['parent_discussion_id', 'fork_message_id']:
+                            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT")
+                        elif column=='message_count':
+                            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT DEFAULT 0")
                         else:
                             cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
                         ASCIIColors.yellow(f"Added column :{column}")
             conn.commit()
+            # The indexes need the up to date columns, so they are built once the columns are fixed
+            self.create_indexes(cursor)
+            self.create_fts(cursor)
+            self.create_tokens_counts(cursor)
+            self.create_discussion_stats(cursor)
+            conn.commit()
+
+    def create_indexes(self, cursor):
+        """
+        Creates the indexes introduced by the version 15 of the schema.
+        Messages are always fetched by discussion and ordered by id, so (discussion_id, id)
+        serves both the full listing and the keyset pagination without a table scan.
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='idx_message_discussion_id'")
+        is_new = cursor.fetchone() is None
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_discussion_id ON message (discussion_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_parent_message_id ON message (parent_message_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_discussion_created_at ON message (discussion_id, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_discussion_created_at ON discussion (created_at)")
+        # Forks are looked up by parent (version 18)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_discussion_parent_discussion_id ON discussion (parent_discussion_id)")
+        if is_new:
+            ASCIIColors.yellow("Added discussions database indexes")
+            # Give the query planner statistics about the new indexes
+            cursor.execute("ANALYZE")
+
+    def create_fts(self, cursor):
+        """
+        Creates the message_fts full text index introduced by the version 16 of the schema.
+        It is an external content FTS5 table over message.content kept in sync by triggers.
+        When the table is created on an existing database, it is backfilled from the messages.
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='message_fts'")
+        is_new = cursor.fetchone() is None
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(content, content='message', content_rowid='id')")
+        except sqlite3.OperationalError as ex:
+            ASCIIColors.warning(f"Full text search is not available with this sqlite version: {ex}")
+            return
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+                INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+                INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+                INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        if is_new:
+            ASCIIColors.yellow("Indexing the messages for full text search")
+            self.rebuild_fts(cursor)
+
+    def create_tokens_counts(self, cursor):
+        """
+        Creates the message_tokens table introduced by the version 17 of the schema.
+        It stores the number of tokens of each message content per tokenizer (binding:model identity).
+        Triggers drop the counts of a message when its content changes or when it is deleted.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_tokens (
+                message_id INTEGER NOT NULL,
+                tokenizer TEXT NOT NULL,
+                nb_tokens INTEGER NOT NULL,
+                PRIMARY KEY (message_id, tokenizer)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_tokens_invalidate AFTER UPDATE OF content ON message
+            WHEN old.content IS NOT new.content BEGIN
+                DELETE FROM message_tokens WHERE message_id = old.id;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS message_tokens_delete AFTER DELETE ON message BEGIN
+                DELETE FROM message_tokens WHERE message_id = old.id;
+            END
+        """)
+
+    def create_discussion_stats(self, cursor):
+        """
+        Creates the triggers maintaining the message_count and last_message_at columns of the
+        discussions (version 19 of the schema), so that listings don't have to aggregate the messages.
+        When the triggers are created on an existing database, the columns are backfilled.
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name='discussion_stats_insert'")
+        is_new = cursor.fetchone() is None
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS discussion_stats_insert AFTER INSERT ON message BEGIN
+                UPDATE discussion SET
+                    message_count = COALESCE(message_count, 0) + 1,
+                    last_message_at = CASE WHEN last_message_at IS NULL OR new.created_at > last_message_at THEN new.created_at ELSE last_message_at END
+                WHERE id = new.discussion_id;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS discussion_stats_delete AFTER DELETE ON message BEGIN
+                UPDATE discussion SET
+                    message_count = MAX(COALESCE(message_count, 0) - 1, 0),
+                    last_message_at = (SELECT MAX(created_at) FROM message WHERE discussion_id = old.discussion_id)
+                WHERE id = old.discussion_id;
+            END
+        """)
+        if is_new:
+            ASCIIColors.yellow("Computing the discussions statistics")
+            self.refresh_discussion_stats(cursor=cursor)
+
+    def refresh_discussion_stats(self, discussion_ids:list=None, cursor=None):
+        """Recomputes message_count and last_message_at from the messages (all the discussions by default)"""
+        query = """
+            UPDATE discussion SET
+                message_count = (SELECT COUNT(*) FROM message WHERE message.discussion_id = discussion.id),
+                last_message_at = (SELECT MAX(created_at) FROM message WHERE message.discussion_id = discussion.id)
+        """
+        if cursor is None:
+            with self.pool.connection() as conn:
+                self.refresh_discussion_stats(discussion_ids, conn.cursor())
+            return
+        if discussion_ids is None:
+            cursor.execute(query)
+        else:
+            cursor.executemany(query+" WHERE id = ?", [(discussion_id,) for discussion_id in discussion_ids])
+
+    def rebuild_fts(self, cursor=None):
+        """
+        Rebuilds the full text index from the message table (one-off backfill or repair).
+        """
+        if cursor is not None:
+            cursor.execute("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+        else:
+            self.update("INSERT INTO message_fts(message_fts) VALUES ('rebuild')", ())
+
+    @staticmethod
+    def _fts_query(text:str)->str:
+        # Every word is quoted so that user input can't break the FTS5 query syntax
+        return " ".join('"'+word.replace('"', '""')+'"' for word in text.split())
+
+    def search_messages(self, text:str, limit:int=20, offset:int=0, discussion_id:int=None, raw_query:bool=False):
+        """
+        Full text search over the content of all the messages.
+
+        Args:
+            text (str): The words to search for (all must be present).
+            limit (int): Page size.
+            offset (int): Number of results to skip (use next_offset of the previous page).
+            discussion_id (int, optional): Restrict the search to one discussion.
+            raw_query (bool): If True, text is used as is as an FTS5 query (operators, prefixes, NEAR...).
+
+        Returns:
+            dict: {"results": [{"message_id", "discussion_id", "discussion_title", "sender", "created_at", "snippet", "score"}...],
+                   "next_offset": offset of the next page or None, "archived_excluded": number of archived discussions not searched}
+                Results are ranked by bm25, best first.
+                Archived discussions are not searched (their messages are in the cold storage), restore them to search them.
+        """
+        query = text if raw_query else self._fts_query(text)
+        archived_excluded = len(self.archive.archived_ids) if discussion_id is None else int(self.archive.is_archived(discussion_id))
+        if query.strip()=="":
+            return {"results":[], "next_offset":None, "archived_excluded":archived_excluded}
+        limit = max(1, int(limit))
+        offset = max(0, int(offset))
+        sql = """
+            SELECT m.id, m.discussion_id, d.title, m.sender, m.created_at,
+                   snippet(message_fts, 0, '<b>', '</b>', '...', 16), bm25(message_fts) AS score
+            FROM message_fts
+            JOIN message m ON m.id = message_fts.rowid
+            JOIN discussion d ON d.id = m.discussion_id
+            WHERE message_fts MATCH ?"""
+        params = [query]
+        if discussion_id is not None:
+            sql += " AND m.discussion_id = ?"
+            params.append(discussion_id)
+        sql += " ORDER BY score LIMIT ? OFFSET ?"
+        params += [limit+1, offset]
+        rows = self.select(sql, tuple(params))
+        has_more = len(rows)>limit
+        return {
+            "results":[
+                {"message_id":row[0], "discussion_id":row[1], "discussion_title":row[2], "sender":row[3], "created_at":row[4], "snippet":row[5], "score":-row[6]}
+                for row in rows[:limit]
+            ],
+            "next_offset": offset+limit if has_more else None,
+            "archived_excluded": archived_excluded
+        }
 
 
     def select(self, query, params=None, fetch_all=True):
@@ -158,7 +410,10 @@ class DiscussionsDB:
         with optional parameters.
         Returns the cursor object for further processing.
         """
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        # Readers must see the latest streamed content
+        if self.write_buffer.has_pending():
+            self.write_buffer.flush()
+        with self.pool.connection() as conn:
             if params is None:
                 cursor = conn.execute(query)
             else:
@@ -169,19 +424,30 @@ class DiscussionsDB:
                 return cursor.fetchone()
             
 
+    def select_messages(self, query, params=None)->List["Message"]:
+        """Runs a query selecting the columns of Message.get_fields (in that order) and returns Message objects.
+        The messages are built by the row factory of the cursor while fetching.
+        """
+        if self.write_buffer.has_pending():
+            self.write_buffer.flush()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = lambda cursor, row: Message.from_row(self, row)
+            cursor.execute(query, params or ())
+            return cursor.fetchall()
+
     def delete(self, query, params=None):
         """
         Execute the specified SQL delete query on the database,
         with optional parameters.
         Returns the cursor object for further processing.
         """
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             if params is None:
                 cursor.execute(query)
             else:
                 cursor.execute(query, params)
-            conn.commit()
    
     def insert(self, query, params=None):
         """
@@ -190,11 +456,9 @@ class DiscussionsDB:
         Returns the ID of the newly inserted row.
         """
         
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.execute(query, params)
             rowid = cursor.lastrowid
-            conn.commit()
-        self.conn = None
         return rowid
 
     def update(self, query, params:tuple=None):
@@ -204,9 +468,31 @@ class DiscussionsDB:
         Returns the ID of the newly inserted row.
         """
         
-        with sqlite3.connect(self.discussion_db_file_path) as conn:
+        with self.pool.connection() as conn:
             conn.execute(query, params)
-            conn.commit()
+
+    def get_pool_stats(self):
+        """
+        Returns the statistics of the connection pool of this database
+        (opened/reused connections, number of queries, commits, rollbacks...)
+        """
+        stats = self.pool.get_stats()
+        stats["write_buffer"] = self.write_buffer.get_stats()
+        return stats
+
+    def flush(self):
+        """
+        Writes all the pending message updates to the database
+        """
+        self.write_buffer.flush()
+
+    def close(self):
+        """
+        Writes the pending message updates and closes all the connections held for this database
+        """
+        self.write_buffer.stop()
+        self.pool.close_all()
+        self.archive.close()
     
     def load_last_discussion(self):
         last_discussion_id = self.select("SELECT id FROM discussion ORDER BY id DESC LIMIT 1", fetch_all=False)
@@ -243,9 +529,191 @@ class DiscussionsDB:
     def build_discussion(self, discussion_id=0):
         return Discussion(self.lollms, discussion_id, self)
 
+    # ----------------------------- Forks -----------------------------
+    # Messages inherited by a fork: the chain of parents starting from its fork message.
+    # The chain naturally climbs through the parents of the parent when forking a fork.
+    FORK_CHAIN_CTE = """WITH RECURSIVE chain(id) AS (
+                SELECT ?
+                UNION
+                SELECT m.parent_message_id FROM message m JOIN chain c ON m.id = c.id WHERE m.parent_message_id > 0
+            ) """
+
+    def fork_discussion(self, discussion_id:int, message_id:int, title:str=None):
+        """
+        Creates a copy-on-write fork of a discussion.
+        The fork shares the branch of the parent ending with message_id and only stores its own new messages.
+
+        Args:
+            discussion_id (int): The discussion to fork.
+            message_id (int): The last message of the parent branch that is inherited by the fork.
+            title (str, optional): The title of the fork. Defaults to the parent title.
+
+        Returns:
+            Discussion: The new discussion
+        """
+        parent = Discussion(self.lollms, discussion_id, self)
+        if parent.get_message(message_id) is None:
+            raise ValueError(f"Message {message_id} is not part of the discussion {discussion_id}")
+        if title is None:
+            title = parent.title()
+        fork_id = self.insert(
+            "INSERT INTO discussion (title, metadata, parent_discussion_id, fork_message_id) SELECT ?, metadata, id, ? FROM discussion WHERE id=?",
+            (title, int(message_id), discussion_id)
+        )
+        return Discussion(self.lollms, fork_id, self)
+
+    def get_forks_referencing(self, discussion_id:int, message_id:int=None)->List[int]:
+        """
+        Returns the forks (direct or nested) of a discussion whose inherited messages include
+        message_id, or any message of the discussion if message_id is None.
+        """
+        forks = self.select("""
+            WITH RECURSIVE forks(id) AS (
+                SELECT id FROM discussion WHERE parent_discussion_id = ?
+                UNION
+                SELECT d.id FROM discussion d JOIN forks f ON d.parent_discussion_id = f.id
+            )
+            SELECT d.id, d.fork_message_id FROM discussion d JOIN forks f ON d.id = f.id WHERE d.fork_message_id IS NOT NULL
+        """, (discussion_id,))
+        referencing = []
+        for fork_id, fork_message_id in forks:
+            if message_id is None:
+                row = self.select(self.FORK_CHAIN_CTE+"SELECT 1 FROM message WHERE id IN (SELECT id FROM chain) AND discussion_id = ? LIMIT 1", (fork_message_id, discussion_id), fetch_all=False)
+            else:
+                row = self.select(self.FORK_CHAIN_CTE+"SELECT 1 FROM chain WHERE id = ? LIMIT 1", (fork_message_id, int(message_id)), fetch_all=False)
+            if row is not None:
+                referencing.append(fork_id)
+        return referencing
+
+    def detach_forks(self, discussion_id:int, message_id:int=None)->Dict[int, Dict[int, int]]:
+        """
+        Gives their own copy of the shared messages to the forks that inherit message_id
+        (or any message of the discussion), so that the discussion can be modified or deleted safely.
+
+        Returns:
+            dict: fork id -> {old message id: new message id} of the messages renumbered in that fork (see Discussion.materialize)
+        """
+        return {
+            fork_id: Discussion(self.lollms, fork_id, self).materialize()
+            for fork_id in self.get_forks_referencing(discussion_id, message_id)
+        }
+
+    def resolve_message_id(self, message_id)->int:
+        """Returns the current id of a message, following the renumbering of the forks (ids held by clients stay valid)"""
+        return self.write_buffer.resolve(int(message_id))
+
+    def _apply_renumbering(self, discussion_ids:set, materialized_id:int, mapping:Dict[int, int]):
+        """Updates the messages loaded by the live Discussion objects of the given discussions after a renumbering"""
+        for discussion in list(self._live_discussions):
+            if discussion.discussion_id in discussion_ids:
+                discussion._renumber(materialized_id, mapping)
+
     def get_discussions(self):
-        rows = self.select("SELECT * FROM discussion")         
-        return [{"id": row[0], "title": row[1]} for row in rows]
+        rows = self.select("SELECT id, title, message_count, last_message_at FROM discussion")
+        return [{"id": row[0], "title": row[1], "message_count": row[2], "last_message_at": row[3]} for row in rows]
+
+    DISCUSSIONS_SORT_FIELDS = {
+        "id": "d.id",
+        "title": "d.title",
+        "created_at": "d.created_at",
+        "last_message_at": "COALESCE(d.last_message_at, d.created_at)",
+        "message_count": "d.message_count",
+    }
+
+    def list_discussions(
+                            self,
+                            sort_by:str="last_message_at",
+                            ascending:bool=False,
+                            limit:int=50,
+                            offset:int=0,
+                            title:str=None,
+                            min_messages:int=None,
+                            max_messages:int=None,
+                            active_after:str=None,
+                            active_before:str=None,
+                            preview_length:int=120
+                        )->Dict[str, Any]:
+        """
+        Lists the discussions with their message count, last activity and a preview of their last message.
+        Everything comes from one query over the discussions table: the counts are maintained by triggers
+        and the preview is read through the (discussion_id, id) index for the returned page only.
+
+        Args:
+            sort_by (str): id, title, created_at, last_message_at (the creation date for empty discussions) or message_count.
+            ascending (bool): Sort order, newest/biggest first by default.
+            limit (int), offset (int): The page.
+            title (str, optional): Only the discussions whose title contains this text.
+            min_messages (int, optional), max_messages (int, optional): Bounds on the number of messages.
+            active_after (str, optional), active_before (str, optional): Bounds on the last activity ('%Y-%m-%d %H:%M:%S').
+            preview_length (int): Number of characters of the last message to return (0 for no preview).
+
+        Returns:
+            dict: {"discussions": [{"id", "title", "created_at", "message_count", "last_message_at", "preview", "archived"}], "total": number of matching discussions}
+        """
+        if sort_by not in self.DISCUSSIONS_SORT_FIELDS:
+            raise ValueError(f"Unsupported sort field {sort_by}, use one of {list(self.DISCUSSIONS_SORT_FIELDS.keys())}")
+        conditions = []
+        params = []
+        if title:
+            conditions.append("d.title LIKE ? ESCAPE '\\'")
+            params.append("%"+title.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")+"%")
+        if min_messages is not None:
+            conditions.append("d.message_count >= ?")
+            params.append(min_messages)
+        if max_messages is not None:
+            conditions.append("d.message_count <= ?")
+            params.append(max_messages)
+        if active_after is not None:
+            conditions.append("COALESCE(d.last_message_at, d.created_at) >= ?")
+            params.append(active_after)
+        if active_before is not None:
+            conditions.append("COALESCE(d.last_message_at, d.created_at) < ?")
+            params.append(active_before)
+        where = (" WHERE "+" AND ".join(conditions)) if len(conditions)>0 else ""
+        order = f"{self.DISCUSSIONS_SORT_FIELDS[sort_by]} {'ASC' if ascending else 'DESC'}, d.id {'ASC' if ascending else 'DESC'}"
+        rows = self.select(f"""
+            SELECT d.id, d.title, d.created_at, d.message_count, d.last_message_at,
+                   (SELECT substr(m.content, 1, ?) FROM message m WHERE m.discussion_id = d.id ORDER BY m.id DESC LIMIT 1),
+                   COUNT(*) OVER ()
+            FROM discussion d{where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        """, tuple([max(0, int(preview_length))]+params+[max(1, int(limit)), max(0, int(offset))]))
+        archived_ids = self.archive.archived_ids
+        return {
+            "discussions": [
+                {
+                    "id": row[0], "title": row[1], "created_at": row[2], "message_count": row[3] or 0,
+                    "last_message_at": row[4], "preview": row[5] if preview_length>0 else None, "archived": row[0] in archived_ids
+                }
+                for row in rows
+            ],
+            "total": rows[0][6] if len(rows)>0 else self.select(f"SELECT COUNT(*) FROM discussion d{where}", tuple(params), fetch_all=False)[0]
+        }
+
+    def get_discussions_page(self, limit:int=50, before_id:int=None):
+        """
+        Returns a page of discussions, newest first, using keyset pagination.
+
+        Args:
+            limit (int): The maximum number of discussions to return.
+            before_id (int, optional): Only discussions with an id lower than this one are returned.
+                Use the next_cursor of the previous page to get the next one.
+
+        Returns:
+            dict: {"discussions": [{"id", "title", "created_at"}...], "next_cursor": id or None when this is the last page}
+        """
+        limit = max(1, int(limit))
+        if before_id is None:
+            rows = self.select("SELECT id, title, created_at FROM discussion ORDER BY id DESC LIMIT ?", (limit+1,))
+        else:
+            rows = self.select("SELECT id, title, created_at FROM discussion WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit+1))
+        has_more = len(rows)>limit
+        rows = rows[:limit]
+        return {
+            "discussions": [{"id": row[0], "title": row[1], "created_at": row[2]} for row in rows],
+            "next_cursor": rows[-1][0] if has_more else None
+        }
 
     def does_last_discussion_have_messages(self):
         last_discussion_id = self.select("SELECT id FROM discussion ORDER BY id DESC LIMIT 1", fetch_all=False)
@@ -257,10 +725,410 @@ class DiscussionsDB:
         last_message = self.select("SELECT * FROM message WHERE discussion_id=?", (last_discussion_id,), fetch_all=False)
         return last_message is not None
     
+    def change_message_rank(self, message_id:int, delta:int)->Optional[int]:
+        """
+        Adds delta to the rank of a message in a single atomic statement, so concurrent votes are never lost.
+
+        Returns:
+            int: The new rank, None if the message doesn't exist
+        """
+        with self.pool.connection() as conn:
+            if SQLITE_HAS_RETURNING:
+                row = conn.execute("UPDATE message SET rank = COALESCE(rank, 0) + ? WHERE id = ? RETURNING rank", (int(delta), message_id)).fetchone()
+            else:
+                # The read happens in the write transaction, no other writer can slip in between
+                cursor = conn.execute("UPDATE message SET rank = COALESCE(rank, 0) + ? WHERE id = ?", (int(delta), message_id))
+                row = conn.execute("SELECT rank FROM message WHERE id = ?", (message_id,)).fetchone() if cursor.rowcount>0 else None
+        return row[0] if row is not None else None
+
+    def rate_messages(self, ratings:List[Tuple[int, int]], relative:bool=True)->int:
+        """
+        Applies many ratings in one transaction (used to import feedback).
+
+        Args:
+            ratings (list): (message_id, value) pairs. The same message can appear several times.
+            relative (bool): If True the values are added to the ranks (votes), otherwise they replace them.
+
+        Returns:
+            int: The number of applied ratings (ratings of missing messages are ignored)
+        """
+        if relative:
+            query = "UPDATE message SET rank = COALESCE(rank, 0) + ? WHERE id = ?"
+        else:
+            query = "UPDATE message SET rank = ? WHERE id = ?"
+        params = [(int(value), int(message_id)) for message_id, value in ratings]
+        if len(params)==0:
+            return 0
+        with self.pool.connection() as conn:
+            return conn.executemany(query, params).rowcount
+
+    def delete_discussions(self, discussion_ids:List[int], remove_folders:bool=True)->Dict[str, Any]:
+        """
+        Deletes several discussions and their messages in a single transaction.
+        Forks that are not deleted get their own copy of the shared messages first.
+        The folders are removed in the background, see get_folders_removal_progress.
+
+        Args:
+            discussion_ids (List[int]): The discussions to delete.
+            remove_folders (bool): Queue the discussion folders for removal.
+
+        Returns:
+            dict: {"deleted": number of deleted discussions, "messages": number of deleted messages, "folders": number of queued folders}
+        """
+        ids = sorted({int(discussion_id) for discussion_id in discussion_ids})
+        if len(ids)==0:
+            return {"deleted": 0, "messages": 0, "folders": 0}
+        deleted_ids = set(ids)
+        for discussion_id in ids:
+            for fork_id in self.get_forks_referencing(discussion_id):
+                if fork_id not in deleted_ids:
+                    Discussion(self.lollms, fork_id, self).materialize()
+        if self.write_buffer.has_pending():
+            self.write_buffer.flush()
+        params = [(discussion_id,) for discussion_id in ids]
+        with self.pool.connection() as conn:
+            nb_messages = conn.executemany("DELETE FROM message WHERE discussion_id=?", params).rowcount
+            nb_deleted = conn.executemany("DELETE FROM discussion WHERE id=?", params).rowcount
+        for discussion_id in ids:
+            if self.archive.is_archived(discussion_id):
+                self.archive.remove(discussion_id)
+        folders = [self.discussion_db_path/f"{discussion_id}" for discussion_id in ids] if remove_folders else []
+        folders = [folder for folder in folders if folder.exists()]
+        self.folder_remover.remove(folders)
+        return {"deleted": nb_deleted, "messages": nb_messages, "folders": len(folders)}
+
+    def get_folders_removal_progress(self)->Dict[str, Any]:
+        """Progress of the background removal of the deleted discussions folders"""
+        return self.folder_remover.get_progress()
+
     def remove_discussions(self):
         self.delete("DELETE FROM message")
         self.delete("DELETE FROM discussion")
+        for discussion_id in list(self.archive.archived_ids):
+            self.archive.remove(discussion_id)
+
+    # ----------------------------- Cold storage -----------------------------
+    def get_idle_discussions(self, max_idle_days:float, exclude_ids:list=None)->List[Dict[str, Any]]:
+        """
+        Returns the discussions (not archived yet) whose last activity is older than max_idle_days.
+        The last activity is the most recent message date (maintained in last_message_at), or the creation date of an empty discussion.
+        Discussions that have forks are kept since the forks read their messages.
+        """
+        limit = (datetime.now()-timedelta(days=max_idle_days)).strftime('%Y-%m-%d %H:%M:%S')
+        rows = self.select("""
+            SELECT d.id, d.title, d.created_at, COALESCE(d.last_message_at, d.created_at) AS last_activity_at
+            FROM discussion d
+            WHERE last_activity_at < ?
+              AND d.id NOT IN (SELECT parent_discussion_id FROM discussion WHERE parent_discussion_id IS NOT NULL)
+            ORDER BY d.id
+        """, (limit,))
+        excluded = set(exclude_ids or []) | self.archive.archived_ids
+        return [
+            {"id": row[0], "title": row[1], "created_at": row[2], "last_activity_at": row[3]}
+            for row in rows if row[0] not in excluded
+        ]
+
+    def opened_discussion_ids(self)->set:
+        """Ids of the discussions that have a Discussion object alive on this database"""
+        return {discussion.discussion_id for discussion in list(self._live_discussions)}
+
+    @staticmethod
+    def _read_messages(conn, discussion_id:int)->List[Dict[str, Any]]:
+        cursor = conn.execute("SELECT * FROM message WHERE discussion_id=? ORDER BY id", (discussion_id,))
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def archive_discussion(self, discussion:Dict[str, Any])->Optional[Dict[str, int]]:
+        """
+        Moves the messages and the folder of a discussion to the cold storage.
+        The discussion row stays in the database so that it is still listed.
+        The archive is written from a snapshot of the messages, then the messages are checked again and deleted
+        in one immediate transaction: if the discussion changed in between (new or updated messages) nothing is deleted
+        and the archive is dropped. The folder is only removed once the transaction is committed.
+
+        Args:
+            discussion (dict): id, title, created_at and last_activity_at of the discussion (as returned by get_idle_discussions).
+
+        Returns:
+            dict: original_size and archived_size in bytes, None if the discussion is opened or changed and was not archived
+        """
+        discussion_id = discussion["id"]
+        with self._archive_lock:
+            if discussion_id in self.opened_discussion_ids() or self.archive.is_archived(discussion_id):
+                return None
+            if self.write_buffer.has_pending():
+                self.write_buffer.flush()
+            with self.pool.connection() as conn:
+                messages = self._read_messages(conn, discussion_id)
+                tokens_counts = conn.execute(
+                    "SELECT t.message_id, t.tokenizer, t.nb_tokens FROM message_tokens t JOIN message m ON m.id = t.message_id WHERE m.discussion_id=?",
+                    (discussion_id,)
+                ).fetchall()
+            folder = self.discussion_db_path/f"{discussion_id}"
+            sizes = self.archive.store(discussion, messages, tokens_counts, folder)
+            try:
+                with self.pool.connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    last_activity_at = conn.execute("SELECT COALESCE(last_message_at, created_at) FROM discussion WHERE id=?", (discussion_id,)).fetchone()
+                    unchanged = (
+                        last_activity_at is not None and last_activity_at[0]==discussion["last_activity_at"]
+                        and self._read_messages(conn, discussion_id)==messages and discussion_id not in self.opened_discussion_ids()
+                    )
+                    if unchanged:
+                        # The archive is safely written, the hot copy of the archived messages can go
+                        ids = [message["id"] for message in messages]
+                        for start in range(0, len(ids), 500):
+                            chunk = ids[start:start+500]
+                            conn.execute(f"DELETE FROM message WHERE id IN ({','.join('?'*len(chunk))})", chunk)
+                        # The listing keeps showing the archived messages statistics
+                        conn.execute(
+                            "UPDATE discussion SET message_count=?, last_message_at=? WHERE id=?",
+                            (len(messages), max((m.get("created_at") for m in messages if m.get("created_at")), default=None), discussion_id)
+                        )
+            except Exception:
+                self.archive.remove(discussion_id)
+                raise
+            if not unchanged:
+                self.archive.remove(discussion_id)
+                ASCIIColors.info(f"Discussion {discussion_id} changed while being archived, it is kept")
+                return None
+        if folder.exists():
+            shutil.rmtree(folder)
+        return sizes
+
+    def archive_idle_discussions(self, max_idle_days:float, exclude_ids:list=None)->Dict[str, Any]:
+        """
+        Archives every discussion that has been idle for more than max_idle_days.
 
+        Args:
+            max_idle_days (float): The idle age after which a discussion is archived.
+            exclude_ids (list, optional): Discussions to keep (for example the ones opened by connected clients).
+                The discussions opened on this database (see opened_discussion_ids) are always kept.
+
+        Returns:
+            dict: {"archived", "discussion_ids", "reclaimed_bytes", "archived_bytes", "db_size_before", "db_size_after"}
+                reclaimed_bytes is the size of the data moved out of the hot storage, archived_bytes its compressed size.
+                The database file itself only shrinks once its free pages are vacuumed.
+        """
+        db_size_before = self.discussion_db_file_path.stat().st_size if self.discussion_db_file_path.exists() else 0
+        archived_ids = []
+        reclaimed_bytes = 0
+        archived_bytes = 0
+        for discussion in self.get_idle_discussions(max_idle_days, exclude_ids):
+            try:
+                sizes = self.archive_discussion(discussion)
+                if sizes is None:
+                    continue
+                archived_ids.append(discussion["id"])
+                reclaimed_bytes += sizes["original_size"]
+                archived_bytes += sizes["archived_size"]
+            except Exception as ex:
+                trace_exception(ex)
+                ASCIIColors.error(f"Couldn't archive discussion {discussion['id']}")
+        db_size_after = self.discussion_db_file_path.stat().st_size if self.discussion_db_file_path.exists() else 0
+        if len(archived_ids)>0:
+            ASCIIColors.success(f"Archived {len(archived_ids)} idle discussions, {reclaimed_bytes/1e6:.2f}MB moved to {archived_bytes/1e6:.2f}MB of cold storage")
+        return {
+            "archived": len(archived_ids),
+            "discussion_ids": archived_ids,
+            "reclaimed_bytes": reclaimed_bytes,
+            "archived_bytes": archived_bytes,
+            "db_size_before": db_size_before,
+            "db_size_after": db_size_after
+        }
+
+    def is_archived(self, discussion_id:int)->bool:
+        return self.archive.is_archived(discussion_id)
+
+    def restore_discussion(self, discussion_id:int)->bool:
+        """
+        Brings an archived discussion back to the hot storage with its original message ids.
+        Returns False if the discussion was not archived.
+        """
+        with self._archive_lock:
+            if not self.archive.is_archived(discussion_id):
+                return False
+            archived = self.archive.load(discussion_id)
+            if archived is None:
+                self.archive.archived_ids.discard(discussion_id)
+                return False
+            messages, tokens_counts = archived
+            with self.pool.connection() as conn:
+                existing_columns = {column[1] for column in conn.execute("PRAGMA table_info(message)")}
+                if len(messages)>0:
+                    columns = [c for c in messages[0].keys() if c in existing_columns]
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO message ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))})",
+                        [tuple(message.get(c) for c in columns) for message in messages]
+                    )
+                conn.executemany("INSERT OR REPLACE INTO message_tokens (message_id, tokenizer, nb_tokens) VALUES (?, ?, ?)", tokens_counts)
+                self.refresh_discussion_stats([discussion_id], conn.cursor())
+            self.archive.unpack_bundle(discussion_id, self.discussion_db_path/f"{discussion_id}")
+            # The bundle holds plain copies, share them again with the other discussions
+            self.media_store.store_folder(self.discussion_db_path/f"{discussion_id}")
+            self.archive.remove(discussion_id)
+        ASCIIColors.info(f"Restored discussion {discussion_id} from the archive")
+        return True
+
+    def get_archived_discussions(self)->List[Dict[str, Any]]:
+        """Returns the metadata of the archived discussions"""
+        return self.archive.list_archived()
+
+
+    # The message fields exported (and accepted back by import_from_json)
+    EXPORT_MESSAGE_FIELDS = ["sender", "content", "message_type", "rank", "parent_message_id", "binding", "model", "personality", "created_at", "started_generating_at", "finished_generating_at", "nb_tokens"]
+
+    def _iter_export_rows(self, discussion_ids:list=None, batch_size:int=500):
+        """
+        Iterates over all the messages of the selected discussions (all of them by default)
+        with a single ordered JOIN query. Each row is (discussion id, title, message id, *EXPORT_MESSAGE_FIELDS),
+        the message part being None for a discussion without messages.
+        The messages of archived discussions are read from the cold storage, one discussion at a time.
+        Rows are fetched by batches on a dedicated connection, so memory use does not depend on the database size.
+        """
+        fields = ", ".join(f"m.{field}" for field in self.EXPORT_MESSAGE_FIELDS)
+        query = f"SELECT d.id, d.title, m.id, {fields} FROM discussion d LEFT JOIN message m ON m.discussion_id = d.id"
+        params = ()
+        if discussion_ids is not None:
+            params = tuple(discussion_ids)
+            query += f" WHERE d.id IN ({','.join(['?'] * len(params))})"
+        query += " ORDER BY d.id, m.id"
+
+        if self.write_buffer.has_pending():
+            self.write_buffer.flush()
+        conn = self.pool.open_connection()
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows)==0:
+                    break
+                for row in rows:
+                    if row[2] is None and self.archive.is_archived(row[0]):
+                        yield from self._iter_archived_export_rows(row[0], row[1])
+                    else:
+                        yield row
+        finally:
+            conn.close()
+
+    def _iter_archived_export_rows(self, discussion_id:int, title:str):
+        archived = self.archive.load(discussion_id)
+        messages = sorted(archived[0], key=lambda message: message["id"]) if archived is not None else []
+        if len(messages)==0:
+            yield (discussion_id, title, None)+(None,)*len(self.EXPORT_MESSAGE_FIELDS)
+            return
+        for message in messages:
+            yield (discussion_id, title, message["id"])+tuple(message.get(field) for field in self.EXPORT_MESSAGE_FIELDS)
+
+    def _count_discussions(self, discussion_ids:list=None):
+        if discussion_ids is None:
+            return self.select("SELECT COUNT(*) FROM discussion", fetch_all=False)[0]
+        discussions_ids_tuple = tuple(discussion_ids)
+        return self.select(f"SELECT COUNT(*) FROM discussion WHERE id IN ({','.join(['?'] * len(discussions_ids_tuple))})", discussions_ids_tuple, fetch_all=False)[0]
+
+    def iter_discussions(self, discussion_ids:list=None):
+        """
+        Yields the selected discussions (all of them by default) one at a time
+        as {"id", "title", "messages"} dictionaries, using a single query.
+        """
+        discussion = None
+        for row in self._iter_export_rows(discussion_ids):
+            if discussion is None or discussion["id"]!=row[0]:
+                if discussion is not None:
+                    yield discussion
+                discussion = {"id": row[0], "title":row[1], "messages": []}
+            if row[2] is not None:
+                discussion["messages"].append({field:row[3+i] for i, field in enumerate(self.EXPORT_MESSAGE_FIELDS)})
+        if discussion is not None:
+            yield discussion
+
+    def export_stream(self, export_format:str="ndjson", discussion_ids:list=None, title:str="", progress_callback=None, chunk_size:int=65536):
+        """
+        Streams an export of the selected discussions (all of them by default).
+
+        Args:
+            export_format (str): "ndjson" (one discussion per line), "json" (a json array) or "markdown".
+            discussion_ids (list, optional): The discussions to export.
+            title (str, optional): Title of the markdown document.
+            progress_callback (callable, optional): Called with (exported discussions, total discussions) after each discussion.
+            chunk_size (int): The text is yielded by chunks of about this many characters.
+
+        Yields:
+            str: Pieces of the export. Memory use is bounded by one message (one discussion for ndjson).
+        """
+        if export_format not in ["ndjson", "json", "markdown"]:
+            raise ValueError(f"Unsupported export format {export_format}")
+        total = self._count_discussions(discussion_ids) if progress_callback is not None else 0
+        done = 0
+        parts = []
+        size = 0
+
+        if export_format=="ndjson":
+            for discussion in self.iter_discussions(discussion_ids):
+                line = json.dumps(discussion)+"\n"
+                parts.append(line)
+                size += len(line)
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, total)
+                if size>=chunk_size:
+                    yield "".join(parts)
+                    parts, size = [], 0
+            if len(parts)>0:
+                yield "".join(parts)
+            return
+
+        current_id = None
+        first_message = True
+        if export_format=="json":
+            parts.append("[")
+        elif title!="":
+            parts.append(f"# {title}\n\n")
+        for row in self._iter_export_rows(discussion_ids):
+            if row[0]!=current_id:
+                if current_id is not None:
+                    parts.append("]}" if export_format=="json" else "\n")
+                    done += 1
+                    if progress_callback is not None:
+                        progress_callback(done, total)
+                if export_format=="json":
+                    parts.append(("," if current_id is not None else "") + f'{{"id": {row[0]}, "title": {json.dumps(row[1])}, "messages": [')
+                else:
+                    parts.append(f"## {row[1]}\n")
+                current_id = row[0]
+                first_message = True
+            if row[2] is not None:
+                if export_format=="json":
+                    parts.append(("" if first_message else ", ") + json.dumps({field:row[3+i] for i, field in enumerate(self.EXPORT_MESSAGE_FIELDS)}))
+                else:
+                    parts.append(f"### {row[3]}:\n{row[4]}\n")
+                first_message = False
+            size += len(parts[-1])
+            if size>=chunk_size:
+                yield "".join(parts)
+                parts, size = [], 0
+        if current_id is not None:
+            parts.append("]}" if export_format=="json" else "\n")
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+        if export_format=="json":
+            parts.append("]")
+        yield "".join(parts)
+
+    def export_to_file(self, file_path, export_format:str="ndjson", discussion_ids:list=None, title:str="", progress_callback=None):
+        """
+        Writes a streamed export of the discussions to a file.
+
+        Returns:
+            int: The number of characters written.
+        """
+        written = 0
+        with open(file_path, "w", encoding="utf-8") as f:
+            for chunk in self.export_stream(export_format, discussion_ids, title, progress_callback):
+                f.write(chunk)
+                written += len(chunk)
+        return written
 
     def export_to_json(self):
         """
@@ -273,34 +1141,7 @@ class DiscussionsDB:
                 parent message ID, binding, model, personality, created at, and finished
                 generating at fields.
         """        
-        db_discussions = self.select("SELECT * FROM discussion")
-        discussions = []
-        for row in db_discussions:
-            discussion_id = row[0]
-            discussion_title = row[1]
-            discussion = {"id": discussion_id, "title":discussion_title, "messages": []}
-
-            rows = self.select(f"SELECT sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens FROM message WHERE discussion_id=?",(discussion_id,))
-            for message_row in rows:
-                sender = message_row[0]
-                content = message_row[1]
-                content_type = message_row[2]
-                rank = message_row[3]
-                parent_message_id = message_row[4]
-                binding = message_row[5]
-                model = message_row[6]
-                personality = message_row[7]
-                created_at = message_row[8]
-                started_generating_at = message_row[9]
-                finished_generating_at = message_row[10]
-                nb_tokens =  message_row[11]
-
-                discussion["messages"].append(
-                    {"sender": sender, "content": content, "message_type": content_type, "rank": rank, "parent_message_id": parent_message_id, "binding": binding, "model":model, "personality":personality, "created_at":created_at, "started_generating_at":started_generating_at, "finished_generating_at":finished_generating_at, "nb_tokens":nb_tokens}
-                )
-            discussions.append(discussion)
-
-        return discussions
+        return list(self.iter_discussions())
 
     def export_all_as_markdown_list_for_vectorization(self):
         """
@@ -311,21 +1152,10 @@ class DiscussionsDB:
                 Each inner list contains the discussion title and a string representing all
                 messages in the discussion in a Markdown format.
         """        
-        data = self.export_all_discussions_to_json()
-        # Initialize an empty result string
         discussions = []
-        # Iterate through discussions in the JSON data
-        for discussion in data:
-            # Extract the title
-            title = discussion['title']
-            messages = ""
-            # Iterate through messages in the discussion
-            for message in discussion['messages']:
-                sender = message['sender']
-                content = message['content']
-                # Append the sender and content in a Markdown format
-                messages += f'{sender}: {content}\n'
-            discussions.append([title, messages])
+        for discussion in self.iter_discussions():
+            messages = "".join(f"{message['sender']}: {message['content']}\n" for message in discussion["messages"])
+            discussions.append([discussion["title"], messages])
         return discussions
         
     def export_all_as_markdown(self):
@@ -337,165 +1167,269 @@ class DiscussionsDB:
                 Each discussion is represented as a Markdown heading, and each message is
                 represented with the sender and content in a Markdown format.
         """        
-        data = self.export_all_discussions_to_json()
-
-        # Initialize an empty result string
-        result = ''
-
-        # Iterate through discussions in the JSON data
-        for discussion in data:
-            # Extract the title
-            title = discussion['title']
-            # Append the title with '#' as Markdown heading
-            result += f'#{title}\n'
-
-            # Iterate through messages in the discussion
-            for message in discussion['messages']:
-                sender = message['sender']
-                content = message['content']
+        result = []
+        current_id = None
+        for row in self._iter_export_rows():
+            if row[0]!=current_id:
+                current_id = row[0]
+                # Append the title with '#' as Markdown heading
+                result.append(f"#{row[1]}\n")
+            if row[2] is not None:
                 # Append the sender and content in a Markdown format
-                result += f'{sender}: {content}\n'
-
-        return result
+                result.append(f"{row[3]}: {row[4]}\n")
+        return "".join(result)
 
     def export_all_discussions_to_json(self):
-        # Convert the list of discussion IDs to a tuple
-        db_discussions = self.select(
-            f"SELECT * FROM discussion"
-        )
-        discussions = []
-        for row in db_discussions:
-            discussion_id = row[0]
-            discussion_title = row[1]
-            discussion = {"id": discussion_id, "title":discussion_title, "messages": []}
-
-            rows = self.select(f"SELECT sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens FROM message WHERE discussion_id=?",(discussion_id,))
-            for message_row in rows:
-                sender = message_row[0]
-                content = message_row[1]
-                content_type = message_row[2]
-                rank = message_row[3]
-                parent_message_id = message_row[4]
-                binding = message_row[5]
-                model = message_row[6]
-                personality = message_row[7]
-                created_at = message_row[8]
-                started_generating_at = message_row[9]
-                finished_generating_at = message_row[10]
-                nb_tokens = message_row[11]
-                discussion["messages"].append(
-                    {"sender": sender, "content": content, "message_type": content_type, "rank": rank, "parent_message_id": parent_message_id, "binding": binding, "model":model, "personality":personality, "created_at":created_at, "started_generating_at":started_generating_at, "finished_generating_at": finished_generating_at,"nb_tokens":nb_tokens}
-                )
-            discussions.append(discussion)
-        return discussions
+        return list(self.iter_discussions())
 
     def export_discussions_to_json(self, discussions_ids:list):
-        # Convert the list of discussion IDs to a tuple
-        discussions_ids_tuple = tuple(discussions_ids)
-        txt = ','.join(['?'] * len(discussions_ids_tuple))
-        db_discussions = self.select(
-            f"SELECT * FROM discussion WHERE id IN ({txt})",
-            discussions_ids_tuple
-        )
-        discussions = []
-        for row in db_discussions:
-            discussion_id = row[0]
-            discussion_title = row[1]
-            discussion = {"id": discussion_id, "title":discussion_title, "messages": []}
-            rows = self.select(f"SELECT sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens FROM message WHERE discussion_id=?",(discussion_id,))
-            for message_row in rows:
-                sender = message_row[0]
-                content = message_row[1]
-                content_type = message_row[2]
-                rank = message_row[3]
-                parent_message_id = message_row[4]
-                binding = message_row[5]
-                model = message_row[6]
-                personality = message_row[7]
-                created_at = message_row[8]
-                started_generating_at = message_row[9]
-                finished_generating_at = message_row[9]
-                nb_tokens = message_row[9]
-                
-                discussion["messages"].append(
-                    {"sender": sender, "content": content, "message_type": content_type, "rank": rank, "parent_message_id": parent_message_id, "binding": binding, "model":model, "personality":personality, "created_at":created_at, "started_generating_at":started_generating_at, "finished_generating_at": finished_generating_at, "nb_tokens":nb_tokens}
-                )
-            discussions.append(discussion)
-        return discussions
+        return list(self.iter_discussions(discussions_ids))
     
-    def import_from_json(self, json_data):
-        discussions = []
-        data = json_data
-        for discussion_data in data:
-            discussion_id = discussion_data.id
-            discussion_title = discussion_data.title
-            messages_data = discussion_data.messages
-            discussion = {"id": discussion_id, "title": discussion_title, "messages": []}
-
-            # Insert discussion into the database
-            discussion_id = self.insert("INSERT INTO discussion (title) VALUES (?)", (discussion_title,))
-
-            for message_data in messages_data:
-                sender = message_data.get("sender")
-                content = message_data.get("content")
-                content_type = message_data.get("message_type",message_data.get("type"))
-                rank = message_data.get("rank")
-                parent_message_id = message_data.get("parent_message_id")
-                binding = message_data.get("binding","")
-                model = message_data.get("model","")
-                personality = message_data.get("personality","")
-                created_at = message_data.get("created_at",datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-
-                started_generating_at = message_data.get("started_generating_at",datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                finished_generating_at = message_data.get("finished_generating_at",datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                nb_tokens = message_data.get("nb_tokens",datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                discussion["messages"].append(
-                    {"sender": sender, "content": content, "message_type": content_type, "rank": rank, "binding": binding, "model": model, "personality": personality, "created_at": created_at, "started_generating_at":started_generating_at, "finished_generating_at": finished_generating_at, "nb_tokens":nb_tokens}
-                )
+    # Secondary indexes and triggers that can be dropped during a large import and rebuilt afterwards
+    DEFERRABLE_INDEXES = ["idx_message_discussion_id", "idx_message_parent_message_id", "idx_message_discussion_created_at"]
+    FTS_TRIGGERS = ["message_fts_insert", "message_fts_delete", "message_fts_update"]
 
-                # Insert message into the database
-                self.insert("INSERT INTO message (sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                            (sender, content, content_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id))
+    @staticmethod
+    def _message_import_row(message_data:dict, discussion_id:int):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return (
+            message_data.get("sender"),
+            message_data.get("content", ""),
+            message_data.get("message_type",message_data.get("type")),
+            message_data.get("rank") or 0,
+            message_data.get("parent_message_id"),
+            message_data.get("binding",""),
+            message_data.get("model",""),
+            message_data.get("personality",""),
+            message_data.get("created_at",now),
+            message_data.get("started_generating_at",now),
+            message_data.get("finished_generating_at",now),
+            message_data.get("nb_tokens",0),
+            discussion_id
+        )
+
+    def _drop_deferrable_indexes(self, conn):
+        for index in self.DEFERRABLE_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        for trigger in self.FTS_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    def _restore_deferrable_indexes(self, conn):
+        cursor = conn.cursor()
+        self.create_indexes(cursor)
+        self.create_fts(cursor)
+        # The triggers were off during the import, reindex everything
+        try:
+            self.rebuild_fts(cursor)
+        except sqlite3.OperationalError as ex:
+            ASCIIColors.warning(f"Couldn't rebuild the full text index: {ex}")
+
+    def bulk_import(self, discussions, batch_size:int=100, defer_index_threshold:int=10000, progress_callback=None):
+        """
+        Imports discussions and their messages in batches.
+        Each batch of discussions is inserted in a single transaction (messages with executemany),
+        so a failing batch is rolled back entirely and the previous batches stay imported.
+        When more than defer_index_threshold messages are imported, the message indexes and the
+        full text search triggers are dropped during the import and rebuilt once at the end.
+
+        Args:
+            discussions (list): Discussions as objects or dictionaries with title and messages (list of message dictionaries).
+            batch_size (int): Number of discussions per transaction.
+            defer_index_threshold (int): Number of messages above which the index maintenance is deferred.
+            progress_callback (callable, optional): Called with (imported discussions, total discussions) after each batch.
+
+        Returns:
+            dict: {"discussions", "messages", "discussion_ids", "duration", "messages_per_second"}
+
+        Raises:
+            Exception: the error of the failed batch, after it has been rolled back.
+        """
+        def field(entry, name, default=None):
+            return entry.get(name, default) if isinstance(entry, dict) else getattr(entry, name, default)
+
+        discussions = list(discussions)
+        nb_messages = sum(len(field(discussion, "messages", []) or []) for discussion in discussions)
+        defer_indexes = nb_messages>=defer_index_threshold
+        message_query = "INSERT INTO message (sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+        start = time.perf_counter()
+        imported_ids = []
+        imported_messages = 0
+        if defer_indexes:
+            with self.pool.connection() as conn:
+                self._drop_deferrable_indexes(conn)
+        try:
+            for batch_start in range(0, len(discussions), batch_size):
+                batch = discussions[batch_start:batch_start+batch_size]
+                batch_ids = []
+                batch_messages = 0
+                with self.pool.connection() as conn:
+                    conn.execute("BEGIN")
+                    for discussion in batch:
+                        discussion_id = conn.execute("INSERT INTO discussion (title) VALUES (?)", (field(discussion, "title"),)).lastrowid
+                        messages = field(discussion, "messages", []) or []
+                        conn.executemany(message_query, [self._message_import_row(message_data, discussion_id) for message_data in messages])
+                        batch_ids.append(discussion_id)
+                        batch_messages += len(messages)
+                imported_ids += batch_ids
+                imported_messages += batch_messages
+                if progress_callback is not None:
+                    progress_callback(len(imported_ids), len(discussions))
+        finally:
+            if defer_indexes:
+                with self.pool.connection() as conn:
+                    self._restore_deferrable_indexes(conn)
+
+        duration = time.perf_counter() - start
+        return {
+            "discussions": len(imported_ids),
+            "messages": imported_messages,
+            "discussion_ids": imported_ids,
+            "duration": duration,
+            "messages_per_second": imported_messages/duration if duration>0 else 0
+        }
 
-            discussions.append(discussion)
+    def import_from_json(self, json_data):
+        discussions = []
+        for discussion_data in json_data:
+            messages = discussion_data.get("messages", []) if isinstance(discussion_data, dict) else discussion_data.messages
+            discussions.append({
+                "id": discussion_data.get("id") if isinstance(discussion_data, dict) else discussion_data.id,
+                "title": discussion_data.get("title") if isinstance(discussion_data, dict) else discussion_data.title,
+                "messages": messages
+            })
 
+        stats = self.bulk_import(discussions)
+        ASCIIColors.info(f"Imported {stats['discussions']} discussions and {stats['messages']} messages in {stats['duration']:.2f}s ({stats['messages_per_second']:.0f} messages/s)")
         return discussions
 
     def export_discussions_to_markdown(self, discussions_ids:list, title = ""):
-        # Convert the list of discussion IDs to a tuple
-        discussions_ids_tuple = tuple(discussions_ids)
-        txt = ','.join(['?'] * len(discussions_ids_tuple))
-        db_discussions = self.select(
-            f"SELECT * FROM discussion WHERE id IN ({txt})",
-            discussions_ids_tuple
-        )
-        discussions = f"# {title}" if title!="" else ""
-        for row in db_discussions:
-            discussion_id = row[0]
-            discussion_title = row[1]
-            discussions += f"## {discussion_title}\n"
-
-            rows = self.select(f"SELECT sender, content, message_type, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens FROM message WHERE discussion_id=?",(discussion_id,))
-            for message_row in rows:
-                sender = message_row[0]
-                content = message_row[1]
-                content_type = message_row[2]
-                rank = message_row[3]
-                parent_message_id = message_row[4]
-                binding = message_row[5]
-                model = message_row[6]
-                personality = message_row[7]
-                created_at = message_row[8]
-                started_generating_at = message_row[9]
-                finished_generating_at = message_row[10]
-                nb_tokens = message_row[11]
-
-                discussions +=f"### {sender}:\n{content}\n"
-            discussions +=f"\n"
-        return discussions
+        return "".join(self.export_stream("markdown", discussions_ids, title))
+
+
+class DiscussionsDBCache:
+    """
+    Keeps the DiscussionsDB objects of the most recently used databases, so that switching
+    between databases doesn't reopen them and check their schema every time.
+    At most max_size databases are kept (the least recently used one is closed when a new one comes in)
+    and the connections of the databases unused for idle_timeout seconds are closed by a background thread.
+    There is never more than one object per database file: an evicted database still held by someone
+    (a client, a discussion) is handed back instead of opening a second one with its own write buffer.
+    """
+    def __init__(self, max_size:int=8, idle_timeout:float=300):
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self._entries:OrderedDict = OrderedDict()
+        # Evicted databases that are still referenced elsewhere
+        self._evicted = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._janitor:threading.Thread = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_closed = 0
+
+    def add(self, db:DiscussionsDB):
+        """Adopts a database object created elsewhere (the one opened at startup) unless its database is already cached"""
+        key = str(db.discussion_db_path.resolve())
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = self._evicted.pop(key, db)
+                self._entries.move_to_end(key, last=False)
+
+    def get(self, lollms:LoLLMsCom, lollms_paths:LollmsPaths, discussion_db_name:str="default")->DiscussionsDB:
+        """Returns the database object for this name, creating it (and checking its schema) on first use"""
+        key = str((lollms_paths.personal_discussions_path/discussion_db_name).resolve())
+        evicted = []
+        with self._lock:
+            db = self._entries.get(key)
+            if db is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                db = self._evicted.pop(key, None)
+                if db is None:
+                    db = DiscussionsDB(lollms, lollms_paths, discussion_db_name)
+                self._entries[key] = db
+                while len(self._entries)>self.max_size:
+                    evicted_key, evicted_db = self._entries.popitem(last=False)
+                    self._evicted[evicted_key] = evicted_db
+                    evicted.append(evicted_db)
+                    self.evictions += 1
+        for old_db in evicted:
+            try:
+                # Objects still holding the database keep working, its connections reopen on demand.
+                # Connections in use by a running query are left to their thread.
+                old_db.flush()
+                old_db.close_if_idle(0)
+            except Exception as ex:
+                trace_exception(ex)
+        db.ensure_schema()
+        self._ensure_janitor()
+        return db
+
+    def _ensure_janitor(self):
+        if self.idle_timeout<=0:
+            return
+        if self._janitor is None or not self._janitor.is_alive():
+            self._janitor = threading.Thread(target=self._run_janitor, name="discussions_db_janitor", daemon=True)
+            self._janitor.start()
+
+    def _run_janitor(self):
+        while not self._stop.wait(max(1, self.idle_timeout/2)):
+            self.close_idle()
+
+    def close_idle(self)->int:
+        """Closes the connections of the databases that are idle, returns how many were closed"""
+        with self._lock:
+            dbs = list(self._entries.values())
+        closed = 0
+        for db in dbs:
+            try:
+                if db.close_if_idle(self.idle_timeout):
+                    closed += 1
+            except Exception as ex:
+                trace_exception(ex)
+        self.idle_closed += closed
+        return closed
+
+    def close_all(self):
+        """Closes and forgets every cached database"""
+        self._stop.set()
+        with self._lock:
+            dbs = list(self._entries.values())+list(self._evicted.values())
+            self._entries.clear()
+            self._evicted.clear()
+        for db in dbs:
+            db.close()
+        self._stop = threading.Event()
+
+    def get_stats(self)->Dict[str, Any]:
+        with self._lock:
+            names = [db.discussion_db_name for db in self._entries.values()]
+        return {
+            "databases": names,
+            "max_size": self.max_size,
+            "idle_timeout": self.idle_timeout,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle_closed": self.idle_closed
+        }
 
 
 class Message:
+    # Discussions can hold thousands of messages: no per instance __dict__, and the json columns
+    # (steps) are kept as loaded from the database until they are actually used
+    __slots__ = (
+        "discussion_id", "discussions_db", "sender", "sender_type", "content", "_steps", "_steps_raw",
+        "message_type", "rank", "parent_message_id", "binding", "model", "metadata", "ui", "personality",
+        "created_at", "started_generating_at", "finished_generating_at", "nb_tokens", "_tokens_counts",
+        "id", "message_id"
+    )
+
     def __init__(
                     self,
                     discussion_id,
@@ -504,7 +1438,7 @@ class Message:
                     sender_type,
                     sender,
                     content,
-                    steps:list              = [],
+                    steps:list              = None,
                     metadata                = None,
                     ui                      = None,
                     rank                    = 0,
@@ -522,14 +1456,10 @@ class Message:
         
         self.discussion_id      = discussion_id
         self.discussions_db     = discussions_db
-        self.self               = self
         self.sender             = sender
         self.sender_type        = sender_type
         self.content            = content
-        try:
-            self.steps          = steps if type(steps)==list else json.loads(steps)
-        except:
-            self.steps          = []
+        self.steps              = steps
         self.message_type       = message_type
         self.rank               = rank
         self.parent_message_id  = parent_message_id
@@ -542,16 +1472,67 @@ class Message:
         self.started_generating_at  = started_generating_at
         self.finished_generating_at = finished_generating_at
         self.nb_tokens              = nb_tokens
+        # tokenizer identity -> number of tokens of the content (created on first use)
+        self._tokens_counts:Dict[str, int] = None
+        self.message_id             = None
 
         if insert_into_db:
             self.id = self.discussions_db.insert(
                 "INSERT INTO message (sender,  message_type,  sender_type,  sender,  content, steps,  metadata, ui,  rank,  parent_message_id,  binding,  model,  personality,  created_at, started_generating_at,  finished_generating_at, nb_tokens,  discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                (sender, message_type, sender_type, sender, content, str(steps), metadata, ui, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id)
+                (sender, message_type, sender_type, sender, content, str(steps if steps is not None else []), metadata, ui, rank, parent_message_id, binding, model, personality, created_at, started_generating_at, finished_generating_at, nb_tokens, discussion_id)
             )
         else:
             self.id = id
 
 
+    @property
+    def steps(self)->list:
+        """The steps of the message, decoded from the database json on first access"""
+        if self._steps is None:
+            try:
+                self._steps = json.loads(self._steps_raw) if self._steps_raw else []
+            except:
+                self._steps = []
+            self._steps_raw = None
+        return self._steps
+
+    @steps.setter
+    def steps(self, value):
+        if type(value)==list:
+            self._steps = value
+            self._steps_raw = None
+        else:
+            self._steps = None
+            self._steps_raw = value
+
+    @property
+    def tokens_counts(self)->Dict[str, int]:
+        if self._tokens_counts is None:
+            self._tokens_counts = {}
+        return self._tokens_counts
+
+    @tokens_counts.setter
+    def tokens_counts(self, value:Dict[str, int]):
+        self._tokens_counts = value
+
+    @staticmethod
+    def from_row(discussions_db, row):
+        """Builds a message from a row selected with the columns of get_fields (in that order).
+        Used as a row factory: no intermediate dict and no __init__ logic to run.
+        """
+        message = Message.__new__(Message)
+        (
+            message.id, message.message_type, message.sender_type, message.sender, message.content,
+            message.metadata, message._steps_raw, message.ui, message.rank, message.parent_message_id,
+            message.binding, message.model, message.personality, message.created_at,
+            message.started_generating_at, message.finished_generating_at, message.nb_tokens, message.discussion_id
+        ) = row
+        message._steps = [] if message._steps_raw is None else None
+        message.discussions_db = discussions_db
+        message._tokens_counts = None
+        message.message_id = None
+        return message
+
     @staticmethod
     def get_fields():
         return [
@@ -578,17 +1559,10 @@ class Message:
     @staticmethod
     def from_db(discussions_db, message_id):
         columns = Message.get_fields()
-        rows = discussions_db.select(
+        rows = discussions_db.select_messages(
             f"SELECT {','.join(columns)} FROM message WHERE id=?", (message_id,)
         )
-        data_dict={
-            col:rows[0][i]
-            for i,col in enumerate(columns)
-        }
-        data_dict["discussions_db"]=discussions_db
-        return Message(
-            **data_dict
-        )
+        return rows[0]
 
     @staticmethod
     def from_dict(discussions_db,data_dict):
@@ -609,96 +1583,76 @@ class Message:
             (self.sender, self.content, self.metadata, self.ui, self.message_type, self.rank, self.parent_message_id, self.binding, self.model, self.personality, self.created_at, self.started_generating_at, self.finished_generating_at, nb_tokens, self.discussion_id)
         )
 
-    def update(self, new_content, new_metadata=None, new_ui=None, started_generating_at=None, nb_tokens=None, commit=True):
+    def update(self, new_content, new_metadata=None, new_ui=None, started_generating_at=None, nb_tokens=None, commit=False):
+        """Updates the message. The new state is kept in memory and written by the write-behind buffer
+        of the database. Use commit=True to write it immediately.
+        """
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET content = ?"
-        params = [new_content]
+        if new_content != self.content:
+            self.tokens_counts = {}
+        self.content = new_content
+        columns = {"content": new_content}
         if new_metadata is not None:
-            text+=", metadata = ?"
-            params.append(new_metadata if type(new_metadata)==str else json.dumps(new_metadata) if type(new_metadata)==dict else None)
+            columns["metadata"] = new_metadata if type(new_metadata)==str else json.dumps(new_metadata) if type(new_metadata)==dict else None
             self.metadata=new_metadata
         if new_ui is not None:
-            text+=", ui = ?"
-            params.append(new_ui)
+            columns["ui"] = new_ui
             self.ui=new_ui
 
         if started_generating_at is not None:
-            text+=", started_generating_at = ?"
-            params.append(started_generating_at)
+            columns["started_generating_at"] = started_generating_at
             self.started_generating_at=started_generating_at
 
         if nb_tokens is not None:
-            text+=", nb_tokens = ?"
-            params.append(nb_tokens)
+            columns["nb_tokens"] = nb_tokens
             self.nb_tokens=nb_tokens
 
+        columns["finished_generating_at"] = self.finished_generating_at
+        self.discussions_db.write_buffer.push(self.id, columns, commit)
 
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
-
-    def update_content(self, new_content, started_generating_at=None, nb_tokens=None, commit=True):
+    def update_content(self, new_content, started_generating_at=None, nb_tokens=None, commit=False):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET content = ?"
-        params = [new_content]
+        if new_content != self.content:
+            self.tokens_counts = {}
+        self.content = new_content
+        columns = {"content": new_content}
 
         if started_generating_at is not None:
-            text+=", started_generating_at = ?"
-            params.append(started_generating_at)
+            columns["started_generating_at"] = started_generating_at
             self.started_generating_at=started_generating_at
 
         if nb_tokens is not None:
-            text+=", nb_tokens = ?"
-            params.append(nb_tokens)
+            columns["nb_tokens"] = nb_tokens
             self.nb_tokens=nb_tokens
 
+        columns["finished_generating_at"] = self.finished_generating_at
+        self.discussions_db.write_buffer.push(self.id, columns, commit)
 
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )  
-
-    def update_steps(self, steps:list, step_type:str, status:bool):
+    def update_steps(self, steps:list, step_type:str, status:bool, commit=False):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET steps = ?"
         self.steps = steps
-        params = [json.dumps(self.steps)]
+        self.discussions_db.write_buffer.push(self.id, {"steps": json.dumps(self.steps)}, commit)
 
-        text +=" WHERE id = ?"
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
 
-
-    def update_metadata(self, new_metadata):
+    def update_metadata(self, new_metadata, commit=False):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET metadata = ?"
-        params = [None if new_metadata is None else new_metadata if type(new_metadata)==str else json.dumps(new_metadata)]
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
+        self.metadata = new_metadata
+        columns = {
+            "metadata": None if new_metadata is None else new_metadata if type(new_metadata)==str else json.dumps(new_metadata),
+            "finished_generating_at": self.finished_generating_at
+        }
+        self.discussions_db.write_buffer.push(self.id, columns, commit)
 
-    def update_ui(self, new_ui):
+    def update_ui(self, new_ui, commit=False):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        text = f"UPDATE message SET ui = ?"
-        params = [str(new_ui) if new_ui is not None else None]
-        text +=", finished_generating_at = ? WHERE id = ?"
-        params.append(self.finished_generating_at)
-        params.append(self.id)
-        self.discussions_db.update(
-            text, tuple(params)
-        )        
+        self.ui = new_ui
+        columns = {
+            "ui": str(new_ui) if new_ui is not None else None,
+            "finished_generating_at": self.finished_generating_at
+        }
+        self.discussions_db.write_buffer.push(self.id, columns, commit)
 
-    def add_step(self, step: str, step_type: str, status: bool, done: bool):
+    def add_step(self, step: str, step_type: str, status: bool, done: bool, commit=False):
         self.finished_generating_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         # Check if the step text already exists
@@ -719,13 +1673,48 @@ class Message:
                 "done": done
             })
 
-        # Prepare the SQL update statement
-        text = "UPDATE message SET steps = ? WHERE id = ?"
-        params = [json.dumps(self.steps), self.id]
-        
-        # Update the database
-        self.discussions_db.update(text, tuple(params))
+        # Update the database (through the write-behind buffer)
+        self.discussions_db.write_buffer.push(self.id, {"steps": json.dumps(self.steps)}, commit)
 
+    def close(self, model=None):
+        """Marks the end of the generation of this message and writes its pending updates to the database.
+        If a model (LLMBinding) is given, the number of tokens of the final content is stored for it.
+        """
+        self.discussions_db.write_buffer.flush(self.id)
+        if model is not None and self.id is not None:
+            try:
+                self.count_tokens(model)
+            except Exception as ex:
+                trace_exception(ex)
+
+    def get_tokens_count(self, tokenizer_id:str):
+        """Returns the stored number of tokens of the content for this tokenizer, or None if unknown
+        """
+        if tokenizer_id not in self.tokens_counts and self.id is not None:
+            row = self.discussions_db.select("SELECT nb_tokens FROM message_tokens WHERE message_id=? AND tokenizer=?", (self.id, tokenizer_id), fetch_all=False)
+            if row is not None:
+                self.tokens_counts[tokenizer_id] = row[0]
+        return self.tokens_counts.get(tokenizer_id)
+
+    def set_tokens_count(self, tokenizer_id:str, nb_tokens:int):
+        """Stores the number of tokens of the content for this tokenizer
+        """
+        self.tokens_counts[tokenizer_id] = nb_tokens
+        if self.id is not None:
+            self.discussions_db.write_buffer.flush(self.id)
+            self.discussions_db.update(
+                "INSERT OR REPLACE INTO message_tokens (message_id, tokenizer, nb_tokens) VALUES (?, ?, ?)", (self.id, tokenizer_id, nb_tokens)
+            )
+
+    def count_tokens(self, model)->int:
+        """Returns the number of tokens of the (stripped) content for this model, tokenizing it only if it is not stored yet
+        """
+        tokenizer_id = model.get_model_identity()
+        nb_tokens = self.get_tokens_count(tokenizer_id)
+        if nb_tokens is None:
+            nb_tokens = model.count_tokens(self.content.strip(), use_cache=False)
+            self.set_tokens_count(tokenizer_id, nb_tokens)
+        return nb_tokens
 
     def to_json(self):
         attributes = Message.get_fields()
@@ -747,74 +1736,330 @@ class Message:
 
 class Discussion:
     def __init__(self, lollms:LoLLMsCom, discussion_id:int, discussions_db:DiscussionsDB):
+        """Creates a discussion handle.
+        Construction is cheap: the folders are created on first write, the messages are loaded
+        when first needed and the vector store is opened only when RAG over the discussion files is used.
+        """
         self.lollms = lollms
-        self.current_message = None
         self.discussion_id = discussion_id
         self.discussions_db = discussions_db
-        self.discussion_folder = self.discussions_db.discussion_db_path/f"{discussion_id}"
-        self.discussion_audio_folder = self.discussion_folder / "audio"
-        self.discussion_images_folder = self.discussion_folder / "images"
-        self.discussion_text_folder = self.discussion_folder / "text_data"
-        self.discussion_skills_folder = self.discussion_folder / "skills"
-        self.discussion_rag_folder = self.discussion_folder / "rag"
-        self.discussion_view_images_folder = self.discussion_folder / "view_images"
-
-        self.discussion_folder.mkdir(exist_ok=True)
-        self.discussion_images_folder.mkdir(exist_ok=True)
-        self.discussion_text_folder.mkdir(exist_ok=True)
-        self.discussion_skills_folder.mkdir(exist_ok=True)
-        self.discussion_rag_folder.mkdir(exist_ok=True)
-        self.discussion_view_images_folder.mkdir(exist_ok=True)
-        self.messages = self.get_messages()
-        
-        if len(self.messages)>0:
-            self.current_message = self.messages[-1]
+        self._discussion_folder = self.discussions_db.discussion_db_path/f"{discussion_id}"
+        self._created_folders = set()
+
+        self._messages:List[Message] = None
+        self._messages_by_id:Dict[int, Message] = {}
+        self._message_positions:Dict[int, int] = {}
+        self._current_message:Message = None
+        self._current_message_loaded = False
+        # Materialized path (root -> leaf) of the last requested branch
+        self._active_branch:List[Message] = []
+        self._active_branch_positions:Dict[int, int] = {}
+
+        self._text_files = None
+        self._image_files = None
+        self._audio_files = None
+        self._rag_db = None
+
+        self._vectorizer:VectorDatabase = None
+        self._vectorizer_loaded = False
+
+        # Fork information, loaded on first use (-1 means not loaded)
+        self._fork_message_id = -1
+
+        # Registered before the restore, so that the discussion is not archived again while it is opened
+        self.discussions_db._live_discussions.add(self)
+        # Opening an archived discussion brings it back from the cold storage
+        if self.discussions_db.is_archived(discussion_id):
+            self.discussions_db.restore_discussion(discussion_id)
+
+    # ----------------------------- Folders (created on first use) -----------------------------
+    def _folder(self, name:str=None, create:bool=True)->Path:
+        folder = self._discussion_folder if name is None else self._discussion_folder/name
+        if create and name not in self._created_folders:
+            folder.mkdir(exist_ok=True, parents=True)
+            self._created_folders.add(name)
+        return folder
+
+    @property
+    def discussion_folder(self)->Path:
+        return self._folder()
+
+    @property
+    def discussion_audio_folder(self)->Path:
+        return self._folder("audio")
+
+    @property
+    def discussion_images_folder(self)->Path:
+        return self._folder("images")
+
+    @property
+    def discussion_text_folder(self)->Path:
+        return self._folder("text_data")
+
+    @property
+    def discussion_skills_folder(self)->Path:
+        return self._folder("skills")
+
+    @property
+    def discussion_rag_folder(self)->Path:
+        return self._folder("rag")
+
+    @property
+    def discussion_view_images_folder(self)->Path:
+        return self._folder("view_images")
+
+    # ----------------------------- Forks -----------------------------
+    @property
+    def fork_message_id(self)->int:
+        """The last message inherited from the parent discussion, or None if this discussion is not a fork"""
+        if self._fork_message_id == -1:
+            row = self.discussions_db.select("SELECT fork_message_id FROM discussion WHERE id=?", (self.discussion_id,), fetch_all=False)
+            self._fork_message_id = row[0] if row is not None else None
+        return self._fork_message_id
+
+    def is_fork(self)->bool:
+        return self.fork_message_id is not None
+
+    def _messages_source(self):
+        """Returns the (cte, condition, params) selecting the messages of this discussion, inherited ones included"""
+        if self.fork_message_id is None:
+            return "", "discussion_id=?", (self.discussion_id,)
+        return DiscussionsDB.FORK_CHAIN_CTE, "(discussion_id=? OR id IN (SELECT id FROM chain))", (self.fork_message_id, self.discussion_id)
+
+    def is_inherited(self, message_id)->bool:
+        """True if the message belongs to the parent discussion and is only shared with this fork"""
+        if self.fork_message_id is None:
+            return False
+        if self._messages is None:
+            self.get_messages()
+        message = self._messages_by_id.get(int(message_id))
+        return message is not None and message.discussion_id != self.discussion_id
 
-        # Initialize the file lists
-        self.update_file_lists()
-
-        if len(self.text_files)>0:
-            if self.lollms.config.rag_vectorizer=="semantic":
-                from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
-                vectorizer = SemanticVectorizer(self.lollms.config.rag_vectorizer_model)
-            elif self.lollms.config.rag_vectorizer=="tfidf":
-                from lollmsvectordb.lollms_vectorizers.tfidf_vectorizer import TFIDFVectorizer
-                vectorizer = TFIDFVectorizer()
-            elif self.lollms.config.rag_vectorizer=="openai":
-                from lollmsvectordb.lollms_vectorizers.openai_vectorizer import OpenAIVectorizer
-                vectorizer = OpenAIVectorizer(self.lollms.config.rag_vectorizer_model, self.lollms.config.rag_vectorizer_openai_key)
-
-            self.vectorizer = VectorDatabase(
-                                        self.discussion_rag_folder/"db.sqli",
-                                        vectorizer,
-                                        self.lollms.model,
-                                        chunk_size=self.lollms.config.rag_chunk_size,
-                                        overlap=self.lollms.config.rag_overlap
-                                        )
-            
-            if len(self.vectorizer.list_documents())==0 and len(self.text_files)>0:
-                for path in self.text_files:
-                    try:
-                        data = TextDocumentsLoader.read_file(path)
+    def materialize(self)->Dict[int, int]:
+        """
+        Copies the inherited messages into this discussion (copy-on-write) and detaches it from its parent.
+        Messages are ordered by id, so the own messages of the fork are renumbered after the copies
+        and the references to them (nested forks, replies) are updated.
+        The renumbering is followed everywhere in the process: the pending updates of the write buffer move
+        to the new ids, the messages loaded by the live Discussion objects of the fork and of its nested forks
+        are renumbered in place, and the old ids still resolve to the new ones (resolve_message_id, get_message).
+
+        Returns:
+            dict: old message id -> new message id
+        """
+        if self.fork_message_id is None:
+            return {}
+        cte, condition, params = self._messages_source()
+        nested_forks = {row[0] for row in self.discussions_db.select("""
+            WITH RECURSIVE forks(id) AS (
+                SELECT id FROM discussion WHERE parent_discussion_id = ?
+                UNION
+                SELECT d.id FROM discussion d JOIN forks f ON d.parent_discussion_id = f.id
+            )
+            SELECT id FROM forks
+        """, (self.discussion_id,))}
+        mapping = {}
+        write_buffer = self.discussions_db.write_buffer
+        # Nothing is written to the old ids while they are renumbered
+        with write_buffer.paused(), self.discussions_db.pool.connection() as conn:
+            cursor = conn.execute(f"{cte}SELECT * FROM message WHERE {condition} ORDER BY id", params)
+            all_columns = [c[0] for c in cursor.description]
+            columns = [c for c in all_columns if c!="id"]
+            rows = [dict(zip(all_columns, row)) for row in cursor.fetchall()]
+            own_ids = [row["id"] for row in rows if row["discussion_id"]==self.discussion_id]
+            for row in rows:
+                row["discussion_id"] = self.discussion_id
+                row["parent_message_id"] = mapping.get(row["parent_message_id"], row["parent_message_id"])
+                mapping[row["id"]] = conn.execute(
+                    f"INSERT INTO message ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))})", tuple(row[c] for c in columns)
+                ).lastrowid
+            conn.executemany(
+                "INSERT OR REPLACE INTO message_tokens (message_id, tokenizer, nb_tokens) SELECT ?, tokenizer, nb_tokens FROM message_tokens WHERE message_id=?",
+                [(new_id, old_id) for old_id, new_id in mapping.items()]
+            )
+            conn.executemany("DELETE FROM message WHERE id=?", [(old_id,) for old_id in own_ids])
+            # Nested forks and their messages may point to the renumbered messages
+            conn.executemany("UPDATE message SET parent_message_id=? WHERE parent_message_id=?", [(mapping[old_id], old_id) for old_id in own_ids])
+            conn.executemany("UPDATE discussion SET fork_message_id=? WHERE fork_message_id=?", [(mapping[old_id], old_id) for old_id in own_ids])
+            conn.execute("UPDATE discussion SET parent_discussion_id=NULL, fork_message_id=NULL WHERE id=?", (self.discussion_id,))
+            conn.commit()
+            # The inherited rows are copies, the originals still belong to the parent: only the own messages moved
+            write_buffer.rekey({old_id: mapping[old_id] for old_id in own_ids})
+        # This discussion is one of the live ones
+        self.discussions_db._apply_renumbering(nested_forks | {self.discussion_id}, self.discussion_id, mapping)
+        return mapping
+
+    def _renumber(self, materialized_id:int, mapping:Dict[int, int]):
+        """
+        Follows the materialization of the fork materialized_id (this discussion or one of its parents):
+        the loaded messages keep their objects (held by clients, generations) but those replaced by a copy get its id.
+        """
+        # Reloaded on next use (nested forks may now start from a copy)
+        self._fork_message_id = -1
+        if self._messages is None:
+            return
+        cte, condition, params = self._messages_source()
+        ids = {row[0] for row in self.discussions_db.select(f"{cte}SELECT id FROM message WHERE {condition}", params)}
+        for message in self._messages:
+            if message.id not in ids and mapping.get(message.id) in ids:
+                message.id = mapping[message.id]
+                message.discussion_id = materialized_id
+            if message.parent_message_id not in ids and mapping.get(message.parent_message_id) in ids:
+                message.parent_message_id = mapping[message.parent_message_id]
+        self.messages = sorted(self._messages, key=lambda message: message.id)
+
+    def _own_message_id(self, message_id)->int:
+        """Makes sure a message can be modified without affecting other discussions and returns its (possibly new) id.
+        Inherited messages are copied into this fork, and the forks sharing the message get their own copy first.
+        """
+        message_id = self.discussions_db.resolve_message_id(message_id)
+        if self.is_inherited(message_id):
+            message_id = self.materialize().get(message_id, message_id)
+        self.discussions_db.detach_forks(self.discussion_id, message_id)
+        return message_id
+
+    def fork(self, message_id=None, title:str=None)->"Discussion":
+        """Creates a copy-on-write fork of this discussion sharing the branch ending with message_id (the current message by default)
+        """
+        if message_id is None:
+            message_id = self.current_message.id
+        return self.discussions_db.fork_discussion(self.discussion_id, message_id, title)
+
+    # ----------------------------- Messages (loaded on demand) -----------------------------
+    @property
+    def messages(self)->List[Message]:
+        if self._messages is None:
+            self.get_messages()
+        return self._messages
+
+    @messages.setter
+    def messages(self, value:List[Message]):
+        self._messages = value
+        self._index_messages()
+
+    def _index_messages(self):
+        messages = self._messages if self._messages is not None else []
+        self._messages_by_id = {message.id: message for message in messages}
+        self._message_positions = {message.id: i for i, message in enumerate(messages)}
+        self._set_active_branch([])
+
+    def _set_active_branch(self, branch:List[Message]):
+        self._active_branch = branch
+        self._active_branch_positions = {message.id: i for i, message in enumerate(branch)}
+
+    @property
+    def current_message(self)->Message:
+        if not self._current_message_loaded:
+            # Only the last message is needed here, no need to load the whole discussion
+            columns = Message.get_fields()
+            cte, condition, params = self._messages_source()
+            rows = self.discussions_db.select_messages(
+                f"{cte}SELECT {','.join(columns)} FROM message WHERE {condition} ORDER BY id DESC LIMIT 1", params
+            )
+            self._current_message = rows[0] if len(rows)>0 else None
+            self._current_message_loaded = True
+        return self._current_message
+
+    @current_message.setter
+    def current_message(self, value:Message):
+        self._current_message = value
+        self._current_message_loaded = True
+
+    # ----------------------------- Files (listed on demand) -----------------------------
+    @property
+    def text_files(self)->List[Path]:
+        if self._text_files is None:
+            self.update_file_lists()
+        return self._text_files
+
+    @text_files.setter
+    def text_files(self, value:List[Path]):
+        self._text_files = value
+
+    @property
+    def image_files(self)->List[Path]:
+        if self._image_files is None:
+            self.update_file_lists()
+        return self._image_files
+
+    @image_files.setter
+    def image_files(self, value:List[Path]):
+        self._image_files = value
+
+    @property
+    def audio_files(self)->List[Path]:
+        if self._audio_files is None:
+            self.update_file_lists()
+        return self._audio_files
+
+    @audio_files.setter
+    def audio_files(self, value:List[Path]):
+        self._audio_files = value
+
+    @property
+    def rag_db(self)->List[Path]:
+        if self._rag_db is None:
+            self.update_file_lists()
+        return self._rag_db
+
+    @rag_db.setter
+    def rag_db(self, value:List[Path]):
+        self._rag_db = value
+
+    def update_file_lists(self):
+        # Listing must not create the folders
+        self._text_files = [Path(file) for file in self._folder("text_data", False).glob('*') if not file.is_dir()]
+        self._image_files = [Path(file) for file in self._folder("images", False).glob('*') if not file.is_dir()]
+        self._audio_files = [Path(file) for file in self._folder("audio", False).glob('*') if not file.is_dir()]
+        self._rag_db = [Path(file) for file in self._folder("rag", False).glob('*') if not file.is_dir()]
+
+    # ----------------------------- Vector store (opened when RAG is needed) -----------------------------
+    def _build_vectorizer(self)->VectorDatabase:
+        if self.lollms.config.rag_vectorizer=="semantic":
+            from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
+            vectorizer = SemanticVectorizer(self.lollms.config.rag_vectorizer_model)
+        elif self.lollms.config.rag_vectorizer=="tfidf":
+            from lollmsvectordb.lollms_vectorizers.tfidf_vectorizer import TFIDFVectorizer
+            vectorizer = TFIDFVectorizer()
+        elif self.lollms.config.rag_vectorizer=="openai":
+            from lollmsvectordb.lollms_vectorizers.openai_vectorizer import OpenAIVectorizer
+            vectorizer = OpenAIVectorizer(self.lollms.config.rag_vectorizer_model, self.lollms.config.rag_vectorizer_openai_key)
+
+        return VectorDatabase(
+                                    self.discussion_rag_folder/"db.sqli",
+                                    vectorizer,
+                                    self.lollms.model,
+                                    chunk_size=self.lollms.config.rag_chunk_size,
+                                    overlap=self.lollms.config.rag_overlap
+                                    )
+
+    @property
+    def vectorizer(self)->VectorDatabase:
+        if not self._vectorizer_loaded:
+            self._vectorizer_loaded = True
+            if len(self.text_files)>0:
+                # The store is persisted in the rag folder, the files are only vectorized if it is empty
+                self._vectorizer = self._build_vectorizer()
+                if len(self._vectorizer.list_documents())==0:
+                    for path in self.text_files:
                         try:
-                            self.vectorizer.add_document(path.stem, data, path, True)
+                            data = TextDocumentsLoader.read_file(path)
+                            try:
+                                self._vectorizer.add_document(path.stem, data, path, True)
+                            except Exception as ex:
+                                trace_exception(ex)            
                         except Exception as ex:
-                            trace_exception(ex)            
+                            trace_exception(ex)
+                    try:
+                        self._vectorizer.build_index()
                     except Exception as ex:
                         trace_exception(ex)
-                try:
-                    self.vectorizer.build_index()
-                except Exception as ex:
-                    trace_exception(ex)
-        else:
-            self.vectorizer = None
-
-    def update_file_lists(self):
-        self.text_files = [Path(file) for file in self.discussion_text_folder.glob('*') if not file.is_dir()]
-        self.image_files = [Path(file) for file in self.discussion_images_folder.glob('*') if not file.is_dir()]
-        self.audio_files = [Path(file) for file in self.discussion_audio_folder.glob('*') if not file.is_dir()]
-        self.rag_db = [Path(file) for file in self.discussion_rag_folder.glob('*') if not file.is_dir()]
+        return self._vectorizer
 
+    @vectorizer.setter
+    def vectorizer(self, value:VectorDatabase):
+        self._vectorizer = value
+        self._vectorizer_loaded = True
 
     def remove_file(self, file_name, callback=None):
         try:
@@ -856,16 +2101,18 @@ class Discussion:
 
     def remove_all_files(self):
         # Iterate over each directory and remove all files
-        for path in [self.discussion_images_folder, self.discussion_rag_folder, self.discussion_audio_folder, self.discussion_text_folder]:
+        for path in [self._folder(name, False) for name in ["images", "rag", "audio", "text_data"]]:
             
             for file in path.glob('*'):
                 if file.is_file() and file.suffix!=".sqli":  # Ensure it's a file, not a directory
-                    try:
-                        text = TextDocumentsLoader.read_file(file)
-                        hash = self.vectorizer._hash_document(text)
-                        self.vectorizer.remove_document(hash)
-                    except Exception as ex:
-                        trace_exception(ex)
+                    # No need to open the vector store just to empty it, its file is removed below
+                    if self._vectorizer is not None:
+                        try:
+                            text = TextDocumentsLoader.read_file(file)
+                            hash = self._vectorizer._hash_document(text)
+                            self._vectorizer.remove_document(hash)
+                        except Exception as ex:
+                            trace_exception(ex)
                     file.unlink()  # Delete the file
                     
         # Clear the lists to reflect the current state (empty directories)
@@ -874,16 +2121,24 @@ class Discussion:
         self.audio_files.clear()
         self.vectorizer = None
         gc.collect()
-        fn = self.discussion_rag_folder/"db.sqli"
-        try:
-            fn.unlink()
-        except Exception as ex:
-            trace_exception(ex)
+        fn = self._folder("rag", False)/"db.sqli"
+        if fn.exists():
+            try:
+                fn.unlink()
+            except Exception as ex:
+                trace_exception(ex)
 
     def add_file(self, path, client, tasks_library:TasksLibrary, callback=None, process=True):
         output = ""
 
         path = Path(path)
+        blob = None
+        if self._discussion_folder in path.parents:
+            # Keep one copy of each content, the discussion folder only holds a link to it
+            try:
+                blob = self.discussions_db.media_store.store(path)
+            except Exception as ex:
+                trace_exception(ex)
         if path.suffix in [".wav",".mp3"]:
             self.audio_files.append(path)
             if process:
@@ -893,7 +2148,7 @@ class Discussion:
                 self.lollms.info(f"Transcribing ... ")
                 transcription = self.lollms.stt.transcribe(str(path))
                 transcription_fn = self.discussion_text_folder/(path.stem+".txt")
-                with open(transcription_fn, "w", encoding="utf-8") as f:
+                with open_unshared(transcription_fn, "w", encoding="utf-8") as f:
                     f.write(transcription)
                 self.text_files.append(transcription_fn)
                 tasks_library.info(f"Transcription saved to {transcription_fn}")
@@ -904,7 +2159,11 @@ class Discussion:
                 
                 try:
                     view_file = self.discussion_view_images_folder/path.name
-                    shutil.copyfile(path, view_file)
+                    if blob is not None:
+                        # The view only needs a cached thumbnail, not a full size copy
+                        self.discussions_db.media_store.link_thumbnail(blob, view_file)
+                    else:
+                        shutil.copyfile(path, view_file)
                     pth = str(view_file).replace("\\","/").split('/')
                     if "discussion_databases" in pth:
                         pth = discussion_path_to_url(view_file)
@@ -916,7 +2175,8 @@ class Discussion:
                     if self.lollms.model.binding_type not in [BindingType.TEXT_IMAGE, BindingType.TEXT_IMAGE_VIDEO]:
                         # self.ShowBlockingMessage("Understanding image (please wait)")
                         from PIL import Image
-                        img = Image.open(str(view_file))
+                        # The view file may be a thumbnail, the description is made from the uploaded image
+                        img = Image.open(str(path))
                         # Convert the image to RGB mode
                         img = img.convert("RGB")
                         output += "## image description :\n"+ self.lollms.model.interrogate_blip([img])[0]
@@ -940,25 +2200,15 @@ class Discussion:
         else:
             try:
                 # self.ShowBlockingMessage("Adding file to vector store.\nPlease stand by")
-                self.text_files.append(path)
+                # Open the store with the files that were already there before adding the new one
+                vectorizer = self.vectorizer if process else None
+                if path not in self.text_files:
+                    self.text_files.append(path)
                 ASCIIColors.info("Received text compatible file")
                 self.lollms.ShowBlockingMessage("Processing file\nPlease wait ...")
                 if process:
-                    if self.vectorizer is None:
-                        if self.lollms.config.rag_vectorizer == "semantic":
-                            from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
-                            v = SemanticVectorizer(self.lollms.config.rag_vectorizer_model)
-                        elif self.lollms.config.rag_vectorizer == "tfidf":
-                            from lollmsvectordb.lollms_vectorizers.tfidf_vectorizer import TFIDFVectorizer
-                            v = TFIDFVectorizer()
-                        elif self.lollms.config.rag_vectorizer == "openai":
-                            from lollmsvectordb.lollms_vectorizers.openai_vectorizer import OpenAIVectorizer
-                            v = OpenAIVectorizer(self.lollms.config.rag_vectorizer_openai_key)
-                        self.vectorizer = VectorDatabase(
-                                    self.discussion_rag_folder/"db.sqli",
-                                    v,
-                                    self.lollms.model,
-                                    )
+                    if vectorizer is None:
+                        self.vectorizer = self._build_vectorizer()
                     data = TextDocumentsLoader.read_file(path)
                     self.vectorizer.add_document(path.stem, data, path, True)
                     self.vectorizer.build_index()
@@ -1020,6 +2270,10 @@ class Discussion:
         if nb_tokens is None:
             nb_tokens = 0
 
+        # The previous message is done, make sure its streamed state reaches the database
+        if self._current_message is not None:
+            self._current_message.close()
+
         self.current_message = Message(
             self.discussion_id,
             self.discussions_db,
@@ -1042,9 +2296,21 @@ class Discussion:
             insert_into_db=True
         )
 
-        self.messages.append(self.current_message)
+        # If the messages were not loaded yet, they will be read from the database (new one included) when needed
+        if self._messages is not None:
+            self._append_message(self.current_message)
         return self.current_message
 
+    def _append_message(self, message:Message):
+        """Adds a new message (the most recent one) to the loaded messages, their indexes and the active branch"""
+        self._message_positions[message.id] = len(self._messages)
+        self._messages_by_id[message.id] = message
+        self._messages.append(message)
+        # A reply to the leaf of the materialized branch just extends it
+        if len(self._active_branch)>0 and self._active_branch[-1].id == message.parent_message_id:
+            self._active_branch_positions[message.id] = len(self._active_branch)
+            self._active_branch.append(message)
+
     def rename(self, new_title):
         """Renames the discussion
 
@@ -1128,14 +2394,9 @@ class Discussion:
             self.set_metadata(current_metadata)
 
     def delete_discussion(self):
-        """Deletes the discussion
+        """Deletes the discussion. The forks that share its messages get their own copy first.
         """
-        self.discussions_db.delete(
-            f"DELETE FROM message WHERE discussion_id={self.discussion_id}"
-        )
-        self.discussions_db.delete(
-            f"DELETE FROM discussion WHERE id={self.discussion_id}"
-        )
+        self.discussions_db.delete_discussions([self.discussion_id], remove_folders=False)
 
     def get_messages(self)->List[Message]:
         """Gets a list of messages information
@@ -1144,26 +2405,130 @@ class Discussion:
             list: List of entries in the format {"id":message id, "sender":sender name, "content":message content, "message_type":message type, "rank": message rank}
         """
         columns = Message.get_fields()
-
-        rows = self.discussions_db.select(
-            f"SELECT {','.join(columns)} FROM message WHERE discussion_id=?", (self.discussion_id,)
+        cte, condition, params = self._messages_source()
+        self.messages = self.discussions_db.select_messages(
+            f"{cte}SELECT {','.join(columns)} FROM message WHERE {condition} ORDER BY id", params
         )
-        msg_dict = [{ c:row[i] for i,c in enumerate(columns)} for row in rows]
-        self.messages=[]
-        for msg in msg_dict:
-            self.messages.append(Message.from_dict(self.discussions_db, msg))
 
         if len(self.messages)>0:
             self.current_message = self.messages[-1]
 
         return self.messages
 
+    def sync_messages(self)->List[Message]:
+        """Loads the messages added since the messages were loaded (by other Discussion objects of this discussion).
+        Unlike get_messages, the loaded messages, their indexes and the active branch are kept, only the new messages are read.
+        """
+        if self._messages is None:
+            return self.get_messages()
+        columns = Message.get_fields()
+        cte, condition, params = self._messages_source()
+        last_id = self._messages[-1].id if len(self._messages)>0 else 0
+        for message in self.discussions_db.select_messages(
+            f"{cte}SELECT {','.join(columns)} FROM message WHERE {condition} AND id>? ORDER BY id", params+(last_id,)
+        ):
+            self._append_message(message)
+        return self._messages
+
+    def get_messages_page(self, limit:int=50, before_id:int=None, after_id:int=None)->Dict[str, Any]:
+        """Gets a page of messages using keyset pagination on the message id.
+        Without cursor, the last `limit` messages of the discussion are returned.
+
+        Args:
+            limit (int): The maximum number of messages to return.
+            before_id (int, optional): Return the messages that precede this message id (scrolling up).
+            after_id (int, optional): Return the messages that follow this message id (scrolling down).
+
+        Returns:
+            dict: {"messages": List[Message] in chronological order, "before_cursor": id or None, "after_cursor": id or None}
+                The cursors are None when there is nothing more in that direction.
+        """
+        limit = max(1, int(limit))
+        columns = Message.get_fields()
+        fields = ','.join(columns)
+        cte, condition, params = self._messages_source()
+        if after_id is not None:
+            messages = self.discussions_db.select_messages(
+                f"{cte}SELECT {fields} FROM message WHERE {condition} AND id>? ORDER BY id ASC LIMIT ?", params+(after_id, limit+1)
+            )
+            has_more = len(messages)>limit
+            messages = messages[:limit]
+            return {
+                "messages": messages,
+                "before_cursor": messages[0].id if len(messages)>0 else None,
+                "after_cursor": messages[-1].id if has_more else None
+            }
+
+        if before_id is None:
+            messages = self.discussions_db.select_messages(
+                f"{cte}SELECT {fields} FROM message WHERE {condition} ORDER BY id DESC LIMIT ?", params+(limit+1,)
+            )
+        else:
+            messages = self.discussions_db.select_messages(
+                f"{cte}SELECT {fields} FROM message WHERE {condition} AND id<? ORDER BY id DESC LIMIT ?", params+(before_id, limit+1)
+            )
+        has_more = len(messages)>limit
+        messages = messages[:limit]
+        messages.reverse()
+        return {
+            "messages": messages,
+            "before_cursor": messages[0].id if has_more else None,
+            "after_cursor": None if before_id is None else (messages[-1].id if len(messages)>0 else None)
+        }
+
     def get_message(self, message_id):
-        for message in self.messages:
-            if message.id == int(message_id):
-                self.current_message = message
-                return message
-        return None
+        if self._messages is None:
+            self.get_messages()
+        message = self._messages_by_id.get(int(message_id))
+        if message is None:
+            # An id sent before the fork was materialized
+            message = self._messages_by_id.get(self.discussions_db.resolve_message_id(message_id))
+        if message is not None:
+            self.current_message = message
+        return message
+
+    def get_message_index(self, message_id)->int:
+        """Returns the position of a message in self.messages or -1 if it is not in this discussion
+        """
+        if self._messages is None:
+            self.get_messages()
+        return self._message_positions.get(int(message_id), -1)
+
+    def get_branch(self, message_id=None)->List[Message]:
+        """Returns the messages of the branch ending with message_id (the current message by default),
+        from the root to that message, following the parent_message_id links.
+
+        The last branch is kept materialized, so getting it again, one of its prefixes, or a sibling
+        branch only costs the length of the returned branch (plus the part that differs).
+        """
+        if message_id is None:
+            if self.current_message is None:
+                return []
+            message_id = self.current_message.id
+        if self._messages is None:
+            self.get_messages()
+        message_id = int(message_id)
+
+        position = self._active_branch_positions.get(message_id)
+        if position is not None:
+            return self._active_branch[:position+1]
+
+        tail = []
+        seen = set()
+        prefix_length = 0
+        message = self._messages_by_id.get(message_id)
+        while message is not None and message.id not in seen:
+            position = self._active_branch_positions.get(message.id)
+            if position is not None:
+                # The rest of the chain is already materialized
+                prefix_length = position+1
+                break
+            tail.append(message)
+            seen.add(message.id)
+            message = self._messages_by_id.get(message.parent_message_id)
+        tail.reverse()
+        self._set_active_branch(self._active_branch[:prefix_length] + tail)
+        return list(self._active_branch)
 
     def select_message(self, message_id):
         msg = self.get_message(message_id)
@@ -1220,6 +2585,37 @@ class Discussion:
         """
         self.current_message.update_ui(new_ui)
 
+    def close_message(self):
+        """Writes the pending updates of the current message to the database
+        and stores its number of tokens for the current model
+        """
+        if self._current_message is not None:
+            self._current_message.close(getattr(self.lollms, "model", None))
+
+    def load_tokens_counts(self, tokenizer_id:str):
+        """Loads the stored token counts of all the loaded messages (inherited ones included) for a tokenizer in one query
+        """
+        cte, condition, params = self._messages_source()
+        rows = self.discussions_db.select(
+            f"{cte}SELECT message_id, nb_tokens FROM message_tokens WHERE message_id IN (SELECT id FROM message WHERE {condition}) AND tokenizer=?",
+            params+(tokenizer_id,)
+        )
+        for message_id, nb_tokens in rows:
+            message = self._messages_by_id.get(message_id)
+            if message is not None:
+                message.tokens_counts[tokenizer_id] = nb_tokens
+
+    def store_tokens_counts(self, tokenizer_id:str, messages:List[Message]):
+        """Persists the in memory token counts of some messages for a tokenizer in one transaction
+        """
+        params = [(message.id, tokenizer_id, message.tokens_counts[tokenizer_id]) for message in messages if message.id is not None and tokenizer_id in message.tokens_counts]
+        if len(params)==0:
+            return
+        if self.discussions_db.write_buffer.has_pending():
+            self.discussions_db.write_buffer.flush()
+        with self.discussions_db.pool.connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO message_tokens (message_id, tokenizer, nb_tokens) VALUES (?, ?, ?)", params)
+
     def edit_message(self, message_id, new_content, new_metadata=None, new_ui=None):
         """Edits the content of a message
 
@@ -1227,7 +2623,9 @@ class Discussion:
             message_id (int): The id of the message to be changed
             new_content (str): The nex message content
         """
-        msg = self.get_message(message_id)
+        if self.get_message(message_id) is None:
+            return False
+        msg = self.get_message(self._own_message_id(message_id))
         if msg:
             msg.update(new_content, new_metadata, new_ui)
             return True
@@ -1241,30 +2639,21 @@ class Discussion:
         Args:
             message_id (int): The id of the message to be changed
         """
-        # Retrieve current rank value for message_id
-        current_rank = self.discussions_db.select("SELECT rank FROM message WHERE id=?", (message_id,),False)[0]
-
-        # Increment current rank value by 1
-        new_rank = current_rank + 1        
-        self.discussions_db.update(
-            f"UPDATE message SET rank = ? WHERE id = ?",(new_rank,message_id)
-        )
-        return new_rank
+        return self._change_message_rank(message_id, 1)
 
     def message_rank_down(self, message_id):
-        """Increments the rank of the message
+        """Decrements the rank of the message
 
         Args:
             message_id (int): The id of the message to be changed
         """
-        # Retrieve current rank value for message_id
-        current_rank = self.discussions_db.select("SELECT rank FROM message WHERE id=?", (message_id,),False)[0]
+        return self._change_message_rank(message_id, -1)
 
-        # Increment current rank value by 1
-        new_rank = current_rank - 1        
-        self.discussions_db.update(
-            f"UPDATE message SET rank = ? WHERE id = ?",(new_rank,message_id)
-        )
+    def _change_message_rank(self, message_id, delta):
+        message_id = self.discussions_db.resolve_message_id(message_id)
+        new_rank = self.discussions_db.change_message_rank(message_id, delta)
+        if new_rank is not None and self._messages is not None and int(message_id) in self._messages_by_id:
+            self._messages_by_id[int(message_id)].rank = new_rank
         return new_rank
     
     def delete_message(self, message_id):
@@ -1273,8 +2662,11 @@ class Discussion:
         Args:
             message_id (int): The id of the message to be deleted
         """
-        # Retrieve current rank value for message_id
+        message_id = self._own_message_id(message_id)
+        self.discussions_db.write_buffer.discard(message_id)
         self.discussions_db.delete("DELETE FROM message WHERE id=?", (message_id,))
+        if self._messages is not None and int(message_id) in self._messages_by_id:
+            self.messages = [message for message in self._messages if message.id != int(message_id)]
 
     def export_for_vectorization(self):
         """
@@ -1297,15 +2689,30 @@ class Discussion:
         return title, messages
  
     def format_discussion(self, max_allowed_tokens, splitter_text=None):
+        """Formats the most recent messages of the discussion that fit in max_allowed_tokens.
+
+        Each message is tokenized once and the size of the text is tracked incrementally. Token counts
+        are not always additive (merges at message boundaries, bos tokens...), so the running count is
+        allowed to be off by one token per boundary: when it gets that close to the budget, the text is
+        tokenized exactly to take the same decision as a full recount would.
+        """
         if not splitter_text:
             splitter_text = self.lollms.config.discussion_prompt_separator
-        formatted_text = ""
+        formatted_messages = []             # newest first
+        n_text_tokens = self.lollms.model.count_tokens("")    # token count of the text, exact at the last anchor
+        boundaries_since_anchor = 0
         for message in reversed(self.messages):  # Start from the newest message
             formatted_message = f"{splitter_text}{message.sender.replace(':','').replace(splitter_text,'')}:\n{message.content}\n"
-            tokenized_message = self.lollms.model.tokenize(formatted_message)
-            if len(tokenized_message) + len(self.lollms.model.tokenize(formatted_text)) <= max_allowed_tokens:
-                formatted_text = formatted_message + formatted_text
-            else:
-                break  # Stop if adding the next message would exceed the limit
-        return formatted_text   
+            n_message_tokens = self.lollms.model.count_tokens(formatted_message)
+            if n_message_tokens + n_text_tokens + boundaries_since_anchor > max_allowed_tokens:
+                # Too close to call with the running count, count the text exactly
+                n_text_tokens = self.lollms.model.count_tokens("".join(reversed(formatted_messages)), use_cache=False)
+                boundaries_since_anchor = 0
+                if n_message_tokens + n_text_tokens > max_allowed_tokens:
+                    break  # Stop if adding the next message would exceed the limit
+            formatted_messages.append(formatted_message)
+            n_text_tokens += n_message_tokens
+            if len(formatted_messages)>1:
+                boundaries_since_anchor += 1
+        return "".join(reversed(formatted_messages))
 # ========================================================================================================================
@@ -0,0 +1,104 @@
+"""
+project: lollms
+file: folder_remover.py
+author: ParisNeo
+description:
+    Background removal of folders.
+    Deleting hundreds of discussions is a fast database operation, but removing their folders
+    (images, documents, vector stores...) can take a while. The folders are queued here and
+    removed by a worker thread that reports its progress, so the caller returns immediately.
+"""
+import shutil
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, Any, List
+from ascii_colors import ASCIIColors, trace_exception
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+class FolderRemover:
+    """
+    Removes queued folders in a background thread.
+
+    Args:
+        on_done (Callable, optional): Called without arguments each time the queue has been emptied
+            (used to collect the media that are not referenced anymore).
+        progress_callback (Callable, optional): Called with the progress dict after each removed folder.
+    """
+    def __init__(self, on_done:Callable=None, progress_callback:Callable=None):
+        self.on_done = on_done
+        self.progress_callback = progress_callback
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread:threading.Thread = None
+        self._progress = {"queued": 0, "removed": 0, "failed": 0, "current": None}
+
+    def remove(self, folders:List[Path]):
+        """Queues folders for removal, missing ones are ignored"""
+        folders = [Path(folder) for folder in folders if Path(folder).exists()]
+        if len(folders)==0:
+            return
+        with self._cond:
+            if len(self._queue)==0 and self._progress["current"] is None:
+                # A new batch starts
+                self._progress = {"queued": 0, "removed": 0, "failed": 0, "current": None}
+            self._queue.extend(folders)
+            self._progress["queued"] += len(folders)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="folder_remover", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            self._remove_queued()
+            if self.on_done is not None:
+                try:
+                    self.on_done()
+                except Exception as ex:
+                    trace_exception(ex)
+            with self._cond:
+                # Folders queued while on_done was running are removed by this same thread
+                if len(self._queue)==0:
+                    self._thread = None
+                    return
+
+    def _remove_queued(self):
+        while True:
+            with self._cond:
+                if len(self._queue)==0:
+                    self._progress["current"] = None
+                    self._cond.notify_all()
+                    return
+                folder = self._queue.popleft()
+                self._progress["current"] = str(folder)
+            try:
+                shutil.rmtree(folder)
+                self._progress["removed"] += 1
+            except Exception as ex:
+                trace_exception(ex)
+                ASCIIColors.error(f"Couldn't remove {folder}")
+                self._progress["failed"] += 1
+            if self.progress_callback is not None:
+                try:
+                    self.progress_callback(self.get_progress())
+                except Exception as ex:
+                    trace_exception(ex)
+
+    def get_progress(self)->Dict[str, Any]:
+        """Returns {"queued", "removed", "failed", "pending", "current", "done"} for the current (or last) batch"""
+        with self._cond:
+            progress = dict(self._progress)
+            progress["pending"] = len(self._queue)
+        progress["done"] = progress["pending"]==0 and progress["current"] is None
+        return progress
+
+    def wait(self, timeout:float=None)->bool:
+        """Waits until the queue is empty, returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._queue)==0 and self._progress["current"] is None, timeout)
@@ -0,0 +1,222 @@
+"""
+project: lollms
+file: maintenance.py
+author: ParisNeo
+description:
+    Maintenance of the personal sqlite databases of lollms (discussions, skills library).
+    Deleting discussions or skills leaves free pages in the files, and the query planner never gets
+    statistics unless ANALYZE runs. The DatabaseMaintenanceScheduler periodically runs, when the
+    application is idle, an incremental vacuum (returning the free pages to the file system)
+    followed by PRAGMA optimize on each registered database.
+    Switching a database to incremental auto vacuum rewrites the whole file (VACUUM) and blocks its
+    writers meanwhile, so it is never done by the scheduler, only when explicitly requested.
+    database_health reports page counts, free pages and the size of every table and index.
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Any, List
+from ascii_colors import ASCIIColors, trace_exception
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def _connect(db_path:Path)->sqlite3.Connection:
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def database_health(db_path:Path)->Dict[str, Any]:
+    """
+    Returns the health report of a sqlite database file.
+
+    Returns:
+        dict: file_size, page_size, page_count, freelist_count, free_ratio, auto_vacuum and
+            objects: [{"name", "type" (table/index), "table", "size", "pages"}] sorted by size
+            (object sizes need the dbstat virtual table, they are None when sqlite is built without it)
+    """
+    db_path = Path(db_path)
+    if not db_path.exists():
+        return {"path": str(db_path), "exists": False}
+    conn = _connect(db_path)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        objects = {
+            row[0]: {"name": row[0], "type": row[1], "table": row[2], "size": None, "pages": None}
+            for row in conn.execute("SELECT name, type, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')")
+        }
+        try:
+            for name, pages, size in conn.execute("SELECT name, COUNT(*), SUM(pgsize) FROM dbstat GROUP BY name"):
+                if name in objects:
+                    objects[name]["pages"] = pages
+                    objects[name]["size"] = size
+        except sqlite3.OperationalError:
+            pass
+        return {
+            "path": str(db_path),
+            "exists": True,
+            "file_size": db_path.stat().st_size,
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_count": freelist_count,
+            "free_ratio": freelist_count/page_count if page_count>0 else 0,
+            "auto_vacuum": AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum),
+            "objects": sorted(objects.values(), key=lambda o: o["size"] or 0, reverse=True)
+        }
+    finally:
+        conn.close()
+
+
+def maintain_database(db_path:Path, max_vacuum_pages:int=2000, convert:bool=False)->Dict[str, Any]:
+    """
+    Runs one maintenance pass on a database:
+        - if convert is True, switches it to incremental auto vacuum if needed (this needs one full VACUUM
+          that rewrites the file and blocks the writers until it is done),
+        - returns up to max_vacuum_pages free pages to the file system (incremental_vacuum, only
+          effective once the database uses incremental auto vacuum),
+        - runs PRAGMA optimize so that the planner statistics are refreshed when useful.
+
+    Returns:
+        dict: freed_pages, freed_bytes, converted (True if the VACUUM ran),
+            needs_conversion (True if free pages can't be returned until the database is converted), duration
+    """
+    db_path = Path(db_path)
+    start = time.perf_counter()
+    conn = _connect(db_path)
+    converted = False
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0]==2
+        if not incremental and convert:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            converted = True
+        else:
+            # executescript steps the pragma to completion, execute would only free the first page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_vacuum_pages)});")
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+    freed_pages = max(0, free_before-free_after)
+    return {
+        "path": str(db_path),
+        "freed_pages": freed_pages,
+        "freed_bytes": freed_pages*page_size,
+        "converted": converted,
+        "needs_conversion": not incremental and not converted,
+        "duration": time.perf_counter()-start
+    }
+
+
+class DatabaseMaintenanceScheduler:
+    """
+    Runs maintain_database on the registered databases when the application is idle.
+
+    Databases are registered with a callable returning their current path (or a list of paths),
+    so that switching the discussions database is picked up automatically.
+
+    Args:
+        is_idle (Callable): Returns True when nothing is being generated (maintenance is skipped otherwise).
+        interval (float): Minimum number of seconds between two maintenances of a database.
+        check_interval (float): How often the scheduler wakes up to look for work.
+    """
+    def __init__(self, is_idle:Callable[[], bool]=None, interval:float=3600, check_interval:float=60, max_vacuum_pages:int=2000):
+        self.is_idle = is_idle
+        self.interval = interval
+        self.check_interval = check_interval
+        self.max_vacuum_pages = max_vacuum_pages
+        self._databases:Dict[str, Callable] = {}
+        self._last_runs:Dict[str, Dict[str, Any]] = {}
+        self._stop = threading.Event()
+        self._thread:threading.Thread = None
+        self._lock = threading.Lock()
+
+    def register(self, name:str, path_provider:Callable):
+        """Registers a database (or a group of databases) under a name"""
+        self._databases[name] = path_provider
+
+    def _paths(self, name:str)->List[Path]:
+        try:
+            paths = self._databases[name]()
+        except Exception as ex:
+            trace_exception(ex)
+            return []
+        if paths is None:
+            return []
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
+        return [Path(p) for p in paths if p is not None and Path(p).exists()]
+
+    def get_database_paths(self)->Dict[str, List[Path]]:
+        return {name: self._paths(name) for name in self._databases}
+
+    def run_once(self, force:bool=False, convert:bool=False)->List[Dict[str, Any]]:
+        """
+        Maintains every database that is due (all of them if force is True).
+        Stops early if the application becomes busy.
+        convert switches the databases to incremental auto vacuum (full rewrite, see maintain_database),
+        the background schedule never sets it.
+        """
+        reports = []
+        with self._lock:
+            for name, paths in self.get_database_paths().items():
+                for path in paths:
+                    key = str(path)
+                    last = self._last_runs.get(key)
+                    if not force and last is not None and time.time()-last["time"]<self.interval:
+                        continue
+                    if not force and self.is_idle is not None and not self.is_idle():
+                        return reports
+                    try:
+                        report = maintain_database(path, self.max_vacuum_pages, convert)
+                        report["database"] = name
+                        report["time"] = time.time()
+                        self._last_runs[key] = report
+                        reports.append(report)
+                        if report["freed_pages"]>0 or report["converted"]:
+                            ASCIIColors.info(f"Maintained {name} database {path.name}: {report['freed_bytes']/1e6:.2f}MB freed in {report['duration']:.2f}s")
+                    except sqlite3.OperationalError as ex:
+                        # Most likely locked by a writer, retry on next round
+                        ASCIIColors.warning(f"Couldn't maintain {path}: {ex}")
+                    except Exception as ex:
+                        trace_exception(ex)
+        return reports
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            if self.is_idle is None or self.is_idle():
+                self.run_once()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="db_maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_health(self)->Dict[str, List[Dict[str, Any]]]:
+        """Returns the health report of every registered database with the result of its last maintenance"""
+        health = {}
+        for name, paths in self.get_database_paths().items():
+            health[name] = []
+            for path in paths:
+                report = database_health(path)
+                report["last_maintenance"] = self._last_runs.get(str(path))
+                health[name].append(report)
+        return health
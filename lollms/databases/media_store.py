@@ -0,0 +1,228 @@
+"""
+project: lollms
+file: media_store.py
+author: ParisNeo
+description:
+    Content addressed store for the files added to discussions.
+    Each file is stored once under its SHA-256 in media/blobs and the discussion folders only hold
+    hard links to it, so the same image or document shared in many discussions takes the space of one.
+    The number of links of a blob is its reference count: when the last discussion file pointing to it
+    is removed, the blob is collected by collect_garbage.
+    Thumbnails used to display images are generated once per blob and size and cached.
+    When hard links are not supported (for example across file systems), files are copied instead.
+    Writing through a link would change the file of every discussion sharing the blob: code writing
+    to a path that may be linked opens it with open_unshared.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Any
+from ascii_colors import ASCIIColors, trace_exception
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+def hash_file(path:Path, chunk_size:int=1024*1024)->str:
+    """Returns the SHA-256 of a file, read by chunks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def unshare(path:Path):
+    """Gives path its own file if it is a link to a stored media shared with other files (the content is kept)"""
+    path = Path(path)
+    if not path.exists() or path.stat().st_nlink<=1:
+        return
+    tmp = path.with_name(path.name+".unshare")
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, path)
+
+
+def open_unshared(path:Path, mode:str="wb", **kwargs):
+    """
+    open() for writing a file that may be a link to a stored media: the link is broken first,
+    so that the other discussions sharing the content keep theirs.
+    """
+    path = Path(path)
+    if path.exists() and path.stat().st_nlink>1:
+        if "a" in mode or "+" in mode:
+            unshare(path)
+        else:
+            # Overwritten anyway, no need to copy the content
+            path.unlink()
+    return open(path, mode, **kwargs)
+
+
+class MediaStore:
+    # Formats that can't be resized with PIL (or would lose their animation), they are shown as is
+    NOT_RESIZABLE = [".svg", ".gif"]
+
+    def __init__(self, root:Path, thumbnail_size:int=800):
+        self.root = Path(root)
+        self.blobs_path = self.root/"blobs"
+        self.thumbnails_path = self.root/"thumbnails"
+        self.thumbnail_size = thumbnail_size
+        self._lock = threading.Lock()
+        self.hard_links_supported = True
+
+    def blob_path(self, sha:str, suffix:str="")->Path:
+        return self.blobs_path/sha[:2]/f"{sha}{suffix.lower()}"
+
+    def _link(self, source:Path, target:Path):
+        """Makes target a hard link to source (a copy if hard links are not available)"""
+        if target.exists():
+            if os.path.samefile(source, target):
+                return
+            target.unlink()
+        target.parent.mkdir(exist_ok=True, parents=True)
+        if self.hard_links_supported:
+            try:
+                os.link(source, target)
+                return
+            except OSError as ex:
+                ASCIIColors.warning(f"Hard links are not supported for {target} ({ex}), media files will be copied")
+                self.hard_links_supported = False
+        shutil.copyfile(source, target)
+
+    def store(self, path:Path)->Path:
+        """
+        Moves a file into the store and replaces it with a link to its blob.
+        If the same content is already stored, the file is simply replaced by a link to the existing blob.
+
+        Returns:
+            Path: The blob path
+        """
+        path = Path(path)
+        sha = hash_file(path)
+        blob = self.blob_path(sha, path.suffix)
+        with self._lock:
+            if not blob.exists():
+                blob.parent.mkdir(exist_ok=True, parents=True)
+                shutil.copyfile(path, blob)
+            self._link(blob, path)
+        return blob
+
+    def store_folder(self, folder:Path)->int:
+        """Stores every file of a folder (used for folders created before the store or restored from an archive)
+
+        Returns:
+            int: The number of stored files
+        """
+        folder = Path(folder)
+        if not folder.exists():
+            return 0
+        count = 0
+        for file in folder.rglob("*"):
+            # Vector stores are sqlite databases that are modified in place, they must stay private
+            if file.is_file() and file.suffix!=".sqli":
+                try:
+                    self.store(file)
+                    count += 1
+                except Exception as ex:
+                    trace_exception(ex)
+        return count
+
+    def references(self, blob:Path)->int:
+        """Returns the number of discussion files pointing to a blob"""
+        return Path(blob).stat().st_nlink-1
+
+    def thumbnail(self, blob:Path, size:int=None)->Path:
+        """
+        Returns a cached copy of the blob image resized to fit in size x size pixels.
+        The thumbnail is generated on the first request only. Images that are already small enough,
+        or that can't be resized, are returned unchanged.
+        """
+        blob = Path(blob)
+        size = size or self.thumbnail_size
+        if blob.suffix in MediaStore.NOT_RESIZABLE:
+            return blob
+        thumbnail = self.thumbnails_path/f"{blob.stem}_{size}{blob.suffix}"
+        if thumbnail.exists():
+            return thumbnail
+        try:
+            from PIL import Image
+            with Image.open(blob) as img:
+                if max(img.size)<=size:
+                    return blob
+                image_format = img.format
+                img.thumbnail((size, size))
+                thumbnail.parent.mkdir(exist_ok=True, parents=True)
+                tmp = thumbnail.with_name(thumbnail.name+".tmp")
+                img.save(tmp, format=image_format)
+                os.replace(tmp, thumbnail)
+            return thumbnail
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.warning(f"Couldn't build a thumbnail for {blob.name}, using the original image")
+            return blob
+
+    def link_thumbnail(self, blob:Path, target:Path, size:int=None)->Path:
+        """Places the thumbnail of a blob at target (as a link) and returns target"""
+        self._link(self.thumbnail(blob, size), Path(target))
+        return Path(target)
+
+    def collect_garbage(self)->Dict[str, Any]:
+        """
+        Removes the blobs that are not linked from any discussion anymore, and their thumbnails.
+        Only file metadata is read, nothing is hashed.
+
+        Returns:
+            dict: {"removed": number of removed blobs, "freed_bytes": reclaimed space, "remaining": number of blobs left}
+        """
+        removed = 0
+        freed_bytes = 0
+        remaining = 0
+        if not self.blobs_path.exists():
+            return {"removed": 0, "freed_bytes": 0, "remaining": 0}
+        if not self.hard_links_supported:
+            # Without links there is no reference count to rely on
+            return {"removed": 0, "freed_bytes": 0, "remaining": sum(1 for _ in self.blobs_path.rglob("*") if _.is_file())}
+        with self._lock:
+            kept = set()
+            for blob in self.blobs_path.rglob("*"):
+                if not blob.is_file():
+                    continue
+                stat = blob.stat()
+                if stat.st_nlink>1:
+                    kept.add(blob.stem)
+                    continue
+                try:
+                    blob.unlink()
+                    removed += 1
+                    freed_bytes += stat.st_size
+                except Exception as ex:
+                    trace_exception(ex)
+            remaining = len(kept)
+            # Thumbnails of removed blobs go too, unless a discussion still shows them
+            if self.thumbnails_path.exists():
+                for thumbnail in self.thumbnails_path.glob("*"):
+                    stat = thumbnail.stat()
+                    if stat.st_nlink==1 and thumbnail.stem.rsplit("_", 1)[0] not in kept:
+                        try:
+                            thumbnail.unlink()
+                            freed_bytes += stat.st_size
+                        except Exception as ex:
+                            trace_exception(ex)
+        if removed>0:
+            ASCIIColors.info(f"Media store: removed {removed} unused files ({freed_bytes/1e6:.2f}MB)")
+        return {"removed": removed, "freed_bytes": freed_bytes, "remaining": remaining}
+
+    def get_stats(self)->Dict[str, Any]:
+        blobs = [b for b in self.blobs_path.rglob("*") if b.is_file()] if self.blobs_path.exists() else []
+        thumbnails = [t for t in self.thumbnails_path.glob("*") if t.is_file()] if self.thumbnails_path.exists() else []
+        return {
+            "blobs": len(blobs),
+            "blobs_size": sum(b.stat().st_size for b in blobs),
+            "references": sum(b.stat().st_nlink-1 for b in blobs),
+            "thumbnails": len(thumbnails),
+            "thumbnails_size": sum(t.stat().st_size for t in thumbnails),
+            "hard_links_supported": self.hard_links_supported
+        }
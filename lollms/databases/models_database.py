@@ -1,125 +1,296 @@
+import json
 import sqlite3
 import yaml
-from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List
 from ascii_colors import ASCIIColors
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+from lollms.utilities import path_signature
+
+# Columns of the models table, in the order they are selected
+MODEL_COLUMNS = ["id", "category", "icon", "datasets", "last_commit_time", "license", "model_creator", "model_creator_link", "name", "quantizer", "ctx_size", "rank", "type", "description"]
+
 class ModelsDB:
-    def __init__(self, db_name='models.db'):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
+    # Sort orders of search, when no text is searched (text searches are sorted by relevance)
+    SORT_FIELDS = {
+        "last_commit_time": "models.last_commit_time DESC",
+        "rank": "models.rank DESC",
+        "name": "models.name COLLATE NOCASE ASC",
+    }
+
+    def __init__(self, db_name='models.db', source=None):
+        """
+        Args:
+            db_name (str): The database file.
+            source (str, optional): A models zoo database to serve. The zoo databases are files of the models zoo
+                git clone, they are only opened read only and db_name is a local copy of them with the indexes and
+                the full text index (to be placed under the personal paths). The copy is refreshed by sync when
+                the source file changes. Changes made to the copy are lost then.
+        """
+        self.source = Path(source) if source is not None else None
+        if self.source is not None:
+            Path(db_name).parent.mkdir(parents=True, exist_ok=True)
+        # One long lived connection per thread. Databases built for the zoo keep a rollback journal
+        # so that no -wal/-shm files are shipped next to them
+        self.pool = SQLiteConnectionPool(db_name, pragmas={"journal_mode": "DELETE"} if source is None else None)
         self.create_table()
+        if self.source is not None:
+            self.sync()
 
     def create_table(self):
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS models (
-                                id INTEGER PRIMARY KEY,
-                                category TEXT,
-                                icon TEXT,
-                                datasets TEXT,
-                                last_commit_time TEXT,
-                                license TEXT,
-                                model_creator TEXT,
-                                model_creator_link TEXT,
-                                name TEXT UNIQUE,
-                                quantizer TEXT,
-                                ctx_size INTEGER,
-                                rank REAL,
-                                type TEXT
-                            )''')
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS variants (
-                                id INTEGER PRIMARY KEY,
-                                model_id INTEGER,
-                                name TEXT,
-                                size INTEGER,
-                                FOREIGN KEY(model_id) REFERENCES models(id)
-                            )''')
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS models (
+                                    id INTEGER PRIMARY KEY,
+                                    category TEXT,
+                                    icon TEXT,
+                                    datasets TEXT,
+                                    last_commit_time TEXT,
+                                    license TEXT,
+                                    model_creator TEXT,
+                                    model_creator_link TEXT,
+                                    name TEXT UNIQUE,
+                                    quantizer TEXT,
+                                    ctx_size INTEGER,
+                                    rank REAL,
+                                    type TEXT,
+                                    description TEXT
+                                )''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS variants (
+                                    id INTEGER PRIMARY KEY,
+                                    model_id INTEGER,
+                                    name TEXT,
+                                    size INTEGER,
+                                    FOREIGN KEY(model_id) REFERENCES models(id)
+                                )''')
+            # Databases created before the description column
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(models)")]
+            if "description" not in columns:
+                cursor.execute("ALTER TABLE models ADD COLUMN description TEXT")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_variants_model_id ON variants (model_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_variants_name ON variants (name)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_type ON models (type)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_last_commit_time ON models (last_commit_time)")
+            self.create_fts(cursor)
+
+    def create_fts(self, cursor):
+        """
+        Creates the models_fts full text index over the names, descriptions and creators of the models.
+        It is an external content FTS5 table kept in sync by triggers, backfilled when created on an existing database.
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='models_fts'")
+        if cursor.fetchone() is not None:
+            return
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE models_fts USING fts5(name, description, model_creator, content='models', content_rowid='id')")
+        except sqlite3.OperationalError as ex:
+            ASCIIColors.warning(f"Full text search is not available with this sqlite version: {ex}")
+            return
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS models_fts_insert AFTER INSERT ON models BEGIN
+                INSERT INTO models_fts(rowid, name, description, model_creator) VALUES (new.id, new.name, new.description, new.model_creator);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS models_fts_delete AFTER DELETE ON models BEGIN
+                INSERT INTO models_fts(models_fts, rowid, name, description, model_creator) VALUES ('delete', old.id, old.name, old.description, old.model_creator);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS models_fts_update AFTER UPDATE OF name, description, model_creator ON models BEGIN
+                INSERT INTO models_fts(models_fts, rowid, name, description, model_creator) VALUES ('delete', old.id, old.name, old.description, old.model_creator);
+                INSERT INTO models_fts(rowid, name, description, model_creator) VALUES (new.id, new.name, new.description, new.model_creator);
+            END
+        ''')
+        cursor.execute("INSERT INTO models_fts(models_fts) VALUES ('rebuild')")
+
+    def sync(self)->bool:
+        """
+        Copies the source zoo database again if it changed since the last copy (zoo update).
+        A missing source gives an empty database.
 
+        Returns:
+            bool: True if the copy was refreshed
+        """
+        signature = json.dumps(path_signature(self.source))
+        with self.pool.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS source_infos (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM source_infos WHERE key='signature'").fetchone()
+            if row is not None and row[0]==signature:
+                return False
+            models, variants = self._read_source() if self.source.exists() else ([], [])
+            conn.execute("DELETE FROM variants")
+            conn.execute("DELETE FROM models")
+            conn.executemany(f"INSERT INTO models ({', '.join(MODEL_COLUMNS)}) VALUES ({', '.join('?'*len(MODEL_COLUMNS))})", models)
+            conn.executemany("INSERT INTO variants (id, model_id, name, size) VALUES (?, ?, ?, ?)", variants)
+            conn.execute("INSERT OR REPLACE INTO source_infos (key, value) VALUES ('signature', ?)", (signature,))
+        ASCIIColors.info(f"Models zoo {self.source.name} indexed ({len(models)} models)")
+        return True
+
+    def _read_source(self):
+        # mode=ro: nothing is ever written to the zoo clone, not even a journal
+        source = sqlite3.connect(f"{self.source.resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            # Zoos built before some columns existed
+            columns = [row[1] for row in source.execute("PRAGMA table_info(models)")]
+            selected = ", ".join(column if column in columns else "NULL" for column in MODEL_COLUMNS)
+            models = source.execute(f"SELECT {selected} FROM models").fetchall()
+            variants = source.execute("SELECT id, model_id, name, size FROM variants").fetchall()
+        finally:
+            source.close()
+        return models, variants
+
+
+    @staticmethod
+    def _entry_data(entry):
+        datasets = entry.get('datasets', [])
+        license = entry.get('license')
+        return (entry.get('category'), entry.get('icon'), ','.join(datasets) if type(datasets)==list else datasets, entry.get('last_commit_time'),
+                ','.join(license) if type(license)==list else license,
+                entry.get('model_creator'), entry.get('model_creator_link'), entry.get('name'),
+                entry.get('quantizer'), entry.get('ctx_size', 4096), entry.get('rank'), entry.get('type'), entry.get('description'))
 
     def add_entry(self, entry):
-        # Check if a model with the same name already exists
-        self.cursor.execute("SELECT id FROM models WHERE name=?", (entry.get('name'),))
-        model_id = self.cursor.fetchone()
-
-        if model_id is None:
-            datasets = entry.get('datasets', [])
-            license = entry.get('license')
-            # If the model does not exist, insert a new one
-            data = (entry.get('category'), entry.get('icon'), ','.join(datasets) if type(datasets)==list else datasets, entry.get('last_commit_time'),
-                    ','.join(license) if type(license)==list else license,                     
-                    entry.get('model_creator'), entry.get('model_creator_link'), entry.get('name'),
-                    entry.get('quantizer'), entry.get('ctx_size', 4096), entry.get('rank'), entry.get('type'))
-            self.cursor.execute('''INSERT INTO models VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', data)
-            model_id = self.cursor.lastrowid
-            # Insert the variants
-            for variant in entry.get('variants', []):
-                variant_name = variant.get('name')
-                variant_size = variant.get('size')
-                variant_data = (model_id, variant_name, variant_size)
-                self.cursor.execute('''INSERT INTO variants VALUES (NULL, ?, ?, ?)''', variant_data)
-        else:
-            ASCIIColors.warning(f"A duplicate of the model {entry.get('name')} has been detected")
-
-
-        self.conn.commit()
+        return self.add_entries([entry])
+
+    def add_entries(self, entries:List[Dict[str, Any]])->int:
+        """
+        Adds many models and their variants in a single transaction.
+        Models whose name is already in the database (or earlier in entries) are skipped.
+
+        Returns:
+            int: The number of added models
+        """
+        with self.pool.connection() as conn:
+            existing = {row[0] for row in conn.execute("SELECT name FROM models")}
+            new_entries = []
+            duplicates = 0
+            for entry in entries:
+                name = entry.get('name')
+                if name in existing:
+                    duplicates += 1
+                    continue
+                existing.add(name)
+                new_entries.append(entry)
+            if duplicates>0:
+                ASCIIColors.warning(f"{duplicates} duplicate models have been detected and skipped")
+            if len(new_entries)==0:
+                return 0
+            conn.executemany(
+                f"INSERT INTO models ({', '.join(MODEL_COLUMNS[1:])}) VALUES ({', '.join('?'*(len(MODEL_COLUMNS)-1))})",
+                [self._entry_data(entry) for entry in new_entries]
+            )
+            # Names are unique, they give back the ids of the inserted models
+            ids = {}
+            names = [entry.get('name') for entry in new_entries]
+            for start in range(0, len(names), 500):
+                chunk = names[start:start+500]
+                ids.update(conn.execute(f"SELECT name, id FROM models WHERE name IN ({','.join('?'*len(chunk))})", chunk).fetchall())
+            conn.executemany(
+                "INSERT INTO variants (model_id, name, size) VALUES (?, ?, ?)",
+                [
+                    (ids[entry.get('name')], variant.get('name'), variant.get('size'))
+                    for entry in new_entries for variant in (entry.get('variants') or [])
+                ]
+            )
+        return len(new_entries)
 
 
     def import_from_yaml(self, file_path):
         with open(file_path) as file:
             data = yaml.safe_load(file)
 
-        for entry in data:
-            self.add_entry(entry)
+        return self.add_entries(data or [])
 
+    @staticmethod
+    def _fts_query(text:str)->str:
+        # Every word is quoted (so that user input can't break the FTS5 syntax) and matches as a prefix
+        return " ".join('"'+word.replace('"', '""')+'"*' for word in text.split())
 
-    def query(self, n=None, model_types=None, variant_name=None, keyword=None):
-        query = "SELECT models.*, variants.name as variant_name, variants.size as variant_size FROM models LEFT JOIN variants ON models.id = variants.model_id WHERE 1=1"
+    def _model_from_row(self, row)->Dict[str, Any]:
+        model = dict(zip(MODEL_COLUMNS, row))
+        model["datasets"] = model["datasets"].split(',') if model["datasets"] is not None else None
+        model["variants"] = []
+        return model
+
+    def _add_variants(self, conn, models:List[Dict[str, Any]], variant_name:str=None):
+        by_id = {model["id"]: model for model in models}
+        ids = list(by_id.keys())
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            query = f"SELECT model_id, name, size FROM variants WHERE model_id IN ({','.join('?'*len(chunk))})"
+            params = list(chunk)
+            if variant_name:
+                query += " AND name=?"
+                params.append(variant_name)
+            for model_id, name, size in conn.execute(query+" ORDER BY id", params):
+                by_id[model_id]["variants"].append({"name": name, "size": size})
+
+    def search(self, text:str=None, model_types:List[str]=None, variant_name:str=None, limit:int=50, offset:int=0, sort_by:str="last_commit_time", name_contains:str=None)->Dict[str, Any]:
+        """
+        Searches the models one page at a time.
+
+        Args:
+            text (str, optional): Words to look for in the names, descriptions and creators (prefixes match).
+                The results are then ranked by relevance (bm25, names count most).
+            model_types (list, optional): Only return models of these types.
+            variant_name (str, optional): Only return the models having this variant (with this variant only).
+            limit (int): Page size (None for all).
+            offset (int): Number of models to skip.
+            sort_by (str): Order when no text is searched, one of SORT_FIELDS.
+            name_contains (str, optional): Only return models whose name contains this string (case insensitive).
+
+        Returns:
+            dict: {"models": [model dicts with their variants], "total": number of matching models}
+        """
+        joins = ""
+        conditions = []
         params = []
+        order = self.SORT_FIELDS.get(sort_by, self.SORT_FIELDS["last_commit_time"])
+        if text is not None and text.strip()!="":
+            joins = "JOIN models_fts ON models_fts.rowid = models.id"
+            conditions.append("models_fts MATCH ?")
+            params.append(self._fts_query(text))
+            order = "bm25(models_fts, 10.0, 1.0, 2.0)"
         if model_types:
-            query += " AND models.type IN (" + ", ".join("?" for _ in model_types) + ")"
+            conditions.append("models.type IN (" + ", ".join("?" for _ in model_types) + ")")
             params.extend(model_types)
         if variant_name:
-            query += " AND variants.name=?"
+            conditions.append("models.id IN (SELECT model_id FROM variants WHERE name=?)")
             params.append(variant_name)
-        if keyword:
-            query += " AND models.name LIKE ?"
-            params.append('%' + keyword + '%')
-        if n:
-            query += " ORDER BY models.last_commit_time DESC LIMIT ?"
-            params.append(n)
-        self.cursor.execute(query, params)
-        results = self.cursor.fetchall()
-
-        # Group the results by model id and convert the row to a dictionary
-        model_results = {}
-        for row in results:
-            model_id = row[0]
-            if model_id not in model_results:
-                model_results[model_id] = {
-                    "id": row[0],
-                    "category": row[1],
-                    "icon": row[2],
-                    "datasets": row[3].split(',') if row[3] is not None else None,
-                    "last_commit_time": row[4],
-                    "license": row[5],
-                    "model_creator": row[6],
-                    "model_creator_link": row[7],
-                    "name": row[8],
-                    "quantizer": row[9],
-                    "ctx_size": row[10],
-                    "rank": row[11],
-                    "type": row[12],
-                    "variants": []
-                }
-            model_results[model_id]["variants"].append({"name": row[13], "size": row[14]})
-
-        return list(model_results.values())
+        if name_contains:
+            conditions.append("models.name LIKE ?")
+            params.append('%' + name_contains + '%')
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions)>0 else ""
+        with self.pool.connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM models {joins} {where}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {', '.join('models.'+c for c in MODEL_COLUMNS)} FROM models {joins} {where} ORDER BY {order}, models.id LIMIT ? OFFSET ?",
+                params+[-1 if limit is None else limit, offset]
+            ).fetchall()
+            models = [self._model_from_row(row) for row in rows]
+            self._add_variants(conn, models, variant_name)
+        return {"models": models, "total": total}
+
+    def query(self, n=None, model_types=None, variant_name=None, keyword=None):
+        """Returns the models (with their variants), the n most recent ones if n is set, those whose name contains keyword if it is set"""
+        models = self.search(None, model_types, variant_name, limit=n or None, sort_by="last_commit_time", name_contains=keyword)["models"]
+        for model in models:
+            # Callers expect at least one (empty) variant, like the rows of the former LEFT JOIN
+            if len(model["variants"])==0:
+                model["variants"].append({"name": None, "size": None})
+        return models
 
 
 
 
     def remove_entry(self, model_name):
-        self.cursor.execute("DELETE FROM variants WHERE model_id IN (SELECT id FROM models WHERE name=?)", (model_name,))
-        self.cursor.execute("DELETE FROM models WHERE name=?", (model_name,))
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM variants WHERE model_id IN (SELECT id FROM models WHERE name=?)", (model_name,))
+            conn.execute("DELETE FROM models WHERE name=?", (model_name,))
+
+    def close(self):
+        self.pool.close_all()
 
 
 def main():
@@ -1,17 +1,33 @@
+import math
 import sqlite3
-from lollmsvectordb import VectorDatabase, TFIDFVectorizer
-from lollmsvectordb.lollms_tokenizers.tiktoken_tokenizer import TikTokenTokenizer
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from ascii_colors import ASCIIColors, trace_exception
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+from lollms.databases.skills_vector_index import SkillsVectorIndex
 class SkillsLibrary:
         
     def __init__(self, db_path, chunk_size:int=512, overlap:int=0, n_neighbors:int=5, config=None):
         self.db_path =db_path
         self.config = config
+        self.n_neighbors = n_neighbors
+        # One long lived connection per thread instead of a new connection per call
+        self.pool = SQLiteConnectionPool(self.db_path)
         self._initialize_db()
-        from lollmsvectordb.lollms_tokenizers.tiktoken_tokenizer import TikTokenTokenizer
-        self.config = config
-        if config is not None:
+        # The skills vectors are stored in the database, the vectorizer is only loaded when a skill must be vectorized
+        self.vector_index = SkillsVectorIndex(self.pool, self.get_vectorizer_id(), self._create_vectorizer)
+        # Runs the vector search of hybrid queries next to the full text search
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="skills_search")
+
+    def get_vectorizer_id(self):
+        if self.config is not None:
+            if self.config.rag_vectorizer == "semantic":
+                return f"semantic:{self.config.rag_vectorizer_model}"
+            return self.config.rag_vectorizer
+        return "semantic:BAAI/bge-m3"
+
+    def _create_vectorizer(self):
+        if self.config is not None:
             vectorizer = self.config.rag_vectorizer
             if vectorizer == "semantic":
                 from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
@@ -25,247 +41,360 @@ class SkillsLibrary:
         else:
             from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
             v = SemanticVectorizer("BAAI/bge-m3")
-
-        self.vectorizer = VectorDatabase("", v, TikTokenTokenizer(),chunk_size, overlap, n_neighbors)
         ASCIIColors.green("Vecorizer ready")
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("SELECT * FROM skills_library")
-        res = cursor.fetchall()
-        try:
-            for entry in res:
-                self.vectorizer.add_document(entry[3], entry[4], "",True, category_id=entry[2])
-            self.vectorizer.build_index()    
-            cursor.close()
-            conn.close()
-        except Exception as ex:
-            trace_exception(ex)
-                   
+        return v
+
 
     def _initialize_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS skills_library (
+                    id INTEGER PRIMARY KEY,
+                    version INTEGER,
+                    category TEXT,
+                    title TEXT,
+                    content TEXT
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS db_info (
+                    version INTEGER
+                )
+            """)
+            cursor.execute("SELECT version FROM db_info")
+            version = cursor.fetchone()
+            if version is None:
+                cursor.execute("INSERT INTO db_info (version) VALUES (1)")
+                version = (1,)
+            # New databases go through the migrations too, so that every database of a version has the same schema
+            # (before, they only got the version 2 column new_column on their second opening)
+            self._migrate_db(cursor, version[0])
+
+    def _create_fts_table(self, cursor):
+        """
+        Creates the skills_library_fts full text index (version 3 of the schema).
+        It is an external content FTS5 table over the skills kept in sync by triggers.
+        Older databases had a standalone table that was never filled, it is replaced and backfilled.
+        """
+        cursor.execute("DROP TABLE IF EXISTS skills_library_fts")
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS skills_library (
-                id INTEGER PRIMARY KEY,
-                version INTEGER,
-                category TEXT,
-                title TEXT,
-                content TEXT
-            )
+            CREATE VIRTUAL TABLE skills_library_fts USING fts5(category, title, content, content='skills_library', content_rowid='id')
         """)
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS db_info (
-                version INTEGER
-            )
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_insert AFTER INSERT ON skills_library BEGIN
+                INSERT INTO skills_library_fts(rowid, category, title, content) VALUES (new.id, new.category, new.title, new.content);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_delete AFTER DELETE ON skills_library BEGIN
+                INSERT INTO skills_library_fts(skills_library_fts, rowid, category, title, content) VALUES ('delete', old.id, old.category, old.title, old.content);
+            END
         """)
-        cursor.execute("SELECT version FROM db_info")
-        version = cursor.fetchone()
-        self._create_fts_table()  # Create FTS table after initializing the database
-        if version is None:
-            cursor.execute("INSERT INTO db_info (version) VALUES (1)")
-            conn.commit()
-            cursor.close()
-            conn.close()
-        else:
-            cursor.close()
-            conn.close()
-            self._migrate_db(version[0])
-
-    def _create_fts_table(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         cursor.execute("""
-            CREATE VIRTUAL TABLE IF NOT EXISTS skills_library_fts USING fts5(category, title, content)
+            CREATE TRIGGER IF NOT EXISTS skills_library_fts_update AFTER UPDATE OF category, title, content ON skills_library BEGIN
+                INSERT INTO skills_library_fts(skills_library_fts, rowid, category, title, content) VALUES ('delete', old.id, old.category, old.title, old.content);
+                INSERT INTO skills_library_fts(rowid, category, title, content) VALUES (new.id, new.category, new.title, new.content);
+            END
         """)
-        conn.commit()
-        cursor.close()
-        conn.close()
+        cursor.execute("INSERT INTO skills_library_fts(skills_library_fts) VALUES ('rebuild')")
 
-    def _migrate_db(self, version):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
+    def _migrate_db(self, cursor, version):
         # Perform migrations based on the current version
-        # For example, if the current version is 1 and the latest version is 2:
         if version < 2:
             cursor.execute("ALTER TABLE skills_library ADD COLUMN new_column TEXT")
             cursor.execute("UPDATE db_info SET version = 2")
-            conn.commit()
-        cursor.close()
-        conn.close()
+        if version < 3:
+            ASCIIColors.yellow("Indexing the skills library")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_skills_library_category ON skills_library (category, title)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_skills_library_title ON skills_library (title)")
+            self._create_fts_table(cursor)
+            cursor.execute("UPDATE db_info SET version = 3")
 
-    def _create_table(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS skills_library (
-                id INTEGER PRIMARY KEY,
-                version INTEGER,
-                category TEXT,
-                title TEXT,
-                content TEXT
-            )
-        """)
-        conn.commit()
-        cursor.close()
-        conn.close()
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.pool.close_all()
 
     def add_entry(self, version, category, title, content):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("""
-            INSERT INTO skills_library (version, category, title, content) 
-            VALUES (?, ?, ?, ?)
-        """, (version, category, title, content))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        self.vectorizer.add_document(title, content, "",True)
-        self.vectorizer.build_index()
-
-    def list_entries(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("SELECT * FROM skills_library")
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return res
-    
-    def query_entry(self, text):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("""
-            SELECT * FROM skills_library 
-            WHERE category LIKE ? OR title LIKE ? OR content LIKE ?
-        """, (f'%{text}%', f'%{text}%', f'%{text}%'))
-        res= cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return res
+        with self.pool.connection() as conn:
+            skill_id = conn.execute("""
+                INSERT INTO skills_library (version, category, title, content) 
+                VALUES (?, ?, ?, ?)
+            """, (version, category, title, content)).lastrowid
+        self.vector_index.add(skill_id, title, content)
+        return skill_id
+
+    def add_entries(self, entries):
+        """Adds many (version, category, title, content) entries in one transaction.
+        They are vectorized in batches on the next vector search.
+        """
+        with self.pool.connection() as conn:
+            count = conn.executemany("""
+                INSERT INTO skills_library (version, category, title, content) 
+                VALUES (?, ?, ?, ?)
+            """, [tuple(entry) for entry in entries]).rowcount
+        self.vector_index.mark_stale()
+        return count
+
+    def list_entries(self, limit:int=None, offset:int=0):
+        with self.pool.connection() as conn:
+            if limit is None:
+                return conn.execute("SELECT * FROM skills_library ORDER BY id").fetchall()
+            return conn.execute("SELECT * FROM skills_library ORDER BY id LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+
+    @staticmethod
+    def _fts_query(text:str, prefix:bool=False)->str:
+        # Every word is quoted so that user input can't break the FTS5 query syntax
+        return " ".join('"'+word.replace('"', '""')+'"'+("*" if prefix else "") for word in text.split())
+
+    def query_entry(self, text, limit:int=None, offset:int=0):
+        """Returns the skills containing all the words of text (word prefixes match too), best matches first"""
+        query = self._fts_query(text, prefix=True)
+        if query=="":
+            return []
+        with self.pool.connection() as conn:
+            return conn.execute("""
+                SELECT s.* FROM skills_library_fts f
+                JOIN skills_library s ON s.id = f.rowid
+                WHERE skills_library_fts MATCH ?
+                ORDER BY f.rank LIMIT ? OFFSET ?
+            """, (query, -1 if limit is None else limit, offset)).fetchall()
     
-    def query_entry_fts(self, text):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT * FROM skills_library_fts WHERE skills_library_fts MATCH ?"
-        cursor.execute(query, (text,))
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return res
+    def query_entry_fts(self, text, limit:int=None, offset:int=0):
+        """Runs an FTS5 query (operators, prefixes, NEAR...) and returns the (category, title, content) of the matches, best first"""
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "SELECT category, title, content FROM skills_library_fts WHERE skills_library_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                (text, -1 if limit is None else limit, offset)
+            ).fetchall()
 
-    def query_vector_db(self, query_, top_k=3, min_similarity=0):
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
+    def query_bm25(self, text, top_k=20, min_coverage=0.5):
+        """
+        Keyword search ranked by bm25 (matches in titles count double).
+        Any of the words can match, skills containing more of them (and rarer ones) rank first.
+        Skills matching too little of the query are dropped (see _keywords_coverage), so that
+        sharing one common word with the query is not enough to be retrieved.
+
+        Args:
+            min_coverage (float): Minimum share of the query information (idf weighted words) a skill must contain, 0 to keep every match.
+
+        Returns:
+            list: (skill_id, bm25 score) pairs, best first
+        """
+        words = list(dict.fromkeys(word for word in text.split() if len(word)>1))
+        if len(words)==0:
+            return []
+        query = " OR ".join(self._fts_query(word) for word in words)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT rowid, bm25(skills_library_fts, 1.0, 2.0, 1.0) AS score FROM skills_library_fts WHERE skills_library_fts MATCH ? ORDER BY score LIMIT ?",
+                (query, top_k*4 if min_coverage>0 else top_k)
+            ).fetchall()
+            if min_coverage>0 and len(rows)>0:
+                coverage = self._keywords_coverage(conn, words, [r[0] for r in rows])
+                rows = [r for r in rows if coverage.get(r[0], 0)>=min_coverage]
+        return [(r[0], -r[1]) for r in rows[:top_k]]
+
+    def _keywords_coverage(self, conn, words, skill_ids):
+        """
+        Returns, for each skill, the share of the query words it contains, each word weighted by its idf.
+        Words contained by no skill or by more than half of them are ignored (they can't tell skills apart),
+        so a query made of common words only covers nothing.
+        """
+        nb_skills = conn.execute("SELECT COUNT(*) FROM skills_library").fetchone()[0]
+        placeholders = ",".join("?"*len(skill_ids))
+        matched = {skill_id: 0 for skill_id in skill_ids}
+        total = 0
+        for word in words:
+            query = self._fts_query(word)
+            nb_matches = conn.execute("SELECT COUNT(*) FROM skills_library_fts WHERE skills_library_fts MATCH ?", (query,)).fetchone()[0]
+            if nb_matches==0 or nb_matches>nb_skills/2:
+                continue
+            idf = math.log((nb_skills-nb_matches+0.5)/(nb_matches+0.5)+1)
+            total += idf
+            for (skill_id,) in conn.execute(f"SELECT rowid FROM skills_library_fts WHERE skills_library_fts MATCH ? AND rowid IN ({placeholders})", [query]+list(skill_ids)):
+                matched[skill_id] += idf
+        return {skill_id: score/total if total>0 else 0 for skill_id, score in matched.items()}
+
+    def query_hybrid(self, query_, top_k=3, min_similarity=0, candidates=None, rrf_k=60, time_budget_ms=300, bm25_weight=1.0, vector_weight=1.0, min_keywords_coverage=0.5):
+        """
+        Hybrid retrieval: the bm25 keyword search and the vector search run together and their rankings
+        are merged with reciprocal rank fusion (score = sum of weight/(rrf_k+rank) over the rankings).
+        Skills found by both searches come first, exact keywords are not missed by the embeddings and
+        paraphrases are not missed by the keywords.
+        Each search filters its own weak results before the fusion: vector results must be over min_similarity
+        and keyword results must contain min_keywords_coverage of the query (see query_bm25).
+        If the vector search doesn't answer within time_budget_ms (for example while the vectorizer loads),
+        the keyword results are used alone.
+
+        Args:
+            candidates (int): Number of results taken from each search before fusion (2*top_k by default).
+                Long candidate lists let mediocre results found by both searches push out the best result of one of them.
+            min_similarity (float): Vector results below this cosine similarity are ignored.
+            min_keywords_coverage (float): Keyword results containing less of the query are ignored.
+
+        Returns:
+            tuple: (titles, contents, fused scores) of the top_k skills, best first.
+                The fused scores are reciprocal rank fusion scores, not similarities (see query_details).
+        """
+        details = self._query_hybrid(query_, top_k, min_similarity, candidates, rrf_k, time_budget_ms, bm25_weight, vector_weight, min_keywords_coverage)
+        return self._to_titles_and_contents([(skill_id, score) for skill_id, score, _ in details])
+
+    def _query_hybrid(self, query_, top_k, min_similarity, candidates, rrf_k, time_budget_ms, bm25_weight, vector_weight, min_keywords_coverage):
+        """Returns the fused (skill_id, rrf score, cosine similarity or None) of the top_k skills"""
+        start = time.perf_counter()
+        candidates = candidates or 2*top_k
+        vector_future = self._executor.submit(self.vector_index.search, query_, candidates)
+        rankings = []
+        similarities = {}
+        try:
+            rankings.append((bm25_weight, [skill_id for skill_id, _ in self.query_bm25(query_, candidates, min_keywords_coverage)]))
+        except Exception as ex:
+            trace_exception(ex)
+        try:
+            remaining = None if time_budget_ms is None else max(0, time_budget_ms/1000-(time.perf_counter()-start))
+            vector_results = vector_future.result(timeout=remaining)
+            similarities = dict(vector_results)
+            rankings.append((vector_weight, [skill_id for skill_id, similarity in vector_results if similarity>min_similarity]))
+        except FutureTimeoutError:
+            ASCIIColors.warning("Skills vector search is over its time budget, using the keyword search only")
+        except Exception as ex:
+            trace_exception(ex)
+
+        scores = {}
+        for weight, ranking in rankings:
+            for rank, skill_id in enumerate(ranking):
+                scores[skill_id] = scores.get(skill_id, 0)+weight/(rrf_k+rank+1)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(skill_id, score, similarities.get(skill_id)) for skill_id, score in best]
+
+    def query(self, query_, top_k=3, min_similarity=0, method="hybrid", time_budget_ms=300):
+        """
+        Retrieves skills with one of the methods: hybrid (query_hybrid), vector (query_vector_db) or keywords (query_bm25)
+
+        Returns:
+            tuple: (titles, contents, scores), best first. The kind of score depends on the method (see query_details).
+        """
+        details = self.query_details(query_, top_k, min_similarity, method, time_budget_ms)
+        return [d["title"] for d in details], [d["content"] for d in details], [d["score"] for d in details]
+
+    def query_details(self, query_, top_k=3, min_similarity=0, method="hybrid", time_budget_ms=300):
+        """
+        Same as query, with the scores labeled.
+
+        Returns:
+            list: [{"title", "content", "score", "score_type", "similarity"}], best first.
+                score_type is "rrf" (hybrid), "cosine" (vector) or "bm25" (keywords).
+                similarity is the cosine similarity with the query when the vector search computed it, None otherwise.
+        """
+        if method=="vector":
+            results = [(skill_id, similarity, similarity) for skill_id, similarity in self.vector_index.search(query_, top_k) if similarity>min_similarity]
+            score_type = "cosine"
+        elif method=="keywords":
+            results = [(skill_id, score, None) for skill_id, score in self.query_bm25(query_, top_k)]
+            score_type = "bm25"
+        else:
+            results = self._query_hybrid(
+                query_, top_k, min_similarity, None, 60, time_budget_ms if time_budget_ms and time_budget_ms>0 else None, 1.0, 1.0, 0.5
+            )
+            score_type = "rrf"
+        similarities = {skill_id: similarity for skill_id, _, similarity in results}
+        titles, contents, scores = self._to_titles_and_contents([(skill_id, score) for skill_id, score, _ in results])
+        ids = [skill_id for skill_id, _, _ in results]
+        return [
+            {"title": title, "content": content, "score": score, "score_type": score_type, "similarity": similarities.get(skill_id)}
+            for skill_id, title, content, score in zip(ids, titles, contents, scores)
+        ]
+
+    def _to_titles_and_contents(self, results):
+        """Turns (skill_id, score) pairs into the (titles, contents, scores) lists returned by the queries"""
         skills = []
-        similarities = []
-        skill_titles = []        
-        chunks = self.vectorizer.search(query_, top_k)
-        for chunk in chunks:
-            if  1-chunk.distance>min_similarity:
-                skills.append(chunk.text)
-                similarities.append(1-chunk.distance)
-                skill_titles.append(chunk.doc.title)
-            
-        return skill_titles, skills, similarities
+        scores = []
+        skill_titles = []
+        if len(results)==0:
+            return skill_titles, skills, scores
+        with self.pool.connection() as conn:
+            rows = conn.execute(f"SELECT id, title, content FROM skills_library WHERE id IN ({','.join('?'*len(results))})", [skill_id for skill_id, _ in results]).fetchall()
+        entries = {r[0]:(r[1], r[2]) for r in rows}
+        for skill_id, score in results:
+            if skill_id in entries:
+                skill_titles.append(entries[skill_id][0])
+                skills.append(entries[skill_id][1])
+                scores.append(score)
+        return skill_titles, skills, scores
+
+    def query_vector_db(self, query_, top_k=3, min_similarity=0):
+        results = [(skill_id, similarity) for skill_id, similarity in self.vector_index.search(query_, top_k) if similarity>min_similarity]
+        return self._to_titles_and_contents(results)
 
     
-    def dump(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT * FROM skills_library"
-        cursor.execute(query)
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
+    def dump(self, limit:int=None, offset:int=0):
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT id, version, category, title FROM skills_library ORDER BY id LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset)).fetchall()
         return [[r[0], r[1], r[2], r[3]] for r in res]
 
+    def list_skills(self, category:str=None, title:str=None, limit:int=50, offset:int=0):
+        """
+        Lists the skills (without their content) sorted by title, one page at a time.
+
+        Args:
+            category (str, optional): Only list the skills of this category.
+            title (str, optional): Only list the skills whose title contains all these words (full text search).
+
+        Returns:
+            dict: {"skills": [{"id", "category", "title"}], "total": number of matching skills}
+        """
+        conditions = []
+        params = []
+        if category is not None:
+            conditions.append("s.category = ?")
+            params.append(category)
+        if title is not None and title.strip()!="":
+            conditions.append("s.id IN (SELECT rowid FROM skills_library_fts WHERE skills_library_fts MATCH ?)")
+            params.append("title : ("+self._fts_query(title, prefix=True)+")")
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions)>0 else ""
+        with self.pool.connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM skills_library s {where}", params).fetchone()[0]
+            rows = conn.execute(f"SELECT s.id, s.category, s.title FROM skills_library s {where} ORDER BY s.title, s.id LIMIT ? OFFSET ?", params+[limit, offset]).fetchall()
+        return {"skills":[{"id":r[0], "category":r[1], "title":r[2]} for r in rows], "total":total}
+
     def get_categories(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT category FROM skills_library"
-        cursor.execute(query)
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return list(set([r[0] for r in res]))
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT DISTINCT category FROM skills_library ORDER BY category").fetchall()
+        return [r[0] for r in res]
     
    
-    def get_titles(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT id, title FROM skills_library"
-        cursor.execute(query)
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
+    def get_titles(self, limit:int=None, offset:int=0):
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT id, title FROM skills_library ORDER BY title, id LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset)).fetchall()
         return [{"id":r[0], "title":r[1]} for r in res]
 
-    def get_titles_by_category(self, category):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT id, title FROM skills_library WHERE category=?"
-        cursor.execute(query,(category,))
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
+    def get_titles_by_category(self, category, limit:int=None, offset:int=0):
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT id, title FROM skills_library WHERE category=? ORDER BY title, id LIMIT ? OFFSET ?", (category, -1 if limit is None else limit, offset)).fetchall()
         return [{"id":r[0], "title":r[1]} for r in res]
 
     def get_content(self, id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT content FROM skills_library WHERE id = ?"
-        cursor.execute(query, (id,))
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT content FROM skills_library WHERE id = ?", (id,)).fetchall()
         return [r[0] for r in res]
 
     def get_skill(self, id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "SELECT id, category, title, content FROM skills_library WHERE id = ?"
-        cursor.execute(query, (id,))
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            res = conn.execute("SELECT id, category, title, content FROM skills_library WHERE id = ?", (id,)).fetchall()
         return [{"id":r[0], "category":r[1], "title":r[2], "content":r[3]} for r in res]
 
     def update_skill(self, id, category, title, content):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Use direct string concatenation for the MATCH expression.
-        # Ensure text is safely escaped to avoid SQL injection.
-        query = "UPDATE skills_library SET category=?, title=?, content=? WHERE id = ?"
-        cursor.execute(query, (category,title,content))
-        res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return [{"id":r[0], "category":r[1], "title":r[2], "content":r[3]} for r in res]
+        with self.pool.connection() as conn:
+            conn.execute("UPDATE skills_library SET category=?, title=?, content=? WHERE id = ?", (category,title,content,id))
+        self.vector_index.add(id, title, content)
+        return self.get_skill(id)
 
 
     def remove_entry(self, id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()        
-        cursor.execute("DELETE FROM skills_library WHERE id = ?", (id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        self.vectorizer.remove_document_by_id(id)
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM skills_library WHERE id = ?", (id,))
+        self.vector_index.remove(id)
 
     def export_entries(self, file_path):
         with open(file_path, 'w') as f:
@@ -280,7 +409,8 @@ class SkillsLibrary:
 
     def fuse_with_another_db(self, other_db_path):
         other_conn = sqlite3.connect(other_db_path)
-        other_cursor = other_conn.cursor()
-        other_cursor.execute("SELECT * FROM skills_library")
-        for row in other_cursor.fetchall():
-            self.add_entry(*row[1:])  # skip the id column
+        try:
+            rows = other_conn.execute("SELECT version, category, title, content FROM skills_library").fetchall()
+        finally:
+            other_conn.close()
+        return self.add_entries(rows)
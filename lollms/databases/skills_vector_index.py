@@ -0,0 +1,271 @@
+"""
+project: lollms
+file: skills_vector_index.py
+author: ParisNeo
+description:
+    Persistent vector index of the skills library.
+    The vector of each skill is stored next to it in the skills database (skills_vectors table),
+    so starting lollms only opens the file: nothing is vectorized again. Adding, editing or removing
+    a skill updates its vector, and sqlite triggers drop the vector of a skill modified by anything
+    else (fusing libraries, external tools) so that it gets vectorized again on the next search.
+    Changing the vectorizer invalidates the stored vectors, they are rebuilt on the next search.
+    The vectorizer itself is only loaded when a vector is needed.
+    Vectorizers fitted on the library (tfidf) have their fitted state (vocabulary and idf) stored
+    with the vectors, so they are not fitted again, and the library not vectorized again, on each start.
+"""
+import json
+import threading
+from typing import Callable, Dict, Any, List, Tuple
+import numpy as np
+from ascii_colors import ASCIIColors, trace_exception
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+def skill_text(title:str, content:str)->str:
+    """The text that is vectorized for a skill"""
+    return f"{title or ''}\n{content or ''}"
+
+
+class SkillsVectorIndex:
+    """
+    Vectors of the skills of a skills library database.
+
+    Args:
+        pool (SQLiteConnectionPool): The connections of the skills library database.
+        vectorizer_id (str): Identifies the vectorizer (kind and model), the stored vectors are dropped when it changes.
+        vectorizer_factory (Callable): Builds the lollmsvectordb vectorizer, called on first use.
+        batch_size (int): Number of skills vectorized at once when catching up.
+    """
+    def __init__(self, pool:SQLiteConnectionPool, vectorizer_id:str, vectorizer_factory:Callable, batch_size:int=32):
+        self.pool = pool
+        self.vectorizer_id = vectorizer_id
+        self.vectorizer_factory = vectorizer_factory
+        self.batch_size = batch_size
+        self._vectorizer = None
+        self._lock = threading.RLock()
+        # skill id -> row of the matrix
+        self._positions:Dict[int, int] = {}
+        self._ids:List[int] = []
+        self._vectors:List[np.ndarray] = []
+        self._matrix:np.ndarray = None
+        self._loaded = False
+        # Set when skills were added without being vectorized (bulk imports)
+        self._stale = False
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.pool.connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS skills_vectors (
+                    skill_id INTEGER PRIMARY KEY,
+                    vector BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS skills_vectors_info (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TRIGGER IF NOT EXISTS skills_vectors_invalidate AFTER UPDATE OF title, content ON skills_library
+                WHEN old.title IS NOT new.title OR old.content IS NOT new.content
+                BEGIN
+                    DELETE FROM skills_vectors WHERE skill_id = old.id;
+                END;
+                CREATE TRIGGER IF NOT EXISTS skills_vectors_delete AFTER DELETE ON skills_library
+                BEGIN
+                    DELETE FROM skills_vectors WHERE skill_id = old.id;
+                END;
+            """)
+            row = conn.execute("SELECT value FROM skills_vectors_info WHERE key='vectorizer'").fetchone()
+            if row is None or row[0]!=self.vectorizer_id:
+                if row is not None:
+                    ASCIIColors.warning(f"Skills vectorizer changed ({row[0]} -> {self.vectorizer_id}), the skills will be vectorized again")
+                conn.execute("DELETE FROM skills_vectors")
+                conn.execute("DELETE FROM skills_vectors_info WHERE key='fit_state'")
+                conn.execute("INSERT OR REPLACE INTO skills_vectors_info (key, value) VALUES ('vectorizer', ?)", (self.vectorizer_id,))
+
+    @property
+    def vectorizer(self):
+        if self._vectorizer is None:
+            with self._lock:
+                if self._vectorizer is None:
+                    self._vectorizer = self.vectorizer_factory()
+        return self._vectorizer
+
+    def _vectorize(self, texts:List[str])->List[np.ndarray]:
+        vectors = self.vectorizer.vectorize(texts)
+        return [np.asarray(vector, dtype=np.float32).reshape(-1) for vector in vectors]
+
+    def _fit_if_needed(self):
+        """
+        Vectorizers like tfidf are fitted on the library, their vectors are only valid for this fit.
+        The fitted state is stored with the vectors and restored on the next start. Vectorizers whose
+        state can't be stored (no vocab and idf attributes) are fitted again, and the library vectorized again, on each start.
+        """
+        vectorizer = self.vectorizer
+        if not getattr(vectorizer, "requires_fitting", False) or getattr(vectorizer, "fitted", False):
+            return
+        if self._restore_fit_state(vectorizer):
+            return
+        with self.pool.connection() as conn:
+            texts = [skill_text(title, content) for title, content in conn.execute("SELECT title, content FROM skills_library")]
+            conn.execute("DELETE FROM skills_vectors")
+            conn.execute("DELETE FROM skills_vectors_info WHERE key='fit_state'")
+        if len(texts)>0:
+            vectorizer.fit(texts)
+            self._store_fit_state(vectorizer)
+        self._clear()
+
+    def _store_fit_state(self, vectorizer):
+        if not (hasattr(vectorizer, "vocab") and hasattr(vectorizer, "idf")):
+            ASCIIColors.warning("The fitted state of this vectorizer can't be stored, the skills will be vectorized again on next start")
+            return
+        state = json.dumps({"vocab": vectorizer.vocab, "idf": np.asarray(vectorizer.idf, dtype=np.float64).tolist()})
+        with self.pool.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO skills_vectors_info (key, value) VALUES ('fit_state', ?)", (state,))
+
+    def _restore_fit_state(self, vectorizer)->bool:
+        if not (hasattr(vectorizer, "vocab") and hasattr(vectorizer, "idf")):
+            return False
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM skills_vectors_info WHERE key='fit_state'").fetchone()
+        if row is None:
+            return False
+        try:
+            state = json.loads(row[0])
+            vectorizer.vocab = state["vocab"]
+            vectorizer.idf = np.asarray(state["idf"], dtype=np.float64)
+            vectorizer.fitted = True
+            return True
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.warning("Couldn't restore the fitted state of the skills vectorizer, it will be fitted again")
+            return False
+
+    def _clear(self):
+        self._positions = {}
+        self._ids = []
+        self._vectors = []
+        self._matrix = None
+
+    def _set(self, skill_id:int, vector:np.ndarray):
+        # Vectors are kept normalized so that a dot product is a cosine similarity
+        norm = np.linalg.norm(vector)
+        vector = vector/norm if norm>0 else vector
+        position = self._positions.get(skill_id)
+        if position is None:
+            self._positions[skill_id] = len(self._ids)
+            self._ids.append(skill_id)
+            self._vectors.append(vector)
+        else:
+            self._vectors[position] = vector
+        self._matrix = None
+
+    def _unset(self, skill_id:int):
+        position = self._positions.pop(skill_id, None)
+        if position is None:
+            return
+        # The last row takes the place of the removed one
+        last_id = self._ids.pop()
+        last_vector = self._vectors.pop()
+        if last_id!=skill_id:
+            self._ids[position] = last_id
+            self._vectors[position] = last_vector
+            self._positions[last_id] = position
+        self._matrix = None
+
+    def load(self):
+        """Loads the stored vectors and vectorizes the skills that have none (new, modified or after a vectorizer change)"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._fit_if_needed()
+            with self.pool.connection() as conn:
+                for skill_id, blob in conn.execute("SELECT skill_id, vector FROM skills_vectors"):
+                    self._set(skill_id, np.frombuffer(blob, dtype=np.float32))
+            self._loaded = True
+            self.catch_up()
+
+    def catch_up(self)->int:
+        """Vectorizes the skills without a stored vector, returns their number"""
+        with self._lock:
+            with self.pool.connection() as conn:
+                missing = conn.execute("""
+                    SELECT s.id, s.title, s.content FROM skills_library s
+                    LEFT JOIN skills_vectors v ON v.skill_id = s.id
+                    WHERE v.skill_id IS NULL
+                """).fetchall()
+            if len(missing)==0:
+                return 0
+            ASCIIColors.info(f"Vectorizing {len(missing)} skills")
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start:start+self.batch_size]
+                vectors = self._vectorize([skill_text(title, content) for _, title, content in batch])
+                self._store([(skill_id, vector) for (skill_id, _, _), vector in zip(batch, vectors)])
+            return len(missing)
+
+    def _store(self, vectors:List[Tuple[int, np.ndarray]]):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO skills_vectors (skill_id, vector) VALUES (?, ?)",
+                [(skill_id, vector.tobytes()) for skill_id, vector in vectors]
+            )
+        for skill_id, vector in vectors:
+            self._set(skill_id, vector)
+
+    def add(self, skill_id:int, title:str, content:str):
+        """Vectorizes a new or modified skill"""
+        with self._lock:
+            if not self._loaded:
+                # Picked up by the catch up of the first search
+                return
+            try:
+                self._store([(skill_id, self._vectorize([skill_text(title, content)])[0])])
+            except Exception as ex:
+                trace_exception(ex)
+                ASCIIColors.warning(f"Couldn't vectorize skill {skill_id}, it will be done on next search")
+
+    def mark_stale(self):
+        """Tells the index that skills were added in bulk, they are vectorized on the next search"""
+        self._stale = True
+
+    def remove(self, skill_id:int):
+        """Forgets a removed skill (its stored vector is removed by the database trigger)"""
+        with self._lock:
+            self._unset(skill_id)
+
+    def search(self, query:str, top_k:int=3)->List[Tuple[int, float]]:
+        """
+        Returns the (skill_id, cosine similarity) of the top_k skills closest to the query, best first
+        """
+        with self._lock:
+            self.load()
+            if self._stale:
+                self._stale = False
+                self.catch_up()
+            if len(self._ids)==0:
+                return []
+            if self._matrix is None:
+                self._matrix = np.vstack(self._vectors)
+            matrix = self._matrix
+            ids = list(self._ids)
+        query_vector = self._vectorize([query])[0]
+        norm = np.linalg.norm(query_vector)
+        if norm>0:
+            query_vector = query_vector/norm
+        similarities = matrix@query_vector
+        top_k = min(top_k, len(ids))
+        best = np.argpartition(-similarities, top_k-1)[:top_k]
+        best = best[np.argsort(-similarities[best])]
+        return [(ids[i], float(similarities[i])) for i in best]
+
+    def get_stats(self)->Dict[str, Any]:
+        return {
+            "vectorizer": self.vectorizer_id,
+            "vectorizer_loaded": self._vectorizer is not None,
+            "loaded": self._loaded,
+            "vectors": len(self._ids)
+        }
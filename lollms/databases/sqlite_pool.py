@@ -0,0 +1,196 @@
+"""
+project: lollms
+file: sqlite_pool.py
+author: ParisNeo
+description:
+    A small per database connection manager for sqlite.
+    Each thread gets its own long lived connection (sqlite connections can't be shared
+    between threads safely) configured with WAL journaling and a set of tuned pragmas.
+    Statements are cached by the sqlite3 module itself (cached_statements), so reusing
+    the same connection also reuses the prepared statements.
+"""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any
+from ascii_colors import ASCIIColors, trace_exception
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",          # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",        # safe with WAL, much faster than FULL
+    "temp_store": "MEMORY",
+    "cache_size": -16000,           # 16MB of page cache per connection
+    "mmap_size": 268435456,         # 256MB memory mapped io
+    "busy_timeout": 5000,           # wait up to 5s on a locked database
+}
+
+
+class SQLiteConnectionPool:
+    """
+    Keeps one long lived connection per thread for a single database file.
+
+    Usage:
+        pool = SQLiteConnectionPool(path)
+        with pool.connection() as conn:
+            conn.execute(...)
+    The context manager commits on success and rolls back on exception, but the
+    connection itself stays open for the next call from the same thread.
+    """
+    def __init__(self, db_path, pragmas:Dict[str, Any]=None, cached_statements:int=256, timeout:float=30):
+        self.db_path = Path(db_path)
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas is not None:
+            self.pragmas.update(pragmas)
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # thread -> connection, used to close everything and to drop connections of dead threads
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        # Number of connection() blocks running and time of the last one, used to close idle pools
+        self._active = 0
+        self.last_used = time.monotonic()
+        self._stats = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "connections_reused": 0,
+            "queries": 0,
+            "commits": 0,
+            "rollbacks": 0,
+            "busy_time": 0.0,
+        }
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+                                str(self.db_path),
+                                timeout=self.timeout,
+                                cached_statements=self.cached_statements,
+                                check_same_thread=False
+                            )
+        for name, value in self.pragmas.items():
+            try:
+                conn.execute(f"PRAGMA {name}={value}")
+            except sqlite3.DatabaseError as ex:
+                ASCIIColors.warning(f"Couldn't set pragma {name} on {self.db_path}: {ex}")
+        return conn
+
+    def _prune_dead_threads(self):
+        # Called with the lock held
+        dead = [t for t in self._connections if not t.is_alive()]
+        for t in dead:
+            conn = self._connections.pop(t)
+            try:
+                conn.close()
+            except Exception as ex:
+                trace_exception(ex)
+            self._stats["connections_closed"] += 1
+
+    def open_connection(self) -> sqlite3.Connection:
+        """
+        Opens a dedicated connection configured like the pooled ones but not owned by the pool.
+        Useful for long running reads (streaming exports) that may be consumed from several threads.
+        The caller is responsible for closing it.
+        """
+        conn = self._open()
+        self._stats["connections_opened"] += 1
+        return conn
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Returns the connection owned by the calling thread, opening it if needed"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._stats["connections_reused"] += 1
+            return conn
+        conn = self._open()
+        self._local.conn = conn
+        with self._lock:
+            self._prune_dead_threads()
+            self._connections[threading.current_thread()] = conn
+            self._stats["connections_opened"] += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields the thread connection and commits when the block exits.
+        On exception the pending transaction is rolled back and the exception re-raised.
+        """
+        with self._lock:
+            self._active += 1
+        conn = self.get_connection()
+        start = time.perf_counter()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+                self._stats["commits"] += 1
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+                self._stats["rollbacks"] += 1
+            raise
+        finally:
+            self._stats["queries"] += 1
+            self._stats["busy_time"] += time.perf_counter() - start
+            with self._lock:
+                self._active -= 1
+                self.last_used = time.monotonic()
+
+    def close_thread_connection(self):
+        """Closes the connection of the calling thread (if any)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            self._connections.pop(threading.current_thread(), None)
+            self._stats["connections_closed"] += 1
+        conn.close()
+
+    def _close_all(self):
+        # Called with the lock held
+        for conn in self._connections.values():
+            try:
+                conn.close()
+            except Exception as ex:
+                trace_exception(ex)
+            self._stats["connections_closed"] += 1
+        self._connections.clear()
+        # A fresh thread local forgets the closed connections for every thread, they will reopen on next use
+        self._local = threading.local()
+
+    def close_all(self):
+        """Closes every connection of the pool. Threads will transparently reopen one when needed."""
+        with self._lock:
+            self._close_all()
+
+    def close_if_idle(self, idle_seconds:float) -> bool:
+        """
+        Closes every connection if the pool has not been used for idle_seconds and nothing is running.
+        Returns True if connections were closed.
+        """
+        with self._lock:
+            if self._active>0 or len(self._connections)==0 or time.monotonic()-self.last_used<idle_seconds:
+                return False
+            self._close_all()
+            return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns a snapshot of the pool statistics"""
+        with self._lock:
+            self._prune_dead_threads()
+            stats = dict(self._stats)
+            stats["open_connections"] = len(self._connections)
+            stats["idle_time"] = time.monotonic()-self.last_used
+        stats["db_path"] = str(self.db_path)
+        stats["journal_mode"] = self.pragmas.get("journal_mode")
+        return stats
@@ -0,0 +1,239 @@
+"""
+project: lollms
+file: write_behind.py
+author: ParisNeo
+description:
+    Write-behind buffer for row updates.
+    While a message is streamed, its content, steps, metadata and ui are updated many times per second.
+    Instead of issuing an UPDATE and a commit for each chunk, the latest value of each column is kept
+    in memory and written at most every flush_interval_ms milliseconds by a background thread.
+    Pending updates are also written when the row is closed, before any read on the database
+    and when the process exits.
+    Rows that can't be written are retried a few times (with a growing delay) and then dropped
+    with an error, so that a permanent failure (deleted row, schema change) doesn't loop forever.
+    When rows get new ids (see rekey), their pending updates follow them and later updates sent
+    with the old ids are redirected.
+"""
+import atexit
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Any
+from ascii_colors import ASCIIColors, trace_exception
+from lollms.databases.sqlite_pool import SQLiteConnectionPool
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+# Every living buffer is flushed when the interpreter shuts down
+_live_buffers = weakref.WeakSet()
+
+def flush_all_write_buffers():
+    for buffer in list(_live_buffers):
+        try:
+            buffer.stop()
+        except Exception as ex:
+            trace_exception(ex)
+
+atexit.register(flush_all_write_buffers)
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces updates of rows of a table (identified by their id) and writes them in batches.
+    """
+    def __init__(self, pool:SQLiteConnectionPool, table:str="message", flush_interval_ms:int=250, max_retries:int=3):
+        self.pool = pool
+        self.table = table
+        self.flush_interval = max(0, flush_interval_ms)/1000
+        self.max_retries = max_retries
+
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._stopped = False
+        # row id -> number of failed writes, and when the flusher may try again after a failure
+        self._failures: Dict[int, int] = {}
+        self._retry_at = 0
+        # old row id -> new row id of the renumbered rows
+        self._aliases: Dict[int, int] = {}
+        self.nb_updates = 0
+        self.nb_flushes = 0
+        self.nb_rows_written = 0
+        self.nb_rows_dropped = 0
+        _live_buffers.add(self)
+
+    def has_pending(self, row_id:int=None) -> bool:
+        if row_id is None:
+            return len(self._pending)>0
+        return row_id in self._pending
+
+    def push(self, row_id:int, columns:Dict[str, Any], commit:bool=False):
+        """
+        Records the new values of some columns of a row.
+        If commit is True (or the buffer is disabled) the row is written immediately,
+        otherwise it will be written by the background flusher.
+        """
+        if row_id is None:
+            return
+        with self._cond:
+            row_id = self._aliases.get(row_id, row_id)
+            self._pending.setdefault(row_id, {}).update(columns)
+            self.nb_updates += 1
+            if not (commit or self.flush_interval==0 or self._stopped):
+                self._ensure_thread()
+                self._cond.notify()
+                return
+        self.flush()
+
+    def flush(self, row_id:int=None):
+        """
+        Writes the pending updates to the database in a single transaction.
+        If row_id is set, only that row is written.
+        """
+        with self._flush_lock:
+            self._flush(row_id)
+
+    def _flush(self, row_id:int=None):
+        # Called with the flush lock held
+        with self._cond:
+            if row_id is not None:
+                row_id = self._aliases.get(row_id, row_id)
+            if row_id is None:
+                batch = self._pending
+                self._pending = {}
+            elif row_id in self._pending:
+                batch = {row_id: self._pending.pop(row_id)}
+            else:
+                return
+        if len(batch)==0:
+            return
+        try:
+            with self.pool.connection() as conn:
+                for rid, columns in batch.items():
+                    self._write(conn, rid, columns)
+            self.nb_flushes += 1
+            self.nb_rows_written += len(batch)
+            if len(self._failures)>0:
+                for rid in batch:
+                    self._failures.pop(rid, None)
+        except Exception as ex:
+            trace_exception(ex)
+            self._write_rows_one_by_one(batch)
+
+    def _write(self, conn, row_id:int, columns:Dict[str, Any]):
+        names = list(columns.keys())
+        conn.execute(
+            f"UPDATE {self.table} SET {', '.join(f'{n} = ?' for n in names)} WHERE id = ?",
+            tuple(columns[n] for n in names) + (row_id,)
+        )
+
+    def _write_rows_one_by_one(self, batch:Dict[int, Dict[str, Any]]):
+        """After a failed batch: writes each row in its own transaction so that one bad row doesn't hold back the others"""
+        failed = {}
+        for rid, columns in batch.items():
+            try:
+                with self.pool.connection() as conn:
+                    self._write(conn, rid, columns)
+                self.nb_rows_written += 1
+                self._failures.pop(rid, None)
+            except Exception as ex:
+                failed[rid] = (columns, ex)
+        if len(failed)==0:
+            self.nb_flushes += 1
+            return
+        with self._cond:
+            for rid, (columns, ex) in failed.items():
+                self._failures[rid] = self._failures.get(rid, 0)+1
+                if self._failures[rid]>=self.max_retries:
+                    self._failures.pop(rid)
+                    self.nb_rows_dropped += 1
+                    ASCIIColors.error(f"Dropping the pending update of {self.table} {rid} ({', '.join(columns.keys())}) after {self.max_retries} failed writes: {ex}")
+                    continue
+                # Put back what was not superseded by newer updates
+                newer = self._pending.get(rid, {})
+                columns.update(newer)
+                self._pending[rid] = columns
+            if len(self._pending)>0:
+                attempts = max(self._failures.values(), default=1)
+                self._retry_at = time.monotonic() + min(30, 0.5*2**attempts)
+                ASCIIColors.warning(f"Couldn't write {len(failed)} pending {self.table} updates, they will be retried")
+
+    @contextmanager
+    def paused(self):
+        """
+        Writes what is pending and keeps the flusher from writing until the block exits.
+        Updates pushed meanwhile are only kept in memory (use it around a renumbering of the rows, see rekey).
+        """
+        with self._flush_lock:
+            self._flush()
+            yield
+
+    def rekey(self, mapping:Dict[int, int]):
+        """
+        Moves the pending updates of renumbered rows (old id -> new id) to their new ids.
+        Updates later pushed or flushed with an old id go to the new row.
+        """
+        with self._cond:
+            for old_id, new_id in self._aliases.items():
+                self._aliases[old_id] = mapping.get(new_id, new_id)
+            self._aliases.update(mapping)
+            for old_id, new_id in mapping.items():
+                if old_id in self._pending:
+                    self._pending.setdefault(new_id, {}).update(self._pending.pop(old_id))
+
+    def resolve(self, row_id:int)->int:
+        """Returns the current id of a row that may have been renumbered"""
+        return self._aliases.get(row_id, row_id)
+
+    def discard(self, row_id:int):
+        """Forgets the pending updates of a row (used when the row is deleted)"""
+        with self._cond:
+            self._pending.pop(self._aliases.get(row_id, row_id), None)
+
+    def _ensure_thread(self):
+        # Called with the condition held
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"write_behind_{self.table}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._pending)==0 and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                # Leave some time for more updates to be coalesced (new pushes notify us, so loop until the deadline)
+                # and, after a failure, wait before trying again
+                deadline = max(time.monotonic() + self.flush_interval, self._retry_at)
+                while not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining<=0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def stop(self):
+        """Writes everything that is pending and stops the background flusher"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "pending_rows": len(self._pending),
+            "updates": self.nb_updates,
+            "flushes": self.nb_flushes,
+            "rows_written": self.nb_rows_written,
+            "rows_dropped": self.nb_rows_dropped,
+            "flush_interval_ms": int(self.flush_interval*1000),
+        }
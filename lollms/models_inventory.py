@@ -0,0 +1,148 @@
+"""
+project: lollms
+file: models_inventory.py
+author: ParisNeo
+description:
+    Cached inventory of the models of a binding.
+    Listing the installed models walks the models folders and listing the available models reads the
+    models zoo databases. The UI asks for both every time it refreshes, while they only change when a
+    model is installed, removed or referenced, or when the zoo is updated.
+    The inventory keeps both lists and rebuilds them only when the signature of their sources changed
+    (modification time of the models folders, modification time and size of the zoo databases).
+    When watching is enabled (requires watchdog), file system events invalidate the inventory and the
+    signature is not even computed: a refresh is a dictionary lookup.
+"""
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+from ascii_colors import ASCIIColors, trace_exception
+from lollms.utilities import path_signature
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+class ModelsInventory:
+    """
+    Installed and available models of a binding, rebuilt only when the models folders or the zoo databases change.
+
+    Args:
+        binding (LLMBinding): The binding, its list_models and get_available_models methods build the inventory.
+        max_age (float): Seconds after which the lists are rebuilt anyway. Bindings listing remote models
+            (servers, APIs) have no files to watch, their lists are only refreshed this way. None for no limit.
+        watch (bool): Watch the folders with watchdog instead of checking their signature on every call.
+    """
+    def __init__(self, binding, max_age:float=60, watch:bool=False):
+        self.binding = binding
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # key -> (signature, time of the listing, value)
+        self._entries:Dict[str, Tuple[Tuple, float, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._observer = None
+        if watch:
+            self.start_watching()
+
+    def watched_paths(self)->Tuple[List[Path], List[Path]]:
+        """Returns the models folders and the zoo databases of the binding"""
+        folders = list(self.binding.models_folders)
+        databases = [self.binding.lollms_paths.models_zoo_path/f"{models_dir_name}.db" for models_dir_name in self.binding.models_dir_names]
+        return folders, databases
+
+    def signature(self)->Tuple:
+        folders, databases = self.watched_paths()
+        return tuple(path_signature(path) for path in folders+databases)
+
+    @property
+    def watching(self)->bool:
+        return self._observer is not None and self._observer.is_alive()
+
+    def _get(self, key:str, build:Callable[[], Any])->Any:
+        now = time.monotonic()
+        # While watching, changes are reported by invalidate so the signature is not needed
+        signature = None if self.watching else self.signature()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]==signature and (self.max_age is None or now-entry[1]<self.max_age):
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = (signature, now, value)
+        return value
+
+    def list_models(self)->List[str]:
+        """The installed models (binding.list_models)"""
+        return self._get("installed", self.binding.list_models)
+
+    def get_available_models(self, app=None)->List[Dict[str, Any]]:
+        """The models of the zoo (binding.get_available_models)"""
+        return self._get("available", lambda: self.binding.get_available_models(app))
+
+    def invalidate(self):
+        """Forgets the lists, they are rebuilt on next call"""
+        with self._lock:
+            self._entries = {}
+            self.invalidations += 1
+
+    def start_watching(self)->bool:
+        """Watches the models folders and the zoo databases, returns False if watchdog is not available"""
+        if self.watching:
+            return True
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            ASCIIColors.warning("watchdog is not installed, the models inventory is checked on each refresh instead of being watched")
+            return False
+
+        inventory = weakref.ref(self)
+        class InvalidateHandler(FileSystemEventHandler):
+            # Only a weak reference, the observer must not keep a replaced binding alive
+            def on_any_event(self, event):
+                current = inventory()
+                if current is not None:
+                    current.invalidate()
+
+        folders, databases = self.watched_paths()
+        observer = Observer()
+        observer.daemon = True
+        try:
+            for folder in folders:
+                if folder.exists():
+                    observer.schedule(InvalidateHandler(), str(folder), recursive=True)
+            for folder in {database.parent for database in databases}:
+                if folder.exists():
+                    observer.schedule(InvalidateHandler(), str(folder), recursive=False)
+            observer.start()
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.warning("Couldn't watch the models folders, the models inventory is checked on each refresh instead")
+            return False
+        self._observer = observer
+        weakref.finalize(self, observer.stop)
+        # Events that happened before the observer started are not reported
+        self.invalidate()
+        return True
+
+    def stop_watching(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def get_stats(self)->Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "watching": self.watching,
+                "cached": list(self._entries.keys())
+            }
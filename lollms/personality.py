@@ -48,6 +48,7 @@ import pipmaster as pm
 import inspect
 
 from lollms.code_parser import compress_js, compress_python, compress_html
+from lollms.databases.media_store import open_unshared
 
 
 import requests
@@ -268,7 +269,7 @@ class AIPersonality:
             self.ai_full_header if not is_continue else '' if not self.config.use_continue_message else "CONTINUE FROM HERE And do not open a new markdown code tag." + self.separator_template + self.ai_full_header
         ]
         )
-        tokens = self.model.tokenize(prompt_data)
+        tokens = self.model.tokenize_cached(prompt_data)
         if return_tokens:
             return prompt_data, tokens
         else:
@@ -414,7 +415,7 @@ class AIPersonality:
             part_tokens=[]
             nb_tokens=0
             for i,part in enumerate(prompt_parts):
-                tk = self.model.tokenize(part)
+                tk = self.model.tokenize_cached(part)
                 part_tokens.append(tk)
                 if i != sacrifice_id:
                     nb_tokens += len(tk)
@@ -611,7 +612,7 @@ class AIPersonality:
         ASCIIColors.red(" *-*-*-*-*-*-*-*")
         ASCIIColors.yellow(prompt)
         ASCIIColors.red(" *-*-*-*-*-*-*-*")
-        ASCIIColors.red(f"Weight : {len(self.model.tokenize(prompt))} tokens")
+        ASCIIColors.red(f"Weight : {self.model.count_tokens(prompt)} tokens")
         ASCIIColors.red(" *-*-*-*-*-*-*-*")
 
 
@@ -652,17 +653,16 @@ class AIPersonality:
             debug = self.config.debug
 
         if max_generation_size is None:
-            prompt_size = self.model.tokenize(prompt)
-            max_generation_size = self.model.config.ctx_size - len(prompt_size)
+            max_generation_size = self.model.config.ctx_size - self.model.count_tokens(prompt)
 
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders,
-                        self.model.tokenize,
+                        self.model.tokenize_cached,
                         self.model.detokenize,
                         self.model.config.ctx_size - max_generation_size,
                         sacrifice
                         )
-        ntk = len(self.model.tokenize(prompt))
+        ntk = self.model.count_tokens(prompt)
         max_generation_size = min(self.model.config.ctx_size - ntk, max_generation_size)
         # TODO : add show progress
 
@@ -712,7 +712,7 @@ class AIPersonality:
 
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders,
-                        self.model.tokenize,
+                        self.model.tokenize_cached,
                         self.model.detokenize,
                         (self.model.config.ctx_size - max_generation_size) if max_generation_size is not None else (self.model.config.ctx_size - 1024),
                         sacrifice
@@ -1070,7 +1070,7 @@ Use this structure:
             self.print_prompt("gen",prompt)
 
         if max_size is None:
-            max_size = min(self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-len(self.model.tokenize(prompt)), self.config.ctx_size-len(self.model.tokenize(prompt)))
+            max_size = min(self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-self.model.count_tokens(prompt), self.config.ctx_size-self.model.count_tokens(prompt))
 
         self.model.generate_with_images(
                                 prompt,
@@ -1091,7 +1091,7 @@ Use this structure:
         self.bot_says = ""
         if debug:
             self.print_prompt("gen",prompt)
-        ntokens = len(self.model.tokenize(prompt))
+        ntokens = self.model.count_tokens(prompt)
         
         self.model.generate(
                                 prompt,
@@ -1484,7 +1484,7 @@ Use this structure:
                     return
                 text = self.app.stt.transcribe(str(path))
                 transcription_fn = str(path)+".txt"
-                with open(transcription_fn, "w", encoding="utf-8") as f:
+                with open_unshared(transcription_fn, "w", encoding="utf-8") as f:
                     f.write(text)
 
                 self.info(f"File saved to {transcription_fn}")
@@ -3597,7 +3597,7 @@ Use this structure:
         prompt = self.build_prompt(full_context, sacrifice_id)
         
         if self.config.debug:
-            nb_prompt_tokens = len(self.personality.model.tokenize(prompt))
+            nb_prompt_tokens = self.personality.model.count_tokens(prompt)
             nb_tokens = min(self.config.ctx_size - nb_prompt_tokens, self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size-nb_prompt_tokens)
             ASCIIColors.info(f"Prompt size : {nb_prompt_tokens}")
             ASCIIColors.info(f"Requested generation max size : {nb_tokens}")
@@ -3629,7 +3629,7 @@ Use this structure:
             nb_tokens=0
             for i, part in enumerate(prompt_parts):
                 part_s=part.strip()
-                tk = self.personality.model.tokenize(part_s)
+                tk = self.personality.model.tokenize_cached(part_s)
                 part_tokens.append(tk)
                 if i != sacrifice_id:
                     nb_tokens += len(tk)
@@ -4762,7 +4762,7 @@ transition-all duration-300 ease-in-out">
             full_prompt = self.build_prompt_from_context_details(context_details, custom_entries=custom_entries)
 
         out = self.fast_gen(full_prompt)
-        nb_tokens = len(self.personality.model.tokenize(out))
+        nb_tokens = self.personality.model.count_tokens(out, use_cache=False)
         if nb_tokens >= (self.config.max_n_predict if self.config.max_n_predict else self.config.ctx_size)-1:
             out = out+self.fast_gen(full_prompt+out, callback=callback)
         if context_details["is_continue"]:
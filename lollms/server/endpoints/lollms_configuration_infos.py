@@ -109,6 +109,7 @@ async def update_setting(request: Request):
                     if per is not None:
                         per.model = None
                 lollmsElfServer.binding.binding_config.model_name = lollmsElfServer.config.model_name
+                lollmsElfServer.binding.clear_tokens_cache()
                 lollmsElfServer.model = lollmsElfServer.binding.build_model()
                 if lollmsElfServer.model is not None:
                     ASCIIColors.yellow("New model OK")
@@ -15,9 +15,9 @@ from lollms.types import MSG_OPERATION_TYPE
 from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_exception
 from lollms.security import sanitize_path, check_access
 from ascii_colors import ASCIIColors
-from lollms.databases.discussions_database import DiscussionsDB, Discussion
-from typing import List
-import shutil
+from lollms.databases.discussions_database import DiscussionsDBCache, Discussion
+from typing import List, Optional
+import threading
 import tqdm
 from pathlib import Path
 class GenerateRequest(BaseModel):
@@ -43,6 +43,7 @@ class DeleteDiscussionParameters(BaseModel):
 
 router = APIRouter()
 lollmsElfServer:LOLLMSElfServer = LOLLMSElfServer.get_instance()
+discussions_db_cache = DiscussionsDBCache()
 
 
 @router.get("/list_discussions")
@@ -51,6 +52,88 @@ def list_discussions():
     return discussions
 
 
+@router.get("/list_discussions_page")
+def list_discussions_page(limit:int=50, before_id:int=None):
+    """
+    Lists the discussions page by page, newest first.
+    Pass the returned next_cursor as before_id to get the next page.
+    """
+    return lollmsElfServer.db.get_discussions_page(min(limit, 500), before_id)
+
+
+@router.get("/list_discussions_summary")
+def list_discussions_summary(
+                                sort_by:str="last_message_at",
+                                ascending:bool=False,
+                                limit:int=50,
+                                offset:int=0,
+                                title:Optional[str]=None,
+                                min_messages:Optional[int]=None,
+                                max_messages:Optional[int]=None,
+                                active_after:Optional[str]=None,
+                                active_before:Optional[str]=None,
+                                preview_length:int=120
+                            ):
+    """
+    Lists the discussions with their message count, last activity and a preview of the last message,
+    sorted and filtered on those fields, without opening any discussion.
+    """
+    try:
+        return lollmsElfServer.db.list_discussions(sort_by, ascending, min(limit, 500), offset, title, min_messages, max_messages, active_after, active_before, min(preview_length, 1000))
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
+
+class DiscussionMessagesPage(BaseModel):
+    client_id: str
+    id: int
+    limit: int = 50
+    before_id: Optional[int] = None
+    after_id: Optional[int] = None
+
+@router.post("/get_discussion_messages_page")
+def get_discussion_messages_page(data:DiscussionMessagesPage):
+    """
+    Returns a page of messages of a discussion in chronological order.
+    Without cursors, the last messages are returned. Use before_cursor as before_id to load older messages.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        discussion = Discussion(lollmsElfServer, data.id, lollmsElfServer.db)
+        page = discussion.get_messages_page(min(data.limit, 500), data.before_id, data.after_id)
+        page["messages"] = [message.to_json() for message in page["messages"]]
+        return page
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
+
+class DiscussionsSearch(BaseModel):
+    client_id: str
+    query: str
+    limit: int = 20
+    offset: int = 0
+    discussion_id: Optional[int] = None
+
+@router.post("/search_discussions")
+def search_discussions(data:DiscussionsSearch):
+    """
+    Full text search across the messages of all discussions.
+    Returns ranked snippets, use next_offset as offset to get the next page.
+    Archived discussions are not searched, archived_excluded tells how many were left out.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        return lollmsElfServer.db.search_messages(data.query, min(data.limit, 200), data.offset, data.discussion_id)
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
+
 @router.get("/list_databases")
 async def list_databases():
    """List all the personal databases in the LoLLMs server."""
@@ -67,13 +150,16 @@ def select_database(data:DatabaseSelectionParameters):
     
 
     print(f'Selecting database {data.name}')
-    # Create database object
-    lollmsElfServer.db = DiscussionsDB(lollmsElfServer, lollmsElfServer.lollms_paths, data.name)
+    # Recently used databases are kept open by the cache, their schema is only checked once
+    if getattr(lollmsElfServer, "db", None) is not None:
+        discussions_db_cache.add(lollmsElfServer.db)
     ASCIIColors.info("Checking discussions database... ",end="")
-    lollmsElfServer.db.create_tables()
-    lollmsElfServer.db.add_missing_columns()
+    lollmsElfServer.db = discussions_db_cache.get(lollmsElfServer, lollmsElfServer.lollms_paths, data.name)
     lollmsElfServer.config.discussion_db_name = data.name
     ASCIIColors.success("ok")
+    if lollmsElfServer.config.discussion_archive_after_days>0:
+        db = lollmsElfServer.db
+        threading.Thread(target=db.archive_idle_discussions, args=(lollmsElfServer.config.discussion_archive_after_days, opened_discussion_ids()), daemon=True).start()
 
     if lollmsElfServer.config.auto_save:
         lollmsElfServer.config.save_config()
@@ -81,6 +167,47 @@ def select_database(data:DatabaseSelectionParameters):
     return {"status":True}
 
 
+def opened_discussion_ids():
+    """Ids of the discussions currently opened by the connected clients"""
+    return [client.discussion.discussion_id for client in list(lollmsElfServer.session.clients.values()) if client.discussion is not None]
+
+
+class ArchiveDiscussionsParameters(BaseModel):
+    client_id: str
+    max_idle_days: Optional[float] = None
+
+@router.post("/archive_idle_discussions")
+def archive_idle_discussions(data:ArchiveDiscussionsParameters):
+    """
+    Moves the discussions idle for more than max_idle_days (discussion_archive_after_days by default) to the cold storage.
+    Returns the number of archived discussions and the reclaimed space.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        max_idle_days = data.max_idle_days if data.max_idle_days is not None else lollmsElfServer.config.discussion_archive_after_days
+        if max_idle_days<=0:
+            return {"status":False,"error":"No idle age set for archival"}
+        report = lollmsElfServer.db.archive_idle_discussions(max_idle_days, opened_discussion_ids())
+        report["status"] = True
+        return report
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
+
+@router.get("/get_media_store_stats")
+def get_media_store_stats():
+    """Returns the number and size of the stored discussion media files and thumbnails"""
+    return lollmsElfServer.db.media_store.get_stats()
+
+
+@router.get("/list_archived_discussions")
+def list_archived_discussions():
+    """Lists the discussions of the cold storage with their metadata. They are restored when opened."""
+    return lollmsElfServer.db.get_archived_discussions()
+
+
 @router.post("/export_discussion")
 def export_discussion():
     return {"discussion_text":lollmsElfServer.get_discussion_to()}
@@ -123,6 +250,27 @@ async def make_title(discussion_title: DiscussionTitle):
         lollmsElfServer.error(ex)
         return {"status":False,"error":str(ex)}
     
+class ForkDiscussionParameters(BaseModel):
+    client_id: str
+    id: int
+    message_id: int
+    title: Optional[str] = None
+
+@router.post("/fork_discussion")
+def fork_discussion(data:ForkDiscussionParameters):
+    """
+    Creates a new discussion sharing the branch of discussion `id` that ends with `message_id`.
+    Nothing is copied: the fork only stores its own new messages.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        discussion = lollmsElfServer.db.fork_discussion(data.id, data.message_id, data.title)
+        return {"status":True, "id":discussion.discussion_id, "title":discussion.title()}
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
+
 class DatabaseExport(BaseModel):
     client_id: str
 
@@ -133,6 +281,35 @@ def export(databaseExport:DatabaseExport):
     return lollmsElfServer.db.export_to_json()
 
 
+class DatabaseStreamExport(BaseModel):
+    client_id: str
+    export_format: str = "ndjson"
+    discussion_ids: Optional[List[int]] = None
+    title: str = ""
+
+@router.post("/export_stream")
+def export_stream(data:DatabaseStreamExport):
+    """
+    Streams an export of the discussions (all of them if no ids are given) as ndjson, json or markdown.
+    The export is produced incrementally from a single query, so it works for databases of any size.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    media_types = {"ndjson":"application/x-ndjson", "json":"application/json", "markdown":"text/markdown"}
+    extensions = {"ndjson":"ndjson", "json":"json", "markdown":"md"}
+    if data.export_format not in media_types:
+        return {"status":False,"error":f"Unsupported export format {data.export_format}"}
+
+    def progress(done, total):
+        if done%100==0 or done==total:
+            ASCIIColors.info(f"Exported {done}/{total} discussions")
+
+    return StreamingResponse(
+        lollmsElfServer.db.export_stream(data.export_format, data.discussion_ids, data.title, progress_callback=progress),
+        media_type=media_types[data.export_format],
+        headers={"Content-Disposition": f'attachment; filename="{lollmsElfServer.db.discussion_db_name}.{extensions[data.export_format]}"'}
+    )
+
+
 
 class DiscussionDelete(BaseModel):
     client_id: str
@@ -149,24 +326,74 @@ async def delete_discussion(discussion: DiscussionDelete):
     check_access(lollmsElfServer, discussion.client_id)
 
     try:
+        client = lollmsElfServer.session.get_client(discussion.client_id)
+        lollmsElfServer.db.delete_discussions([discussion.id])
+        client.discussion = None
+        return {'status':True}
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
 
-        client_id           = discussion.client_id
-        discussion_id       = discussion.id
-        discussion_path = lollmsElfServer.lollms_paths.personal_discussions_path/lollmsElfServer.config.discussion_db_name/f"{discussion_id}"
 
+class DiscussionsDelete(BaseModel):
+    client_id: str
+    ids: List[int]
 
-        lollmsElfServer.session.get_client(client_id).discussion = Discussion(lollmsElfServer, discussion_id, lollmsElfServer.db)
-        lollmsElfServer.session.get_client(client_id).discussion.delete_discussion()
-        lollmsElfServer.session.get_client(client_id).discussion = None
+@router.post("/delete_discussions")
+def delete_discussions(data: DiscussionsDelete):
+    """
+    Deletes several discussions in one transaction.
+    Their folders are removed in the background, use /get_discussions_removal_progress to follow it.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        report = lollmsElfServer.db.delete_discussions(data.ids)
+        # Clients looking at a deleted discussion are detached from it
+        deleted = set(data.ids)
+        for client in list(lollmsElfServer.session.clients.values()):
+            if client.discussion is not None and client.discussion.discussion_id in deleted:
+                client.discussion = None
+        report["status"] = True
+        report["removal"] = lollmsElfServer.db.get_folders_removal_progress()
+        return report
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error(ex)
+        return {"status":False,"error":str(ex)}
 
-        shutil.rmtree(discussion_path)
-        return {'status':True}
+
+@router.get("/get_discussions_removal_progress")
+def get_discussions_removal_progress():
+    """Progress of the background removal of the deleted discussions folders"""
+    return lollmsElfServer.db.get_folders_removal_progress()
+
+
+class MessageRating(BaseModel):
+    message_id: int
+    value: int
+
+class MessagesRatings(BaseModel):
+    client_id: str
+    ratings: List[MessageRating]
+    relative: bool = True
+
+@router.post("/rate_messages")
+def rate_messages(data: MessagesRatings):
+    """
+    Applies many ratings in one transaction (feedback import).
+    With relative=True the values are added to the messages ranks, otherwise they replace them.
+    """
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        applied = lollmsElfServer.db.rate_messages([(rating.message_id, rating.value) for rating in data.ratings], data.relative)
+        return {"status":True, "applied":applied, "ignored":len(data.ratings)-applied}
     except Exception as ex:
         trace_exception(ex)
         lollmsElfServer.error(ex)
         return {"status":False,"error":str(ex)}
-    
-    
+
+
 # ----------------------------- import/export --------------------
 class DiscussionExport(BaseModel):
     client_id: str
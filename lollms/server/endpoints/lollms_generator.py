@@ -16,6 +16,7 @@ from starlette.responses import StreamingResponse
 from lollms.types import MSG_OPERATION_TYPE
 from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_exception
 from lollms.generation import RECEPTION_MANAGER, ROLE_CHANGE_DECISION, ROLE_CHANGE_OURTPUT
+from lollms.databases.media_store import open_unshared
 from ascii_colors import ASCIIColors
 import time
 import re
@@ -131,8 +132,7 @@ async def lollms_generate(request: LollmsGenerateRequest):
         prompt = request.prompt
         if elf_server.config.debug:
             ASCIIColors.yellow(prompt)
-        tokens = elf_server.model.tokenize(prompt)
-        n_tokens = len(tokens)
+        n_tokens = elf_server.model.count_tokens(prompt)
         ASCIIColors.info(f"Prompt input size {n_tokens}")        
         if request.n_predict is None:
             n_predict = min(elf_server.config.ctx_size-n_tokens-1,elf_server.config.max_n_predict if elf_server.config.max_n_predict else elf_server.config.ctx_size)
@@ -173,7 +173,7 @@ async def lollms_generate(request: LollmsGenerateRequest):
                             return False
                         
                     def chunks_builder():
-                        if request.model_name in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model_name:
+                        if request.model_name in elf_server.binding.models_inventory.list_models() and elf_server.binding.model_name!=request.model_name:
                             elf_server.binding.build_model(request.model_name)    
 
                         elf_server.binding.generate(
@@ -218,7 +218,7 @@ async def lollms_generate(request: LollmsGenerateRequest):
                                                 callback=callback,
                                                 temperature=request.temperature or elf_server.config.temperature
                                             )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
+                completion_tokens = elf_server.binding.count_tokens(reception_manager.reception_buffer, use_cache=False)
                 ASCIIColors.yellow(f"Generated: {completion_tokens} tokens")
                 return PlainTextResponse(reception_manager.reception_buffer)
         else:
@@ -279,12 +279,11 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
         reception_manager=RECEPTION_MANAGER()
         prompt = request.prompt
         encoded_images = request.images
-        tokens = elf_server.model.tokenize(prompt)
-        n_tokens = len(tokens)
+        n_tokens = elf_server.model.count_tokens(prompt)
         ASCIIColors.yellow(f"Prompt input size {n_tokens}")        
         n_predict = min(min(elf_server.config.ctx_size-n_tokens-1,elf_server.config.max_n_predict), request.n_predict) if request.n_predict>0 else min(elf_server.config.ctx_size-n_tokens-1,elf_server.config.max_n_predict)
         stream = request.stream
-        prompt_tokens = len(elf_server.binding.tokenize(prompt))
+        prompt_tokens = elf_server.binding.count_tokens(prompt)
         if elf_server.binding is not None:
             def add_padding(encoded_image):
                 missing_padding = len(encoded_image) % 4
@@ -306,7 +305,7 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                 padded_image = add_padding(sanitized_image)
 
                 image_path = images_path/ f'image_{i}.png'
-                with open(image_path, 'wb') as image_file:
+                with open_unshared(image_path, 'wb') as image_file:
                     image_file.write(base64.b64decode(padded_image))
                 image_files.append(image_path)            
             if stream:
@@ -342,7 +341,7 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                             return False
                         
                     def chunks_builder():
-                        if request.model_name in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model_name:
+                        if request.model_name in elf_server.binding.models_inventory.list_models() and elf_server.binding.model_name!=request.model_name:
                             elf_server.binding.build_model(request.model_name)    
 
                         elf_server.binding.generate_with_images(
@@ -391,7 +390,7 @@ async def lollms_generate_with_images(request: LollmsGenerateRequest):
                                                 callback=callback,
                                                 temperature=request.temperature or elf_server.config.temperature
                                             )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
+                completion_tokens = elf_server.binding.count_tokens(reception_manager.reception_buffer, use_cache=False)
                 return PlainTextResponse(reception_manager.reception_buffer)
         else:
             return None
@@ -511,7 +510,7 @@ async def v1_chat_completions(request: ChatGenerationRequest):
             prompt += f"{elf_server.config.discussion_prompt_separator}assistant:"
         n_predict = max_tokens if max_tokens>0 else 1024
         stream = request.stream
-        prompt_tokens = len(elf_server.binding.tokenize(prompt))
+        prompt_tokens = elf_server.binding.count_tokens(prompt)
         if elf_server.binding is not None:
             if stream:
                 new_output={"new_values":[]}
@@ -598,7 +597,7 @@ async def v1_chat_completions(request: ChatGenerationRequest):
                                                 callback=callback,
                                                 temperature=temperature
                                             )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
+                completion_tokens = elf_server.binding.count_tokens(reception_manager.reception_buffer, use_cache=False)
                 return ModelResponse(id = _generate_id(), choices = [Choices(message=Message(role="assistant", content=reception_manager.reception_buffer), finish_reason="stop", index=0)], created=int(time.time()), model=request.model,usage=Usage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
         else:
             return None
@@ -653,7 +652,7 @@ async def ollama_chat_completion(request: ChatGenerationRequest):
             prompt += f"{elf_server.config.discussion_prompt_separator}assistant:"
         n_predict = max_tokens if max_tokens>0 else 1024
         stream = request.stream
-        prompt_tokens = len(elf_server.binding.tokenize(prompt))
+        prompt_tokens = elf_server.binding.count_tokens(prompt)
         if elf_server.binding is not None:
             if stream:
                 new_output={"new_values":[]}
@@ -740,7 +739,7 @@ async def ollama_chat_completion(request: ChatGenerationRequest):
                                                 callback=callback,
                                                 temperature=temperature
                                             )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
+                completion_tokens = elf_server.binding.count_tokens(reception_manager.reception_buffer, use_cache=False)
                 return OllamaModelResponse(id = _generate_id(), choices = [Choices(message=Message(role="assistant", content=reception_manager.reception_buffer), finish_reason="stop", index=0)], created=int(time.time()), model=request.model,usage=Usage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
         else:
             return None
@@ -859,7 +858,7 @@ async def ollama_generate(request: CompletionGenerationRequest):
                 response_data["load_duration"] = 0
                 response_data["prompt_eval_count"] = len(request.prompt.split())
                 response_data["prompt_eval_duration"] = time.perf_counter_ns() - start_time
-                response_data["eval_count"] = len(elf_server.binding.tokenize(output["text"]))  # Simulated number of tokens in the response
+                response_data["eval_count"] = elf_server.binding.count_tokens(output["text"], use_cache=False)  # Simulated number of tokens in the response
                 response_data["eval_duration"] = time.perf_counter_ns() - start_time
                 response_data["response"] = output["text"]
                 response_data["done"] = True
@@ -928,7 +927,7 @@ async def ollama_completion(request: CompletionGenerationRequest):
                             return False
                         
                     def chunks_builder():
-                        if request.model in elf_server.binding.list_models() and elf_server.binding.model_name!=request.model:
+                        if request.model in elf_server.binding.models_inventory.list_models() and elf_server.binding.model_name!=request.model:
                             elf_server.binding.build_model(request.model)    
 
                         elf_server.binding.generate(
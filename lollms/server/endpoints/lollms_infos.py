@@ -10,7 +10,9 @@ description:
 from fastapi import APIRouter, Request
 import pkg_resources
 from lollms.server.elf_server import LOLLMSElfServer
-from ascii_colors import ASCIIColors
+from lollms.security import check_access, forbid_remote_access
+from pydantic import BaseModel
+from ascii_colors import ASCIIColors, trace_exception
 from lollms.utilities import load_config
 from pathlib import Path
 from typing import List
@@ -46,3 +48,39 @@ def get_server_address(request:Request):
     srv_addr = "/".join(str(server_address).split("/")[:-1])
     ASCIIColors.yellow(server_address)
     return srv_addr
+
+
+@router.get("/get_databases_health")
+def get_databases_health():
+    """
+    Get the health of the discussions and skills databases.
+
+    Returns:
+        dict: For each database group, the list of its files with page counts, free pages,
+            the size of each table and index and the result of the last maintenance.
+    """
+    forbid_remote_access(lollmsElfServer)
+    return lollmsElfServer.db_maintenance.get_health()
+
+
+class DatabasesMaintenanceRequest(BaseModel):
+    client_id: str
+    convert_auto_vacuum: bool = False
+
+@router.post("/run_databases_maintenance")
+def run_databases_maintenance(data:DatabasesMaintenanceRequest):
+    """
+    Runs the incremental vacuum and optimize of all the databases now, without waiting for the idle schedule.
+    With convert_auto_vacuum, databases not using incremental auto vacuum yet are converted first.
+    This rewrites each file (VACUUM) and blocks the writers while it runs.
+
+    Returns:
+        dict: The maintenance report of each database file.
+    """
+    forbid_remote_access(lollmsElfServer)
+    check_access(lollmsElfServer, data.client_id)
+    try:
+        return {"status":True, "reports":lollmsElfServer.db_maintenance.run_once(force=True, convert=data.convert_auto_vacuum)}
+    except Exception as ex:
+        trace_exception(ex)
+        return {"status":False, "error":str(ex)}
@@ -41,7 +41,7 @@ async def list_models():
     """
     if lollmsElfServer.binding is not None:
         ASCIIColors.yellow("Listing models")
-        models = lollmsElfServer.binding.list_models()
+        models = lollmsElfServer.binding.models_inventory.list_models()
         ASCIIColors.green("ok")
         return models
     else:
@@ -59,7 +59,7 @@ async def get_available_models():
     if lollmsElfServer.binding is None:
         return []
     try:
-        model_list = lollmsElfServer.binding.get_available_models(lollmsElfServer)
+        model_list = lollmsElfServer.binding.models_inventory.get_available_models(lollmsElfServer)
     except Exception as ex:
         trace_exception(ex)
         lollmsElfServer.error("Coudln't list models. Please reinstall the binding or notify ParisNeo on the discord server")
@@ -67,12 +67,31 @@ async def get_available_models():
 
     return model_list
 
+@router.get("/search_models")
+def search_models(text:str="", model_type:str=None, limit:int=50, offset:int=0, sort_by:str="last_commit_time"):
+    """
+    Searches the models zoo of the current binding one page at a time.
+    With a text, models are ranked by relevance of their name, description and creator, otherwise sorted by sort_by
+    (last_commit_time, rank or name).
+
+    Returns:
+        dict: {"models": [...], "total": number of matching models}
+    """
+    if lollmsElfServer.binding is None:
+        return {"models":[], "total":0}
+    try:
+        return lollmsElfServer.binding.search_models_page(lollmsElfServer, text, [model_type] if model_type else None, max(1, min(limit, 500)), max(0, offset), sort_by)
+    except Exception as ex:
+        trace_exception(ex)
+        lollmsElfServer.error("Couldn't search the models zoo")
+        return {"models":[], "total":0}
+
 @router.get("/get_active_model")
 def get_active_model():
     if lollmsElfServer.binding is not None:
         try:
             ASCIIColors.yellow("Getting active model")
-            models = lollmsElfServer.binding.list_models()
+            models = lollmsElfServer.binding.models_inventory.list_models()
             index = models.index(lollmsElfServer.config.model_name)
             ASCIIColors.green("ok")
             return {"status":True,"model":models[index],"index":index}
@@ -85,6 +104,13 @@ def get_active_model():
 def get_model_status():
     return {"status":lollmsElfServer.model is not None}
 
+@router.get("/get_tokens_cache_stats")
+def get_tokens_cache_stats():
+    """Returns the hits, misses and size of the tokenization cache of the current binding"""
+    if lollmsElfServer.binding is None:
+        return {}
+    return lollmsElfServer.binding.tokens_cache.get_stats()
+
 @router.post("/add_reference_to_local_model")
 def add_reference_to_local_model(data:ModelReferenceParams):     
    
@@ -120,7 +146,7 @@ async def ollama_list_models():
     if lollmsElfServer.binding is None:
         return []
     try:
-        model_list = lollmsElfServer.binding.get_available_models(lollmsElfServer)
+        model_list = lollmsElfServer.binding.models_inventory.get_available_models(lollmsElfServer)
 
         md = {
         "models": [
@@ -16,7 +16,7 @@ from lollms.security import sanitize_path
 from ascii_colors import ASCIIColors
 from lollms.databases.discussions_database import DiscussionsDB, Discussion
 from lollms.security import check_access
-from typing import List
+from typing import List, Optional
 
 import tqdm
 from pathlib import Path
@@ -47,6 +47,45 @@ class CategoryData(BaseModel):
     client_id: str
     category: str
 
+class SkillsListing(BaseModel):
+    client_id: str
+    category: Optional[str] = None
+    title: Optional[str] = None
+    limit: int = 50
+    offset: int = 0
+
+class SkillsSearch(BaseModel):
+    client_id: str
+    query: str
+    limit: int = 20
+    offset: int = 0
+
+
+@router.post("/list_skills")
+def list_skills(listing:SkillsListing):
+    """
+    Lists the skills sorted by title one page at a time (without their content).
+    Filters on the category and on words of the title are optional.
+    """
+    check_access(lollmsElfServer, listing.client_id)
+    try:
+        result = lollmsElfServer.skills_library.list_skills(listing.category, listing.title, max(1, listing.limit), max(0, listing.offset))
+        result["status"] = True
+        return result
+    except Exception as ex:
+        trace_exception(ex)
+        return {"status":False,"error":str(ex)}
+
+@router.post("/search_skills")
+def search_skills(search:SkillsSearch):
+    """Full text search over the categories, titles and contents of the skills, best matches first"""
+    check_access(lollmsElfServer, search.client_id)
+    try:
+        entries = lollmsElfServer.skills_library.query_entry(search.query, max(1, search.limit), max(0, search.offset))
+        return {"status":True, "skills":[{"id":r[0], "category":r[2], "title":r[3]} for r in entries]}
+    except Exception as ex:
+        trace_exception(ex)
+        return {"status":False,"error":str(ex)}
 
 @router.post("/get_skills_library")
 def get_skills_library_categories(discussionInfos:ClientInfos):
@@ -16,6 +16,7 @@ from lollms.types import MSG_OPERATION_TYPE
 from lollms.main_config import BaseConfig
 from lollms.utilities import find_next_available_filename, output_file_path_to_url, detect_antiprompt, remove_text_from_string, trace_exception, find_first_available_file_index, add_period, PackageManager
 from lollms.security import sanitize_path, validate_path, check_access
+from lollms.databases.media_store import open_unshared
 from pathlib import Path
 from ascii_colors import ASCIIColors
 import os
@@ -246,7 +247,7 @@ async def upload_voice_file(file: UploadFile = File(...)):
     contents = await file.read()
     safe_filename = f"{file_path.name}"
     safe_file_path = lollmsElfServer.lollms_paths.custom_voices_path/safe_filename
-    with safe_file_path.open("wb") as f:
+    with open_unshared(safe_file_path, "wb") as f:
         f.write(contents)
     lollmsElfServer.config.xtts_current_voice=safe_filename
     if lollmsElfServer.config.auto_save:
@@ -71,7 +71,7 @@ def add_events(sio:socketio):
             client.is_generating=True
             client.requested_stop=False
             prompt          = data['prompt']
-            tokenized = model.tokenize(prompt)
+            tokenized = model.tokenize_cached(prompt)
             personality_id  = data.get('personality', -1)
 
             n_crop          = data.get('n_crop', len(tokenized))
@@ -108,7 +108,7 @@ def add_events(sio:socketio):
                         else:
                             return False                            
 
-                    tk = model.tokenize(prompt)
+                    tk = model.tokenize_cached(prompt)
                     n_tokens = len(tk)
                     fd = model.detokenize(tk[-min(lollmsElfServer.config.ctx_size-n_predicts,n_tokens):])
 
@@ -140,7 +140,7 @@ def add_events(sio:socketio):
                         personality: AIPersonality = lollmsElfServer.personalities[personality_id]
                         ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
                         personality.model = model
-                        cond_tk = personality.model.tokenize(personality.personality_conditioning)
+                        cond_tk = personality.model.tokenize_cached(personality.personality_conditioning)
                         n_cond_tk = len(cond_tk)
                         # Placeholder code for text generation
                         # Replace this with your actual text generation logic
@@ -251,7 +251,7 @@ def add_events(sio:socketio):
             prompt = data["prompt"]
             ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
             try:
-                nb_tokens = len(lollmsElfServer.model.tokenize(prompt))
+                nb_tokens = lollmsElfServer.model.count_tokens(prompt)
             except:
                 nb_tokens = None
             created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')            
@@ -26,6 +26,7 @@ from datetime import datetime
 import threading
 import os
 from lollms.security import check_access
+from lollms.databases.media_store import open_unshared
 router = APIRouter()
 lollmsElfServer = LOLLMSElfServer.get_instance()
 
@@ -93,10 +94,11 @@ def add_events(sio:socketio):
         try:
             if chunk_index==0:
                 lollmsElfServer.ShowBlockingMessage(f"Receiving File {file_path.name}")
-                with open(file_path, 'wb') as file:
+                # An existing file may be a link to a stored media shared with other discussions, never write through it
+                with open_unshared(file_path, 'wb') as file:
                     file.write(chunk)
             else:
-                with open(file_path, 'ab') as file:
+                with open_unshared(file_path, 'ab') as file:
                     file.write(chunk)
         except Exception as e:
             lollmsElfServer.HideBlockingMessage()
@@ -86,7 +86,7 @@ class TasksLibrary:
         self.bot_says = ""
         if debug:
             self.print_prompt("gen",prompt)
-        ntokens = len(self.lollms.model.tokenize(prompt))
+        ntokens = self.lollms.model.count_tokens(prompt)
         self.lollms.model.generate(
                                 prompt,
                                 max_size if max_size else min(self.lollms.config.ctx_size-ntokens,self.lollms.config.max_n_predict),
@@ -152,7 +152,7 @@ class TasksLibrary:
         """
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders,
-                        self.lollms.model.tokenize,
+                        self.lollms.model.tokenize_cached,
                         self.lollms.model.detokenize,
                         (self.lollms.model.config.ctx_size - max_generation_size) if max_generation_size is not None else (self.lollms.model.config.ctx_size - 1024),
                         sacrifice
@@ -201,17 +201,16 @@ class TasksLibrary:
             debug = self.lollms.config.debug
 
         if max_generation_size is None:
-            prompt_size = self.lollms.model.tokenize(prompt)
-            max_generation_size = self.lollms.model.config.ctx_size - len(prompt_size)
+            max_generation_size = self.lollms.model.config.ctx_size - self.lollms.model.count_tokens(prompt)
 
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders,
-                        self.lollms.model.tokenize,
+                        self.lollms.model.tokenize_cached,
                         self.lollms.model.detokenize,
                         self.lollms.model.config.ctx_size - max_generation_size,
                         sacrifice
                         )
-        ntk = len(self.lollms.model.tokenize(prompt))
+        ntk = self.lollms.model.count_tokens(prompt)
         max_generation_size = min(self.lollms.model.config.ctx_size - ntk, max_generation_size)
         # TODO : add show progress
 
@@ -0,0 +1,111 @@
+"""
+project: lollms
+file: tokens_cache.py
+author: ParisNeo
+description:
+    Bounded LRU cache of tokenizations.
+    Building a prompt tokenizes the same texts at every generation (personality conditioning, user
+    description, message headers, prompt parts) and most of the time only to count their tokens.
+    The cache keeps the tokens of the recently tokenized texts, keyed by the model identity (the
+    tokenizer) and the sha256 digest of the text (texts never share an entry, and the cache doesn't
+    keep the texts themselves alive). It is bounded both in number of texts and in number of tokens,
+    and it clears itself when it sees another model identity (the previous tokens are useless then).
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+__author__ = "parisneo"
+__github__ = "https://github.com/ParisNeo/lollms"
+__copyright__ = "Copyright 2023, "
+__license__ = "Apache 2.0"
+
+
+class TokensCache:
+    """
+    Least recently used tokenizations.
+
+    Args:
+        max_entries (int): Maximum number of cached texts.
+        max_tokens (int): Maximum number of cached tokens (all texts together). A text bigger than a
+            quarter of it is not cached, so that one document does not flush everything else.
+    """
+    def __init__(self, max_entries:int=2048, max_tokens:int=1000000):
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        # (model identity, text sha256 digest) -> tokens
+        self._entries:OrderedDict = OrderedDict()
+        self._nb_tokens = 0
+        self._identity:str = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clears = 0
+
+    @staticmethod
+    def key(identity:str, text:str)->Tuple:
+        return (identity, hashlib.sha256(text.encode("utf-8", "surrogatepass")).digest())
+
+    def get(self, identity:str, text:str)->Optional[Tuple]:
+        """Returns the cached tokens of the text, or None"""
+        key = self.key(identity, text)
+        with self._lock:
+            if identity!=self._identity:
+                self._switch(identity)
+            tokens = self._entries.get(key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def put(self, identity:str, text:str, tokens:List[Any])->Tuple:
+        """Caches the tokens of the text and returns them as a tuple (cached values must not be modified)"""
+        tokens = tuple(tokens)
+        if len(tokens)>self.max_tokens//4:
+            return tokens
+        key = self.key(identity, text)
+        with self._lock:
+            if identity!=self._identity:
+                self._switch(identity)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nb_tokens -= len(previous)
+            self._entries[key] = tokens
+            self._nb_tokens += len(tokens)
+            while len(self._entries)>self.max_entries or self._nb_tokens>self.max_tokens:
+                _, evicted = self._entries.popitem(last=False)
+                self._nb_tokens -= len(evicted)
+                self.evictions += 1
+        return tokens
+
+    def _switch(self, identity:str):
+        # Another model: its tokens differ, the cached ones would only take memory
+        if self._identity is not None and len(self._entries)>0:
+            self._entries.clear()
+            self._nb_tokens = 0
+            self.clears += 1
+        self._identity = identity
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nb_tokens = 0
+            self.clears += 1
+
+    def get_stats(self)->Dict[str, Any]:
+        with self._lock:
+            requests = self.hits+self.misses
+            return {
+                "model_identity": self._identity,
+                "entries": len(self._entries),
+                "tokens": self._nb_tokens,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits/requests if requests>0 else 0,
+                "evictions": self.evictions,
+                "clears": self.clears
+            }
@@ -17,7 +17,7 @@ import subprocess
 import gc
 import shutil
 
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from PIL import Image
 import requests
@@ -195,6 +195,14 @@ def get_media_type(file_path):
     else:
         return media_type
 
+def path_signature(path:Path)->Tuple:
+    """Changes when the file is replaced or modified, or when entries are added to or removed from the folder"""
+    try:
+        stat = path.stat()
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size if path.is_file() else 0)
+    except OSError:
+        return None
+
 
 def app_path_to_url(file_path:str|Path)->str:
     """
@@ -0,0 +1,86 @@
+# Title DiscussionsDB micro benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Measures the message insert/update rate of the discussions database.
+# The "legacy" mode reproduces the old behavior (a brand new sqlite3 connection and
+# a commit per statement, default rollback journal) while the "pooled" mode goes
+# through DiscussionsDB and its per thread WAL connection pool.
+#
+# usage: python tests/benchmarks/discussions_db_benchmark.py --messages 500 --updates 20
+
+import argparse
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB
+
+
+INSERT_QUERY = "INSERT INTO message (sender, message_type, sender_type, content, rank, parent_message_id, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+UPDATE_QUERY = "UPDATE message SET content = ?, finished_generating_at = ? WHERE id = ?"
+
+
+def legacy_insert(db_file, query, params):
+    with sqlite3.connect(db_file) as conn:
+        cursor = conn.execute(query, params)
+        rowid = cursor.lastrowid
+        conn.commit()
+    return rowid
+
+def legacy_update(db_file, query, params):
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(query, params)
+        conn.commit()
+
+
+def run(db:DiscussionsDB, nb_messages, nb_updates, legacy):
+    discussion_id = db.insert("INSERT INTO discussion (title) VALUES (?)", ("benchmark",))
+    if legacy:
+        insert = lambda q, p: legacy_insert(db.discussion_db_file_path, q, p)
+        update = lambda q, p: legacy_update(db.discussion_db_file_path, q, p)
+    else:
+        insert = db.insert
+        update = db.update
+
+    start = time.perf_counter()
+    ids = [insert(INSERT_QUERY, ("user", 0, 0, f"message {i}", 0, 0, discussion_id)) for i in range(nb_messages)]
+    insert_time = time.perf_counter() - start
+
+    # Simulates streaming: each message receives several content updates
+    start = time.perf_counter()
+    for message_id in ids:
+        content = ""
+        for i in range(nb_updates):
+            content += f"chunk {i} "
+            update(UPDATE_QUERY, (content, "2024-01-01 00:00:00", message_id))
+    update_time = time.perf_counter() - start
+    return nb_messages/insert_time, nb_messages*nb_updates/update_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the discussions database insert/update rate.')
+    parser.add_argument('--messages', type=int, default=500, help='Number of messages to insert')
+    parser.add_argument('--updates', type=int, default=20, help='Number of content updates per message')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ["legacy", "pooled"]:
+            lollms_paths = SimpleNamespace(personal_discussions_path=Path(tmp))
+            db = DiscussionsDB(None, lollms_paths, mode)
+            if mode == "legacy":
+                # The legacy code used the default rollback journal
+                db.pool.pragmas["journal_mode"] = "DELETE"
+                db.pool.pragmas["synchronous"] = "FULL"
+            db.create_tables()
+            inserts, updates = run(db, args.messages, args.updates, mode=="legacy")
+            print(f"{mode:>7}: {inserts:10.0f} inserts/s {updates:10.0f} updates/s")
+            if mode == "pooled":
+                print(db.get_pool_stats())
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
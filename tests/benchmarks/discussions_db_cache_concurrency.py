@@ -0,0 +1,132 @@
+# Title DiscussionsDBCache concurrency test
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Several threads switch between many discussions databases at random and write/read messages
+# through the cached DiscussionsDB objects. Checks that:
+#   - no message is lost and each database only contains its own messages,
+#   - the cache never holds more than max_size databases,
+#   - the schema of each database file is checked once per process,
+#   - idle connections are closed by the janitor and transparently reopened,
+#   - a database evicted while still held is handed back instead of being opened a second time.
+# Also compares the time of a switch with the cache and with a fresh object (previous behavior).
+#
+# usage: python tests/benchmarks/discussions_db_cache_concurrency.py [--databases 20] [--threads 8] [--switches 200]
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB, DiscussionsDBCache
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--databases", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--switches", type=int, default=200)
+    parser.add_argument("--max_size", type=int, default=4)
+    args = parser.parse_args()
+
+    lollms_paths = SimpleNamespace(personal_discussions_path=Path(tempfile.mkdtemp()))
+    cache = DiscussionsDBCache(max_size=args.max_size, idle_timeout=1)
+    names = [f"db_{i}" for i in range(args.databases)]
+
+    checks = []
+    original_ensure_schema = DiscussionsDB.ensure_schema
+    def ensure_schema(self):
+        checked = original_ensure_schema(self)
+        if checked:
+            checks.append(self.discussion_db_name)
+        return checked
+    DiscussionsDB.ensure_schema = ensure_schema
+
+    written = {name: 0 for name in names}
+    written_lock = threading.Lock()
+    errors = []
+    max_seen = [0]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(args.switches):
+                name = rng.choice(names)
+                db = cache.get(SimpleNamespace(), lollms_paths, name)
+                max_seen[0] = max(max_seen[0], len(cache._entries))
+                discussion_id = db.select("SELECT id FROM discussion LIMIT 1", fetch_all=False)
+                if discussion_id is None:
+                    discussion_id = db.insert("INSERT INTO discussion (title) VALUES (?)", (name,))
+                else:
+                    discussion_id = discussion_id[0]
+                db.insert(
+                    "INSERT INTO message (sender, content, message_type, sender_type, rank, parent_message_id, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ("user", name, 0, 0, 0, 0, discussion_id)
+                )
+                with written_lock:
+                    written[name] += 1
+        except Exception as ex:
+            errors.append(ex)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter()-start
+    assert len(errors)==0, errors
+
+    # Every message is in its database, and only there
+    for name in names:
+        db = cache.get(SimpleNamespace(), lollms_paths, name)
+        rows = db.select("SELECT content, COUNT(*) FROM message GROUP BY content")
+        assert rows==([(name, written[name])] if written[name]>0 else []), (name, rows, written[name])
+    assert max_seen[0]<=args.max_size, max_seen[0]
+    assert len(cache._entries)<=args.max_size
+    # Schemas are checked once per file (the fresh objects created after an eviction reuse the check)
+    assert len(checks)==len(set(checks))==args.databases, checks
+
+    # Idle connections are closed by the janitor and reopened on demand
+    db = cache.get(SimpleNamespace(), lollms_paths, names[0])
+    db.select("SELECT COUNT(*) FROM message")
+    time.sleep(2.5)
+    assert db.pool.get_stats()["open_connections"]==0
+    assert db.select("SELECT COUNT(*) FROM message", fetch_all=False)[0]==written[names[0]]
+
+    # One object per file: the evicted database is still held here, so it comes back
+    held = cache.get(SimpleNamespace(), lollms_paths, names[0])
+    for name in names[1:args.max_size+1]:
+        cache.get(SimpleNamespace(), lollms_paths, name)
+    assert str(held.discussion_db_path.resolve()) not in cache._entries
+    assert cache.get(SimpleNamespace(), lollms_paths, names[0]) is held
+    del held
+
+    stats = cache.get_stats()
+    print(f"{args.threads} threads x {args.switches} switches over {args.databases} databases in {duration:.2f}s")
+    print(f"  hits {stats['hits']}, misses {stats['misses']}, evictions {stats['evictions']}, idle closed {stats['idle_closed']}")
+
+    # Cost of a switch: cached object vs a new object checking the schema (previous behavior)
+    DiscussionsDB.ensure_schema = original_ensure_schema
+    n = 50
+    start = time.perf_counter()
+    for i in range(n):
+        cache.get(SimpleNamespace(), lollms_paths, names[i%2]).select("SELECT COUNT(*) FROM discussion")
+    cached = (time.perf_counter()-start)/n
+    start = time.perf_counter()
+    for i in range(n):
+        db = DiscussionsDB(SimpleNamespace(), lollms_paths, names[i%2])
+        db.create_tables()
+        db.add_missing_columns()
+        db.select("SELECT COUNT(*) FROM discussion")
+        db.close()
+    fresh = (time.perf_counter()-start)/n
+    print(f"  switch: cached {cached*1000:.2f} ms, new object {fresh*1000:.2f} ms")
+    cache.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Title Discussion.format_discussion benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Formats synthetic discussions of 10, 100 and 1000 messages with a budget large enough to
+# include everything (the worst case) and reports the time per message, which should stay
+# flat if formatting is linear. The output is compared with the previous implementation that
+# re-tokenized the whole accumulated text for each message.
+#
+# usage: python tests/benchmarks/format_discussion_benchmark.py
+
+import argparse
+import re
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB, Discussion, Message
+
+
+class WordTokenizer:
+    """A small deterministic tokenizer (words and punctuation) standing in for a real model"""
+    def __init__(self, add_bos=False):
+        self.add_bos = add_bos
+        self.calls = 0
+    def tokenize(self, text):
+        self.calls += 1
+        return ([0] if self.add_bos else []) + [hash(t) for t in re.findall(r"\w+|[^\w\s]", text)]
+
+
+def legacy_format_discussion(discussion:Discussion, max_allowed_tokens, splitter_text):
+    formatted_text = ""
+    for message in reversed(discussion.messages):
+        formatted_message = f"{splitter_text}{message.sender.replace(':','').replace(splitter_text,'')}:\n{message.content}\n"
+        tokenized_message = discussion.lollms.model.tokenize(formatted_message)
+        if len(tokenized_message) + len(discussion.lollms.model.tokenize(formatted_text)) <= max_allowed_tokens:
+            formatted_text = formatted_message + formatted_text
+        else:
+            break
+    return formatted_text
+
+
+def build_discussion(db, model, nb_messages):
+    lollms = SimpleNamespace(config=SimpleNamespace(discussion_prompt_separator="!@>"), model=model)
+    discussion = Discussion(lollms, 0, db)
+    discussion.messages = [
+        Message(0, db, 0, 0, "user" if i%2==0 else "assistant", f"This is message number {i}. " * 20, id=i+1)
+        for i in range(nb_messages)
+    ]
+    return discussion
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks Discussion.format_discussion.')
+    parser.add_argument('--sizes', type=int, nargs="+", default=[10, 100, 1000], help='Discussion sizes')
+    parser.add_argument('--budget', type=int, default=10**9, help='Token budget (large = everything fits)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DiscussionsDB(None, SimpleNamespace(personal_discussions_path=Path(tmp)), "bench")
+        for add_bos in [False, True]:
+            print(f"tokenizer with bos token: {add_bos}")
+            for size in args.sizes:
+                model = WordTokenizer(add_bos)
+                discussion = build_discussion(db, model, size)
+                for budget in [args.budget, size*60]:    # everything fits / the budget is reached halfway
+                    start = time.perf_counter()
+                    text = discussion.format_discussion(budget)
+                    duration = time.perf_counter() - start
+                    calls = model.calls
+                    model.calls = 0
+                    line = f"  {size:5d} messages, budget {budget:>10}: {duration*1000:9.2f} ms ({duration/size*1e6:7.1f} us/message, {calls} tokenize calls)"
+                    if size<=1000:
+                        legacy_start = time.perf_counter()
+                        expected = legacy_format_discussion(discussion, budget, "!@>")
+                        legacy_duration = time.perf_counter() - legacy_start
+                        line += f" legacy: {legacy_duration*1000:9.2f} ms, same output: {text==expected}"
+                        model.calls = 0
+                    print(line)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Title Message rank concurrency test
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Many threads vote up and down on the same messages at the same time. The rank changes are single
+# atomic statements, so the final rank of each message must be exactly the sum of its votes.
+# The previous read-then-write implementation is run on the same load to show the votes it loses.
+# Also checks the bulk rating API (rate_messages) and measures its throughput.
+#
+# usage: python tests/benchmarks/message_rank_concurrency.py [--threads 16] [--votes 500] [--messages 5]
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB, Discussion
+
+
+def legacy_rank_change(db:DiscussionsDB, message_id, delta):
+    """The previous implementation: read the rank, then write it back"""
+    current_rank = db.select("SELECT rank FROM message WHERE id=?", (message_id,), False)[0]
+    db.update("UPDATE message SET rank = ? WHERE id = ?", (current_rank+delta, message_id))
+
+
+def run_votes(vote, message_ids, threads, votes):
+    expected = {message_id: 0 for message_id in message_ids}
+    lock = threading.Lock()
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = {message_id: 0 for message_id in message_ids}
+        barrier.wait()
+        try:
+            for _ in range(votes):
+                message_id = rng.choice(message_ids)
+                delta = 1 if rng.random()<0.7 else -1
+                vote(message_id, delta)
+                local[message_id] += delta
+        except Exception as ex:
+            errors.append(ex)
+        with lock:
+            for message_id, delta in local.items():
+                expected[message_id] += delta
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert len(errors)==0, errors
+    return expected, time.perf_counter()-start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--votes", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=5)
+    args = parser.parse_args()
+
+    db = DiscussionsDB(SimpleNamespace(), SimpleNamespace(personal_discussions_path=Path(tempfile.mkdtemp())), "ranks", flush_interval_ms=0)
+    db.ensure_schema()
+    discussion = db.create_discussion("ranks")
+    message_ids = [
+        db.insert(
+            "INSERT INTO message (sender, content, message_type, sender_type, rank, parent_message_id, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ("lollms", f"answer {i}", 0, 1, 0, 0, discussion.discussion_id)
+        )
+        for i in range(args.messages)
+    ]
+
+    def ranks():
+        return dict(db.select(f"SELECT id, rank FROM message WHERE id IN ({','.join('?'*len(message_ids))})", message_ids))
+
+    def reset():
+        db.update("UPDATE message SET rank = 0", ())
+
+    total_votes = args.threads*args.votes
+    d = Discussion(SimpleNamespace(), discussion.discussion_id, db)
+    expected, duration = run_votes(lambda message_id, delta: d.message_rank_up(message_id) if delta>0 else d.message_rank_down(message_id), message_ids, args.threads, args.votes)
+    assert ranks()==expected, (ranks(), expected)
+    print(f"{total_votes} concurrent votes from {args.threads} threads")
+    print(f"  atomic     : {duration*1000:8.1f} ms, no vote lost")
+
+    reset()
+    expected, duration = run_votes(lambda message_id, delta: legacy_rank_change(db, message_id, delta), message_ids, args.threads, args.votes)
+    lost = sum(abs(expected[message_id]-rank) for message_id, rank in ranks().items())
+    print(f"  read/write : {duration*1000:8.1f} ms, {lost} rank points lost")
+
+    # The new rank is returned and missing messages are reported
+    reset()
+    assert d.message_rank_up(message_ids[0])==1
+    assert d.message_rank_down(message_ids[0])==0
+    assert d.message_rank_up(10**9) is None
+
+    # Bulk rating: votes are added, absolute values replace the ranks
+    reset()
+    rng = random.Random(0)
+    ratings = [(rng.choice(message_ids), rng.choice([1, -1])) for _ in range(100000)]
+    expected = {message_id: 0 for message_id in message_ids}
+    for message_id, value in ratings:
+        expected[message_id] += value
+    start = time.perf_counter()
+    applied = db.rate_messages(ratings+[(10**9, 1)])
+    duration = time.perf_counter()-start
+    assert applied==len(ratings), applied
+    assert ranks()==expected
+    assert db.rate_messages([(message_ids[0], 5)], relative=False)==1
+    assert ranks()[message_ids[0]]==5
+    print(f"  bulk       : {len(ratings)} ratings in {duration*1000:.1f} ms")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Title Discussion.get_messages memory benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Loads a discussion of 10k messages (with steps and metadata) and compares the memory held
+# by the loaded messages and the loading time of the slotted Message objects built by the row
+# factory (json decoded lazily) with the previous implementation (one dict per row, a full
+# object with a __dict__ per message and the steps decoded up front).
+#
+# usage: python tests/benchmarks/messages_memory_benchmark.py [--messages 10000]
+
+import argparse
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.discussions_database import DiscussionsDB, Discussion, Message
+
+
+class LegacyMessage:
+    """The message object as it was built before (no slots, steps decoded in the constructor)"""
+    def __init__(self, discussion_id, discussions_db, message_type, sender_type, sender, content, steps=[], metadata=None, ui=None, rank=0,
+                 parent_message_id=0, binding="", model="", personality="", created_at=None, started_generating_at=None,
+                 finished_generating_at=None, nb_tokens=None, id=None):
+        self.discussion_id      = discussion_id
+        self.discussions_db     = discussions_db
+        self.self               = self
+        self.sender             = sender
+        self.sender_type        = sender_type
+        self.content            = content
+        try:
+            self.steps          = steps if type(steps)==list else json.loads(steps)
+        except:
+            self.steps          = []
+        self.message_type       = message_type
+        self.rank               = rank
+        self.parent_message_id  = parent_message_id
+        self.binding            = binding
+        self.model              = model
+        self.metadata           = json.dumps(metadata, indent=4) if metadata is not None and type(metadata)== dict else metadata
+        self.ui                 = ui
+        self.personality        = personality
+        self.created_at         = created_at
+        self.started_generating_at  = started_generating_at
+        self.finished_generating_at = finished_generating_at
+        self.nb_tokens              = nb_tokens
+        self.tokens_counts          = {}
+        self.id = id
+
+
+def legacy_get_messages(discussion:Discussion):
+    columns = Message.get_fields()
+    rows = discussion.discussions_db.select(
+        f"SELECT {','.join(columns)} FROM message WHERE discussion_id=? ORDER BY id", (discussion.discussion_id,)
+    )
+    msg_dict = [{ c:row[i] for i,c in enumerate(columns)} for row in rows]
+    messages = []
+    for msg in msg_dict:
+        msg["discussions_db"] = discussion.discussions_db
+        messages.append(LegacyMessage(**msg))
+    return messages
+
+
+def measure(load):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = load()
+    duration = time.perf_counter()-start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return messages, duration, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp())
+    db = DiscussionsDB(SimpleNamespace(), SimpleNamespace(personal_discussions_path=folder), "benchmark", flush_interval_ms=0)
+    db.create_tables()
+    db.add_missing_columns()
+    discussion = db.create_discussion("benchmark")
+    steps = json.dumps([{"id":i, "text":f"step {i}", "step_type":"step", "status":True, "done":True} for i in range(4)])
+    metadata = json.dumps({"model":"benchmark", "sources":[f"source {i}" for i in range(4)]})
+    with db.pool.connection() as conn:
+        conn.executemany(
+            "INSERT INTO message (sender, content, message_type, sender_type, rank, parent_message_id, steps, metadata, created_at, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                ("user" if i%2==0 else "lollms", f"message {i} "+"lorem ipsum dolor sit amet "*10, 0, i%2, 0, i, steps, metadata, "2024-01-01 00:00:00", discussion.discussion_id)
+                for i in range(args.messages)
+            ]
+        )
+
+    legacy, legacy_duration, legacy_current, legacy_peak = measure(lambda: legacy_get_messages(discussion))
+    del legacy
+    messages, duration, current, peak = measure(lambda: Discussion(SimpleNamespace(), discussion.discussion_id, db).get_messages())
+    print(f"{args.messages} messages")
+    print(f"  legacy : {legacy_duration*1000:8.1f} ms, retained {legacy_current/1e6:7.2f} MB, peak {legacy_peak/1e6:7.2f} MB")
+    print(f"  slotted: {duration*1000:8.1f} ms, retained {current/1e6:7.2f} MB, peak {peak/1e6:7.2f} MB")
+    print(f"  memory saved: {(1-current/legacy_current)*100:.0f}% retained, {(1-peak/legacy_peak)*100:.0f}% peak, speedup x{legacy_duration/duration:.1f}")
+    # Steps are still available, decoded on first access
+    assert messages[0].steps[0]["text"]=="step 0"
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
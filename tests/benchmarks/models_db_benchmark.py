@@ -0,0 +1,164 @@
+# Title ModelsDB import and search benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Builds a synthetic models zoo yaml (tens of thousands of models with several variants each) and compares:
+#   - importing it with the previous implementation (one add_entry and one commit per model) and with
+#     import_from_yaml (executemany in a single transaction),
+#   - the previous keyword query (LEFT JOIN + name LIKE '%x%', everything returned) with a ranked page of search.
+# Then serves the zoo built the previous way (without description column nor indexes) through an indexed copy,
+# checks that the zoo file is left untouched and that the copy follows the zoo updates.
+#
+# usage: python tests/benchmarks/models_db_benchmark.py [--models 20000] [--variants 4]
+
+import argparse
+import hashlib
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from lollms.databases.models_database import ModelsDB
+
+
+FAMILIES = ["llama", "mistral", "qwen", "phi", "gemma", "falcon", "mixtral", "deepseek", "yi", "starcoder"]
+QUANTS = ["Q2_K", "Q3_K_M", "Q4_0", "Q4_K_M", "Q5_K_M", "Q6_K", "Q8_0"]
+
+
+def build_zoo(nb_models, nb_variants):
+    rng = random.Random(0)
+    zoo = []
+    for i in range(nb_models):
+        family = rng.choice(FAMILIES)
+        size = rng.choice([1, 3, 7, 8, 13, 34, 70])
+        name = f"{family}-{size}B-{rng.choice(['Instruct', 'Chat', 'Base', 'Code'])}-v{i}-GGUF"
+        zoo.append({
+            "category": "generic", "icon": "", "datasets": ["unknown"], "last_commit_time": f"2024-{1+i%12:02d}-{1+i%28:02d}T00:00:00",
+            "license": "apache-2.0", "model_creator": f"creator{i%300}", "model_creator_link": "", "name": name,
+            "quantizer": "TheBloke", "ctx_size": 4096, "rank": rng.random()*100, "type": "gguf",
+            "description": f"A {size} billion parameters {family} model fine tuned for {rng.choice(['chat', 'code', 'math', 'roleplay', 'translation'])}",
+            "variants": [{"name": f"{name.lower()}.{q}.gguf", "size": rng.randint(10**9, 5*10**10)} for q in rng.sample(QUANTS, nb_variants)]
+        })
+    return zoo
+
+
+def legacy_import(db_path, zoo):
+    """The previous ModelsDB.add_entry loop: a lookup, inserts and a commit per model"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS models (id INTEGER PRIMARY KEY, category TEXT, icon TEXT, datasets TEXT, last_commit_time TEXT, license TEXT, model_creator TEXT, model_creator_link TEXT, name TEXT UNIQUE, quantizer TEXT, ctx_size INTEGER, rank REAL, type TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS variants (id INTEGER PRIMARY KEY, model_id INTEGER, name TEXT, size INTEGER, FOREIGN KEY(model_id) REFERENCES models(id))")
+    conn.commit()
+    for entry in zoo:
+        cursor.execute("SELECT id FROM models WHERE name=?", (entry.get('name'),))
+        if cursor.fetchone() is None:
+            data = (entry.get('category'), entry.get('icon'), ','.join(entry['datasets']), entry.get('last_commit_time'), entry.get('license'),
+                    entry.get('model_creator'), entry.get('model_creator_link'), entry.get('name'), entry.get('quantizer'), entry.get('ctx_size', 4096), entry.get('rank'), entry.get('type'))
+            cursor.execute("INSERT INTO models VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", data)
+            model_id = cursor.lastrowid
+            for variant in entry.get('variants', []):
+                cursor.execute("INSERT INTO variants VALUES (NULL, ?, ?, ?)", (model_id, variant.get('name'), variant.get('size')))
+        conn.commit()
+    return conn
+
+
+def legacy_query(conn, keyword):
+    rows = conn.execute(
+        "SELECT models.*, variants.name as variant_name, variants.size as variant_size FROM models LEFT JOIN variants ON models.id = variants.model_id WHERE 1=1 AND models.name LIKE ?",
+        ('%'+keyword+'%',)
+    ).fetchall()
+    models = {}
+    for row in rows:
+        models.setdefault(row[0], {"name": row[8], "variants": []})["variants"].append({"name": row[13], "size": row[14]})
+    return list(models.values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, default=20000)
+    parser.add_argument("--variants", type=int, default=4)
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp())
+    zoo = build_zoo(args.models, args.variants)
+    yaml_path = folder/"zoo.yaml"
+    with open(yaml_path, "w") as f:
+        yaml.safe_dump(zoo, f)
+    print(f"{args.models} models, {args.models*args.variants} variants")
+
+    start = time.perf_counter()
+    legacy_conn = legacy_import(folder/"legacy.db", zoo)
+    legacy_import_time = time.perf_counter()-start
+
+    db = ModelsDB(folder/"models.db")
+    start = time.perf_counter()
+    added = db.add_entries(zoo)
+    import_time = time.perf_counter()-start
+    assert added==args.models
+    print(f"  import (without yaml parsing): previous {legacy_import_time:6.2f}s, now {import_time:6.2f}s")
+    # Importing again adds nothing
+    assert db.import_from_yaml(yaml_path)==0
+
+    start = time.perf_counter()
+    legacy_results = legacy_query(legacy_conn, "mistral-7B")
+    legacy_query_time = time.perf_counter()-start
+    start = time.perf_counter()
+    page = db.search("mistral 7B", limit=50)
+    search_time = time.perf_counter()-start
+    print(f"  keyword search: previous {legacy_query_time*1000:7.1f}ms ({len(legacy_results)} models returned at once), now {search_time*1000:7.1f}ms (page of 50 out of {page['total']})")
+    assert page["total"]==len(legacy_results)
+    assert all(m["name"].lower().startswith("mistral-7b") for m in page["models"])
+    assert all(len(m["variants"])==args.variants for m in page["models"])
+
+    for name, call in [
+        ("browse newest page 100", lambda: db.search(limit=50, offset=5000)),
+        ("browse by rank", lambda: db.search(limit=50, sort_by="rank")),
+        ("description search", lambda: db.search("roleplay llama 70", limit=20)),
+        ("variant filter", lambda: db.search(variant_name=zoo[123]["variants"][0]["name"])),
+    ]:
+        start = time.perf_counter()
+        result = call()
+        print(f"  {name:<24}: {(time.perf_counter()-start)*1000:7.1f}ms, {result['total']} matches")
+    assert db.search(variant_name=zoo[123]["variants"][0]["name"])["models"][0]["name"]==zoo[123]["name"]
+    ranks = [m["rank"] for m in db.search(limit=50, sort_by="rank")["models"]]
+    assert ranks==sorted(ranks, reverse=True)
+
+    # The former query API keeps its behavior
+    newest = db.query(n=3, model_types=["gguf"])
+    assert len(newest)==3 and newest[0]["last_commit_time"]>=newest[-1]["last_commit_time"]
+    assert sorted(m["name"] for m in db.query(keyword="mistral-7B"))==sorted(m["name"] for m in legacy_results)
+    assert len(db.query(keyword="B-Chat-v1"))==len(legacy_query(legacy_conn, "B-Chat-v1"))
+    db.remove_entry(zoo[0]["name"])
+    assert db.search(zoo[0]["name"])["total"]==0
+    db.close()
+
+    # A zoo file of the git clone, only read
+    legacy_conn.close()
+    zoo_path = folder/"legacy.db"
+    digest = hashlib.sha256(zoo_path.read_bytes()).hexdigest()
+    start = time.perf_counter()
+    served = ModelsDB(folder/"cache"/"legacy.db", source=zoo_path)
+    print(f"  indexed copy of the zoo: {(time.perf_counter()-start)*1000:7.1f}ms")
+    assert served.search("mistral 7B", limit=50)["total"]==len(legacy_results)
+    assert len(served.query(keyword="mistral-7B"))==len(legacy_results)
+    assert not served.sync()
+    served.close()
+    served = ModelsDB(folder/"cache"/"legacy.db", source=zoo_path)
+    assert served.search(limit=1)["total"]==args.models
+    assert hashlib.sha256(zoo_path.read_bytes()).hexdigest()==digest
+    assert sorted(p.name for p in folder.iterdir() if p.name.startswith("legacy"))==["legacy.db"]
+    # Zoo update
+    conn = sqlite3.connect(zoo_path)
+    conn.execute("DELETE FROM models WHERE name=?", (zoo[1]["name"],))
+    conn.commit()
+    conn.close()
+    assert served.sync()
+    assert served.search(zoo[1]["name"])["total"]==0 and served.search(limit=1)["total"]==args.models-1
+    served.close()
+
+
+if __name__ == "__main__":
+    main()
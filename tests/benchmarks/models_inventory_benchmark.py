@@ -0,0 +1,109 @@
+# Title Models inventory benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Builds a binding like models setup (models folders with installed models, a models zoo database) and
+# compares what a UI refresh costs (list_models + get_available_models) without and with the
+# ModelsInventory cache, then checks that installing a model or updating the zoo is seen right away.
+#
+# usage: python tests/benchmarks/models_inventory_benchmark.py [--installed 300] [--zoo 5000] [--refreshes 200]
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from lollms.databases.models_database import ModelsDB
+from lollms.models_inventory import ModelsInventory
+
+
+class FolderBinding:
+    """The parts of LLMBinding the inventory relies on, with the listing code of LLMBinding"""
+    def __init__(self, root:Path, models_dir_names):
+        self.models_dir_names = models_dir_names
+        self.models_folders = [root/"models"/name for name in models_dir_names]
+        self.lollms_paths = SimpleNamespace(models_zoo_path=root/"zoo")
+        for folder in self.models_folders:
+            folder.mkdir(parents=True, exist_ok=True)
+        self.lollms_paths.models_zoo_path.mkdir(parents=True, exist_ok=True)
+
+    def list_models(self):
+        models = []
+        for models_folder in self.models_folders:
+            models+=[f.name for f in models_folder.iterdir() if f.is_dir() and not f.stem.startswith(".") or f.suffix==".reference"]
+        return models
+
+    def get_available_models(self, app=None):
+        # As before: the zoo database is opened on every call
+        full_data = []
+        for models_dir_name in self.models_dir_names:
+            full_data+=ModelsDB(self.lollms_paths.models_zoo_path/f"{models_dir_name}.db").query()
+        return full_data
+
+
+def zoo_entry(i):
+    return {"name": f"model-{i}-GGUF", "last_commit_time": f"2024-01-{1+i%28:02d}", "type": "gguf", "rank": i,
+            "variants": [{"name": f"model-{i}.Q4_K_M.gguf", "size": 4*10**9}]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--installed", type=int, default=300)
+    parser.add_argument("--zoo", type=int, default=5000)
+    parser.add_argument("--refreshes", type=int, default=200)
+    args = parser.parse_args()
+
+    binding = FolderBinding(Path(tempfile.mkdtemp()), ["gguf"])
+    for i in range(args.installed):
+        (binding.models_folders[0]/f"model-{i}-GGUF").mkdir()
+    zoo_path = binding.lollms_paths.models_zoo_path/"gguf.db"
+    db = ModelsDB(zoo_path)
+    db.add_entries([zoo_entry(i) for i in range(args.zoo)])
+    db.close()
+
+    def refresh(source):
+        return source.list_models(), source.get_available_models(None)
+
+    start = time.perf_counter()
+    for _ in range(max(1, args.refreshes//10)):
+        expected = refresh(binding)
+    uncached = (time.perf_counter()-start)/max(1, args.refreshes//10)
+
+    inventory = ModelsInventory(binding, max_age=None)
+    assert refresh(inventory)==expected
+    start = time.perf_counter()
+    for _ in range(args.refreshes):
+        refresh(inventory)
+    cached = (time.perf_counter()-start)/args.refreshes
+    print(f"{args.installed} installed models, {args.zoo} models in the zoo")
+    print(f"  refresh without cache       : {uncached*1000:9.3f}ms")
+    print(f"  refresh with cache (polling): {cached*1000:9.3f}ms")
+
+    # Installing a model changes the folder
+    (binding.models_folders[0]/"new-model-GGUF").mkdir()
+    assert "new-model-GGUF" in inventory.list_models()
+    # Updating the zoo changes the database
+    db = ModelsDB(zoo_path)
+    db.add_entry(zoo_entry(args.zoo))
+    db.close()
+    assert len(inventory.get_available_models()) == args.zoo+1
+
+    if inventory.start_watching():
+        refresh(inventory)
+        start = time.perf_counter()
+        for _ in range(args.refreshes):
+            refresh(inventory)
+        watched = (time.perf_counter()-start)/args.refreshes
+        print(f"  refresh with cache (watching): {watched*1000:8.3f}ms")
+        (binding.models_folders[0]/"watched-model-GGUF").mkdir()
+        deadline = time.monotonic()+5
+        while "watched-model-GGUF" not in inventory.list_models() and time.monotonic()<deadline:
+            time.sleep(0.05)
+        assert "watched-model-GGUF" in inventory.list_models()
+        inventory.stop_watching()
+    print(f"  {inventory.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
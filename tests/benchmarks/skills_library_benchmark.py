@@ -0,0 +1,123 @@
+# Title SkillsLibrary storage benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Fills a skills library with 100k skills using the previous schema (no indexes, an empty standalone
+# FTS table), opens it with SkillsLibrary (which migrates it) and compares the listing and lookup
+# queries with the previous implementation (a new connection per call, categories deduplicated in
+# python, LIKE '%x%' scans).
+#
+# usage: python tests/benchmarks/skills_library_benchmark.py [--skills 100000]
+
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from lollms.databases.skills_database import SkillsLibrary
+
+
+WORDS = ["python", "sqlite", "docker", "linux", "git", "numpy", "fastapi", "regex", "css", "rust",
+         "kubernetes", "pandas", "torch", "react", "bash", "nginx", "redis", "postgres", "json", "yaml"]
+
+
+def create_legacy_db(db_path:Path, nb_skills:int):
+    rng = random.Random(0)
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE skills_library (id INTEGER PRIMARY KEY, version INTEGER, category TEXT, title TEXT, content TEXT, new_column TEXT)")
+    conn.execute("CREATE TABLE db_info (version INTEGER)")
+    conn.execute("INSERT INTO db_info (version) VALUES (2)")
+    conn.execute("CREATE VIRTUAL TABLE skills_library_fts USING fts5(category, title, content)")
+    conn.executemany(
+        "INSERT INTO skills_library (version, category, title, content) VALUES (?, ?, ?, ?)",
+        [
+            (1, f"category {i%50}", f"{rng.choice(WORDS)} {rng.choice(WORDS)} skill {i}", " ".join([rng.choice(WORDS) for _ in range(3)]+[f"word{int(rng.paretovariate(1))%20000}" for _ in range(200)]))
+            for i in range(nb_skills)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_query(db_path, query, params=()):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    res = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return res
+
+
+def timed(function, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter()-start)/repeat*1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skills", type=int, default=100000)
+    args = parser.parse_args()
+
+    db_path = Path(tempfile.mkdtemp())/"skills.sqlite"
+    create_legacy_db(db_path, args.skills)
+
+    rows = [
+        ("categories",
+         lambda: list(set(r[0] for r in legacy_query(db_path, "SELECT category FROM skills_library"))),
+         lambda: library.get_categories()),
+        ("titles of a category",
+         lambda: legacy_query(db_path, "SELECT id, title FROM skills_library WHERE category=?", ("category 7",)),
+         lambda: library.get_titles_by_category("category 7")),
+        ("all titles",
+         lambda: legacy_query(db_path, "SELECT id, title FROM skills_library"),
+         lambda: library.get_titles()),
+        ("dump (page of 50)",
+         lambda: [[r[0], r[1], r[2], r[3]] for r in legacy_query(db_path, "SELECT * FROM skills_library")],
+         lambda: library.dump(50, 1000)),
+        ("listing page 100 of 50",
+         lambda: legacy_query(db_path, "SELECT id, category, title FROM skills_library ORDER BY title LIMIT 50 OFFSET 5000"),
+         lambda: library.list_skills(limit=50, offset=5000)),
+        ("text lookup",
+         lambda: legacy_query(db_path, "SELECT * FROM skills_library WHERE category LIKE ? OR title LIKE ? OR content LIKE ?", ("%docker%",)*3)[:20],
+         lambda: library.query_entry("docker kubernetes", limit=20)),
+        ("get skill",
+         lambda: legacy_query(db_path, "SELECT id, category, title, content FROM skills_library WHERE id = ?", (4242,)),
+         lambda: library.get_skill(4242)),
+    ]
+    # The previous implementation runs on the database before its migration
+    legacy_times = [timed(legacy)[1] for _, legacy, _ in rows]
+    start = time.perf_counter()
+    library = SkillsLibrary(db_path)
+    migration = time.perf_counter()-start
+    print(f"{args.skills} skills, migration (indexes + full text index): {migration:.2f}s")
+    print(f"  {'query':<24}{'previous':>12}{'now':>12}")
+    for (name, _, new), legacy_ms in zip(rows, legacy_times):
+        _, new_ms = timed(new)
+        print(f"  {name:<24}{legacy_ms:>10.2f}ms{new_ms:>10.2f}ms")
+
+    # Results
+    assert sorted(library.get_categories())==sorted({f"category {i%50}" for i in range(args.skills)})
+    assert len(library.get_titles_by_category("category 7"))==len([i for i in range(args.skills) if i%50==7])
+    page = library.list_skills(category="category 3", limit=10)
+    assert page["total"]==len([i for i in range(args.skills) if i%50==3]) and len(page["skills"])==10
+    assert [s["title"] for s in page["skills"]]==sorted(s["title"] for s in page["skills"])
+    for entry in library.query_entry("docker kubernetes", limit=20):
+        assert "docker" in entry[3]+" "+entry[4] and "kubernetes" in entry[3]+" "+entry[4]
+    # The full text index follows the table
+    skill_id = library.add_entry(1, "cooking", "pancakes recipe", "flour eggs milk")
+    assert [r[0] for r in library.query_entry("pancak")]==[skill_id]
+    library.update_skill(skill_id, "cooking", "waffles recipe", "flour eggs milk")
+    assert library.query_entry("pancakes")==[] and len(library.query_entry("waffles"))==1
+    assert library.list_skills(title="waff")["total"]==1
+    library.remove_entry(skill_id)
+    assert library.query_entry("waffles")==[]
+    library.close()
+
+
+if __name__ == "__main__":
+    main()
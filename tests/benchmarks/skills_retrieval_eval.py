@@ -0,0 +1,163 @@
+# Title Skills retrieval offline evaluation
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Compares the keyword (bm25), vector and hybrid (reciprocal rank fusion) skill retrieval of
+# SkillsLibrary on a synthetic corpus where the skill answering each query is known.
+# Each skill is about a few rare terms drowned in common words. Three kinds of queries are asked:
+#   - keywords   : short queries made of the exact rare terms of the skill
+#   - variants   : the same terms with other endings (plural, -ing, -ed...), which exact keyword matching misses
+#   - mixed      : one exact term and one variant, inside a sentence of common words
+# Reports recall@k and the latency percentiles of each method, then checks that queries made of common
+# words only (sharing words with every skill but about none of them) retrieve nothing by keywords.
+#
+# By default a character trigram hashing vectorizer is used so the script runs offline.
+# Use --vectorizer semantic [--model BAAI/bge-m3] to evaluate with a real embedding model.
+#
+# usage: python tests/benchmarks/skills_retrieval_eval.py [--skills 5000] [--queries 300] [--k 3] [--rrf_k 60] [--candidates 6]
+
+import argparse
+import random
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from lollms.databases.skills_database import SkillsLibrary
+
+
+COMMON = ("how to use the with for and a in of on make write configure simple quick guide example "
+          "project code file data using when then your this that from into best way tips setup").split()
+SUFFIXES = ["s", "ing", "ed", "er", "ation"]
+
+
+class TrigramVectorizer:
+    """Hashes the character trigrams of the words, so words sharing a stem get close vectors"""
+    requires_fitting = False
+
+    def __init__(self, dimension=1024):
+        self.dimension = dimension
+
+    def vectorize(self, texts):
+        vectors = []
+        for text in texts:
+            vector = np.zeros(self.dimension, dtype=np.float32)
+            for word in text.lower().split():
+                word = f"#{word}#"
+                for i in range(len(word)-2):
+                    vector[zlib.crc32(word[i:i+3].encode())%self.dimension] += 1
+            vectors.append(vector)
+        return vectors
+
+
+class EvalSkillsLibrary(SkillsLibrary):
+    vectorizer_kind = "trigram"
+    model_name = None
+
+    def get_vectorizer_id(self):
+        return f"{self.vectorizer_kind}:{self.model_name}"
+
+    def _create_vectorizer(self):
+        if self.vectorizer_kind=="semantic":
+            from lollmsvectordb.lollms_vectorizers.semantic_vectorizer import SemanticVectorizer
+            return SemanticVectorizer(self.model_name)
+        return TrigramVectorizer()
+
+
+def make_word(rng:random.Random):
+    consonants = "bcdfghklmnprstvz"
+    vowels = "aeiou"
+    return "".join(rng.choice(consonants)+rng.choice(vowels) for _ in range(rng.randint(3, 4)))
+
+
+def build_corpus(rng:random.Random, nb_skills:int):
+    vocabulary = list({make_word(rng) for _ in range(nb_skills*2)})
+    skills = []
+    for i in range(nb_skills):
+        terms = rng.sample(vocabulary, 3)
+        title = f"{' '.join(terms[:2])} {rng.choice(COMMON)}"
+        content = " ".join(
+            [rng.choice(terms) for _ in range(6)]+[rng.choice(COMMON) for _ in range(60)]+[rng.choice(vocabulary) for _ in range(4)]
+        )
+        skills.append({"category": f"category {i%20}", "title": title, "content": content, "terms": terms})
+    return skills
+
+
+def build_queries(rng:random.Random, skills, nb_queries:int):
+    queries = []
+    for kind in ["keywords", "variants", "mixed"]:
+        for _ in range(nb_queries//3):
+            target = rng.randrange(len(skills))
+            terms = rng.sample(skills[target]["terms"], 2)
+            if kind=="keywords":
+                text = " ".join(terms)
+            elif kind=="variants":
+                text = " ".join(term+rng.choice(SUFFIXES) for term in terms)
+            else:
+                text = " ".join(rng.sample(COMMON, 4)+[terms[0], terms[1]+rng.choice(SUFFIXES)])
+            queries.append((kind, text, target))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skills", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--budget_ms", type=float, default=300)
+    parser.add_argument("--rrf_k", type=int, default=60)
+    parser.add_argument("--candidates", type=int, default=None)
+    parser.add_argument("--vectorizer", choices=["trigram", "semantic"], default="trigram")
+    parser.add_argument("--model", default="BAAI/bge-m3")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    skills = build_corpus(rng, args.skills)
+    queries = build_queries(rng, skills, args.queries)
+
+    EvalSkillsLibrary.vectorizer_kind = args.vectorizer
+    EvalSkillsLibrary.model_name = args.model if args.vectorizer=="semantic" else "1024"
+    library = EvalSkillsLibrary(Path(tempfile.mkdtemp())/"skills.sqlite")
+    library.add_entries([(1, skill["category"], skill["title"], skill["content"]) for skill in skills])
+    start = time.perf_counter()
+    library.vector_index.load()
+    print(f"{args.skills} skills vectorized in {time.perf_counter()-start:.1f}s, {len(queries)} queries, recall@{args.k}")
+
+    methods = {
+        "keywords": lambda text: library.query(text, args.k, method="keywords"),
+        "vector": lambda text: library.query(text, args.k, method="vector"),
+        "hybrid": lambda text: library.query_hybrid(text, args.k, candidates=args.candidates, rrf_k=args.rrf_k, time_budget_ms=args.budget_ms),
+    }
+    kinds = ["keywords", "variants", "mixed"]
+    print(f"  {'method':<10}" + "".join(f"{kind:>10}" for kind in kinds) + f"{'all':>10}{'p50':>10}{'p95':>10}")
+    for name, method in methods.items():
+        hits = {kind: 0 for kind in kinds}
+        counts = {kind: 0 for kind in kinds}
+        latencies = []
+        for kind, text, target in queries:
+            start = time.perf_counter()
+            titles, _, _ = method(text)
+            latencies.append((time.perf_counter()-start)*1000)
+            counts[kind] += 1
+            if skills[target]["title"] in titles:
+                hits[kind] += 1
+        recall = {kind: hits[kind]/max(1, counts[kind]) for kind in kinds}
+        overall = sum(hits.values())/max(1, sum(counts.values()))
+        print(
+            f"  {name:<10}" + "".join(f"{recall[kind]:>10.2f}" for kind in kinds)
+            + f"{overall:>10.2f}{np.percentile(latencies, 50):>8.1f}ms{np.percentile(latencies, 95):>8.1f}ms"
+        )
+
+    off_topic = [" ".join(rng.sample(COMMON, 4)) for _ in range(20)]
+    assert all(len(library.query_bm25(text))==0 for text in off_topic)
+    details = library.query_details(off_topic[0], args.k)
+    assert all(d["score_type"]=="rrf" and d["similarity"] is not None for d in details)
+    print(f"  {len(off_topic)} common words queries: no keyword results")
+    library.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Title SkillsLibrary persistent vector index benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Builds a skills library, then measures a restart: the stored vectors are loaded from the database
+# and no skill is vectorized again. Checks that adding, editing and removing skills keeps the index
+# in sync, that skills modified directly in the database are vectorized again on the next search,
+# and that a vectorizer change rebuilds the index.
+# A small deterministic hashing vectorizer is used so the script runs without downloading a model,
+# it counts the texts it vectorizes.
+#
+# usage: python tests/benchmarks/skills_vector_index_benchmark.py [--skills 5000]
+
+import argparse
+import sqlite3
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from lollms.databases.skills_database import SkillsLibrary
+
+
+class HashingVectorizer:
+    requires_fitting = False
+
+    def __init__(self, dimension=256):
+        self.dimension = dimension
+        self.vectorized = 0
+
+    def vectorize(self, texts):
+        self.vectorized += len(texts)
+        vectors = []
+        for text in texts:
+            vector = np.zeros(self.dimension, dtype=np.float32)
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode())%self.dimension] += 1
+            vectors.append(vector)
+        return vectors
+
+
+class BenchmarkSkillsLibrary(SkillsLibrary):
+    vectorizer_name = "hashing-256"
+
+    def get_vectorizer_id(self):
+        return self.vectorizer_name
+
+    def _create_vectorizer(self):
+        self.created_vectorizer = HashingVectorizer()
+        return self.created_vectorizer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skills", type=int, default=5000)
+    args = parser.parse_args()
+
+    db_path = Path(tempfile.mkdtemp())/"skills.sqlite"
+    library = BenchmarkSkillsLibrary(db_path)
+    topics = ["python", "sqlite", "docker", "linux", "git", "numpy", "fastapi", "regex", "css", "rust"]
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO skills_library (version, category, title, content) VALUES (?, ?, ?, ?)",
+        [(1, topics[i%10], f"{topics[i%10]} skill {i}", f"how to use {topics[i%10]} number {i} " + " ".join(topics[(i+j*j)%10] for j in range(3))) for i in range(args.skills)]
+    )
+    conn.commit()
+    conn.close()
+
+    start = time.perf_counter()
+    titles, _, _ = library.query_vector_db("how to use sqlite", top_k=3)
+    first = time.perf_counter()-start
+    assert library.created_vectorizer.vectorized==args.skills+1
+    assert all("sqlite" in title for title in titles), titles
+
+    # Restart: opening the library doesn't load the vectorizer nor vectorize anything
+    start = time.perf_counter()
+    library = BenchmarkSkillsLibrary(db_path)
+    open_duration = time.perf_counter()-start
+    assert library.vector_index.get_stats()["vectorizer_loaded"] is False
+    start = time.perf_counter()
+    titles, _, _ = library.query_vector_db("how to use docker", top_k=3)
+    restart_search = time.perf_counter()-start
+    assert library.created_vectorizer.vectorized==1, library.created_vectorizer.vectorized
+    assert all("docker" in title for title in titles), titles
+
+    # Incremental updates
+    skill_id = library.add_entry(1, "cooking", "pancakes recipe", "flour eggs milk butter pancakes")
+    assert library.query_vector_db("pancakes flour eggs", top_k=1)[0]==["pancakes recipe"]
+    library.update_skill(skill_id, "cooking", "waffles recipe", "flour eggs milk butter waffles iron")
+    assert library.query_vector_db("waffles iron", top_k=1)[0]==["waffles recipe"]
+    library.remove_entry(skill_id)
+    assert "waffles recipe" not in library.query_vector_db("waffles iron", top_k=5)[0]
+    assert library.vector_index.get_stats()["vectors"]==args.skills
+
+    # Skills modified behind the library are vectorized again on next start
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE skills_library SET title='gardening tomatoes', content='tomatoes garden soil water' WHERE id=1")
+    conn.commit()
+    conn.close()
+    library = BenchmarkSkillsLibrary(db_path)
+    assert library.query_vector_db("tomatoes garden soil", top_k=1)[0]==["gardening tomatoes"]
+    assert library.created_vectorizer.vectorized==2
+
+    # A new vectorizer rebuilds everything
+    BenchmarkSkillsLibrary.vectorizer_name = "hashing-256-v2"
+    library = BenchmarkSkillsLibrary(db_path)
+    library.query_vector_db("python", top_k=1)
+    assert library.created_vectorizer.vectorized==args.skills+1
+
+    print(f"{args.skills} skills")
+    print(f"  first search (vectorizes the library) : {first*1000:8.1f} ms")
+    print(f"  restart: open                         : {open_duration*1000:8.1f} ms")
+    print(f"  restart: first search (loads vectors) : {restart_search*1000:8.1f} ms, 1 text vectorized")
+
+
+if __name__ == "__main__":
+    main()
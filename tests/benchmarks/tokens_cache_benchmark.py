@@ -0,0 +1,144 @@
+# Title Tokens cache benchmark
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Simulates the token counting done while building the prompts of a discussion (conditioning, user
+# description, boosts, message headers, the full prompt counted several times before generating)
+# with and without the tokens cache of LLMBinding, and checks that the cache gives the same results,
+# stays bounded and is cleared when the model changes.
+# A pure python greedy subword tokenizer stands for the model tokenizer, so that it runs offline.
+#
+# usage: python tests/benchmarks/tokens_cache_benchmark.py [--turns 50]
+
+import argparse
+import random
+import re
+import time
+
+from lollms.binding import LLMBinding
+from lollms.tokens_cache import TokensCache
+
+
+class SubwordTokenizer:
+    def __init__(self, rng:random.Random, vocabulary_size=20000):
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        pieces = set(letters)
+        while len(pieces)<vocabulary_size:
+            pieces.add("".join(rng.choice(letters) for _ in range(rng.randint(2, 6))))
+        self.vocabulary = {piece: i for i, piece in enumerate(sorted(pieces))}
+
+    def tokenize(self, text):
+        tokens = []
+        for word in re.findall(r"\w+|[^\w\s]", text.lower()):
+            start = 0
+            while start<len(word):
+                for end in range(min(len(word), start+6), start, -1):
+                    token = self.vocabulary.get(word[start:end])
+                    if token is not None or end==start+1:
+                        tokens.append(token if token is not None else -1)
+                        start = end
+                        break
+        return tokens
+
+
+class BenchBinding:
+    """Uses the counting methods of LLMBinding on top of the stand-in tokenizer"""
+    count_tokens = LLMBinding.count_tokens
+    tokenize_cached = LLMBinding.tokenize_cached
+    _cached_tokens = LLMBinding._cached_tokens
+    clear_tokens_cache = LLMBinding.clear_tokens_cache
+
+    def __init__(self, tokenizer:SubwordTokenizer, model_name="model-a"):
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.tokens_cache = TokensCache()
+        self.nb_tokenizations = 0
+
+    def get_model_identity(self):
+        return f"bench:{self.model_name}"
+
+    def tokenize(self, prompt):
+        self.nb_tokenizations += 1
+        return self.tokenizer.tokenize(prompt)
+
+
+def words(rng, n):
+    return " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(n))
+
+
+def build_turns(rng, nb_turns):
+    conditioning = words(rng, 1500)
+    user_description = words(rng, 200)
+    boost = words(rng, 40)
+    headers = ["!@>user:", "!@>assistant:"]
+    messages = []
+    turns = []
+    for _ in range(nb_turns):
+        messages += [words(rng, 60), words(rng, 150)]
+        prompt = conditioning+user_description+boost+"".join(headers[i%2]+m for i, m in enumerate(messages[-10:]))
+        turns.append((conditioning, user_description, boost, headers, prompt))
+    return turns
+
+
+def run(turns, count, tokenize):
+    results = []
+    for conditioning, user_description, boost, headers, prompt in turns:
+        results.append((
+            len(tokenize(conditioning)), len(tokenize(user_description)), count(boost),
+            [count(header) for header in headers],
+            # The prompt size is computed by the caller and again by generate
+            count(prompt), count(prompt)
+        ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    tokenizer = SubwordTokenizer(rng)
+    turns = build_turns(rng, args.turns)
+
+    binding = BenchBinding(tokenizer)
+    start = time.perf_counter()
+    expected = run(turns, lambda text: len(binding.tokenize(text)), binding.tokenize)
+    uncached = time.perf_counter()-start
+    uncached_tokenizations = binding.nb_tokenizations
+
+    binding = BenchBinding(tokenizer)
+    start = time.perf_counter()
+    results = run(turns, binding.count_tokens, binding.tokenize_cached)
+    cached = time.perf_counter()-start
+    assert results==expected
+    stats = binding.tokens_cache.get_stats()
+    print(f"{args.turns} prompts built")
+    print(f"  without cache: {uncached*1000:8.1f}ms, {uncached_tokenizations} tokenizations")
+    print(f"  with cache   : {cached*1000:8.1f}ms, {binding.nb_tokenizations} tokenizations, hit rate {stats['hit_rate']:.2f}")
+
+    # Returned lists can be modified without altering the cache
+    tokens = binding.tokenize_cached(turns[0][0])
+    tokens.clear()
+    assert binding.count_tokens(turns[0][0])==expected[0][0]
+    # Uncached counts leave the cache alone
+    entries = stats["entries"]
+    binding.count_tokens(words(rng, 100), use_cache=False)
+    assert binding.tokens_cache.get_stats()["entries"]==entries
+    # Another model clears the cache
+    binding.model_name = "model-b"
+    binding.count_tokens("hello")
+    stats = binding.tokens_cache.get_stats()
+    assert stats["entries"]==1 and stats["clears"]==1
+    # Bounded
+    small = TokensCache(max_entries=10, max_tokens=1000)
+    for i in range(100):
+        small.put("m", f"text {i}", list(range(50)))
+    stats = small.get_stats()
+    assert stats["entries"]<=10 and stats["tokens"]<=1000
+    assert small.put("m", "huge", list(range(600)))==tuple(range(600)) and small.get("m", "huge") is None
+    print(f"  {binding.tokens_cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
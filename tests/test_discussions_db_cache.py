@@ -0,0 +1,77 @@
+# Title DiscussionsDBCache tests
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# There must never be more than one DiscussionsDB object per database file, even when the cache
+# evicts databases that are still held by clients or discussions.
+#
+# usage: python -m pytest tests/test_discussions_db_cache.py
+
+import random
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from lollms.databases.discussions_database import DiscussionsDBCache
+
+
+@pytest.fixture
+def lollms_paths(tmp_path):
+    return SimpleNamespace(personal_discussions_path=tmp_path)
+
+
+@pytest.fixture
+def cache():
+    cache = DiscussionsDBCache(max_size=2, idle_timeout=0)
+    yield cache
+    cache.close_all()
+
+
+def test_evicted_database_held_elsewhere_is_handed_back(cache, lollms_paths):
+    held = cache.get(SimpleNamespace(), lollms_paths, "db_0")
+    for name in ["db_1", "db_2", "db_3"]:
+        cache.get(SimpleNamespace(), lollms_paths, name)
+    assert str(held.discussion_db_path.resolve()) not in cache._entries
+    assert cache.get(SimpleNamespace(), lollms_paths, "db_0") is held
+
+
+def test_added_database_is_not_duplicated(cache, lollms_paths):
+    held = cache.get(SimpleNamespace(), lollms_paths, "db_0")
+    for name in ["db_1", "db_2"]:
+        cache.get(SimpleNamespace(), lollms_paths, name)
+    cache.add(held)
+    assert cache.get(SimpleNamespace(), lollms_paths, "db_0") is held
+
+
+def test_one_object_per_file_under_concurrent_switches(cache, lollms_paths):
+    names = [f"db_{i}" for i in range(6)]
+    # Every object handed out is kept alive, so evicted databases stay referenced for the whole test
+    seen = {name: [] for name in names}
+    lock = threading.Lock()
+    errors = []
+    barrier = threading.Barrier(8)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        try:
+            for _ in range(100):
+                name = rng.choice(names)
+                db = cache.get(SimpleNamespace(), lollms_paths, name)
+                with lock:
+                    seen[name].append(db)
+                assert len(cache._entries)<=cache.max_size
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors==[]
+    for name, dbs in seen.items():
+        assert len({id(db) for db in dbs})<=1, name
+    assert cache.evictions>0
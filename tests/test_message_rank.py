@@ -0,0 +1,115 @@
+# Title Message rank tests
+# Licence: Apache 2.0
+# Author : Paris Neo
+#
+# Rank changes are single atomic statements: concurrent votes, mixed with concurrent message inserts,
+# must neither be lost nor counted twice, and the bulk rating API must give the same ranks.
+#
+# usage: python -m pytest tests/test_message_rank.py
+
+import random
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from lollms.databases.discussions_database import DiscussionsDB, Discussion
+
+INSERT_MESSAGE = "INSERT INTO message (sender, content, message_type, sender_type, rank, parent_message_id, discussion_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DiscussionsDB(SimpleNamespace(), SimpleNamespace(personal_discussions_path=tmp_path), "ranks", flush_interval_ms=0)
+    db.ensure_schema()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def discussion(db):
+    discussion_id = db.create_discussion("ranks").discussion_id
+    return Discussion(SimpleNamespace(), discussion_id, db)
+
+
+def add_messages(db, discussion_id, count, prefix="answer"):
+    return [db.insert(INSERT_MESSAGE, ("lollms", f"{prefix} {i}", 0, 1, 0, 0, discussion_id)) for i in range(count)]
+
+
+def ranks(db, discussion_id):
+    return dict(db.select("SELECT id, rank FROM message WHERE discussion_id=?", (discussion_id,)))
+
+
+def test_rank_changes_return_the_new_rank(db, discussion):
+    message_id = add_messages(db, discussion.discussion_id, 1)[0]
+    assert discussion.message_rank_up(message_id)==1
+    assert discussion.message_rank_up(message_id)==2
+    assert discussion.message_rank_down(message_id)==1
+    assert discussion.message_rank_up(10**9) is None
+
+
+def test_concurrent_votes_and_inserts_keep_every_rank(db, discussion):
+    message_ids = add_messages(db, discussion.discussion_id, 5)
+    expected = {message_id: 0 for message_id in message_ids}
+    inserted = []
+    lock = threading.Lock()
+    errors = []
+    voters, inserters = 8, 2
+    barrier = threading.Barrier(voters+inserters)
+
+    def vote(seed):
+        rng = random.Random(seed)
+        local = {message_id: 0 for message_id in message_ids}
+        barrier.wait()
+        try:
+            for _ in range(200):
+                message_id = rng.choice(message_ids)
+                if rng.random()<0.7:
+                    discussion.message_rank_up(message_id)
+                    local[message_id] += 1
+                else:
+                    discussion.message_rank_down(message_id)
+                    local[message_id] -= 1
+        except Exception as ex:
+            errors.append(ex)
+        with lock:
+            for message_id, delta in local.items():
+                expected[message_id] += delta
+
+    def insert(seed):
+        barrier.wait()
+        try:
+            new_ids = add_messages(db, discussion.discussion_id, 50, f"inserted {seed}")
+        except Exception as ex:
+            errors.append(ex)
+            return
+        with lock:
+            inserted.extend(new_ids)
+
+    threads = [threading.Thread(target=vote, args=(i,)) for i in range(voters)]
+    threads += [threading.Thread(target=insert, args=(i,)) for i in range(inserters)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors==[]
+    assert len(inserted)==len(set(inserted))==inserters*50
+    expected.update({message_id: 0 for message_id in inserted})
+    assert ranks(db, discussion.discussion_id)==expected
+
+
+def test_rate_messages(db, discussion):
+    message_ids = add_messages(db, discussion.discussion_id, 5)
+    rng = random.Random(0)
+    ratings = [(rng.choice(message_ids), rng.choice([1, -1])) for _ in range(1000)]
+    expected = {message_id: 0 for message_id in message_ids}
+    for message_id, value in ratings:
+        expected[message_id] += value
+
+    # Unknown messages are skipped and not counted
+    assert db.rate_messages(ratings+[(10**9, 1)])==len(ratings)
+    assert ranks(db, discussion.discussion_id)==expected
+
+    assert db.rate_messages([(message_ids[0], 5)], relative=False)==1
+    assert ranks(db, discussion.discussion_id)[message_ids[0]]==5